@@ -0,0 +1,402 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Offline benchmark of the mongo-logs module hot paths.
+
+Generated (or replayed) broks are managed by a MongoLogs instance connected to an
+in-process recording stand-in of MongoDB. The writer thread is replaced with a
+synchronous writer so that the DB operations are counted per managed brok.
+
+Shinken must be importable (PYTHONPATH), as for the module tests:
+
+    python bench/bench_module.py --broks 100000 --output bench.json
+    python bench/bench_module.py --replay /var/log/shinken/shinken.log
+
+Replayed files contain either raw Shinken log lines or JSON broks, one per line:
+{"type": "service_check_result", "data": {...}}
+
+The broks data are serialized as the broker does, and the broks are managed by batches.
+Results are a JSON document, for each path: broks/s, p50/p99 brok latency (µs, batch
+time divided by the batch size), DB operations per brok, retained objects and maximum RSS.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import cPickle
+import resource
+import optparse
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shinken.objects.module import Module
+
+from module import module as mongo_logs
+from module import mongo_sink
+
+
+class Result(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class RecordingCollection(object):
+    """
+    A MongoDB collection stand-in which records the operations
+    """
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.documents = 0
+
+    def record(self, operation, documents=1):
+        self.db.client.operations[operation] = self.db.client.operations.get(operation, 0) + 1
+        self.db.client.documents[operation] = self.db.client.documents.get(operation, 0) + documents
+
+    def insert_many(self, documents, ordered=True):
+        self.record('insert_many', len(documents))
+        self.documents += len(documents)
+        return Result(inserted_ids=[None] * len(documents))
+
+    def bulk_write(self, requests, ordered=True):
+        self.record('bulk_write', len(requests))
+        return Result(upserted_count=0, modified_count=len(requests))
+
+    def find(self, *args, **kwargs):
+        self.record('find')
+        return iter([])
+
+    def delete_many(self, query):
+        self.record('delete_many')
+        return Result(deleted_count=0)
+
+    def create_index(self, keys, **kwargs):
+        self.record('create_index')
+        return str(keys)
+
+    def aggregate(self, pipeline, **kwargs):
+        self.record('aggregate')
+        return iter([])
+
+
+class RecordingDatabase(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = RecordingCollection(self, name)
+        return self.collections[name]
+
+    def collection_names(self):
+        return self.collections.keys()
+
+    def drop_collection(self, name):
+        self.collections.pop(name, None)
+
+    def command(self, *args, **kwargs):
+        return {'ok': 1}
+
+
+class RecordingClient(object):
+    """
+    A MongoClient stand-in, all the clients share the same operations counters
+    """
+    operations = {}
+    documents = {}
+
+    def __init__(self, *args, **kwargs):
+        self.databases = {}
+        self.admin = self
+        self.address = ('localhost', 27017)
+
+    def command(self, *args, **kwargs):
+        return {'ismaster': True}
+
+    def server_info(self):
+        return {}
+
+    def get_database(self, name, **kwargs):
+        if name not in self.databases:
+            self.databases[name] = RecordingDatabase(self, name)
+        return self.databases[name]
+
+    def close(self):
+        pass
+
+    @classmethod
+    def reset(cls):
+        cls.operations.clear()
+        cls.documents.clear()
+
+
+class SynchronousWriter(object):
+    """
+    A writer stand-in executing the jobs immediately
+    """
+
+    def __init__(self, module):
+        self.module = module
+
+    def submit(self, operation, payload, timeout=0):
+        getattr(self.module, 'write_' + operation)(payload)
+        return True
+
+    def spill(self, job):
+        self.submit(*job)
+
+    def stats(self):
+        return {}
+
+
+class Brok(object):
+    """
+    A Shinken brok stand-in, the data is deserialized by prepare()
+    """
+
+    def __init__(self, type, data):
+        self.type = type
+        self.serialized = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+        self.reset()
+
+    def reset(self):
+        self.data = self.serialized
+        self.prepared = False
+
+    def prepare(self):
+        if not self.prepared:
+            self.data = cPickle.loads(self.data)
+            self.prepared = True
+
+
+def module_configuration(**options):
+    params = {'module_name': 'mongo-logs', 'module_type': 'mongo-logs'}
+    params.update(options)
+    return Module(params)
+
+
+SERVICE_STATES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+HOST_STATES = ['UP', 'DOWN', 'UNREACHABLE']
+
+
+def generate_log_line(r, t, host, service):
+    k = r.randint(0, 9)
+    if k == 0:
+        return '[%d] SERVICE ALERT: %s;%s;%s;HARD;3;CRITICAL - Socket timeout after 10 seconds' % (t, host, service, r.choice(SERVICE_STATES))
+    elif k == 1:
+        return '[%d] HOST ALERT: %s;%s;SOFT;1;PING CRITICAL - Packet loss = 100%%' % (t, host, r.choice(HOST_STATES))
+    elif k == 2:
+        return '[%d] SERVICE NOTIFICATION: admin;%s;%s;%s;notify-service-by-email;Service output' % (t, host, service, r.choice(SERVICE_STATES))
+    elif k == 3:
+        return '[%d] HOST NOTIFICATION: admin;%s;DOWN;notify-host-by-email;Host is down' % (t, host)
+    elif k == 4:
+        return '[%d] CURRENT SERVICE STATE: %s;%s;OK;HARD;1;OK - all is fine' % (t, host, service)
+    elif k == 5:
+        return '[%d] INITIAL HOST STATE: %s;UP;HARD;1;PING OK - rta 0.1ms' % (t, host)
+    elif k == 6:
+        return '[%d] EXTERNAL COMMAND: SCHEDULE_FORCED_SVC_CHECK;%s;%s;%d' % (t, host, service, t)
+    elif k == 7:
+        return '[%d] SERVICE EVENT HANDLER: %s;%s;CRITICAL;SOFT;2;restart-service' % (t, host, service)
+    elif k == 8:
+        return '[%d] SERVICE DOWNTIME ALERT: %s;%s;STARTED; Service has entered a period of scheduled downtime' % (t, host, service)
+    return '[%d] TIMEPERIOD TRANSITION: 24x7;-1;1' % t
+
+
+def check_result_data(r, t, host, service):
+    state_id = 0 if r.random() < 0.9 else r.randint(1, 3 if service else 2)
+    data = {
+        'host_name': host, 'state_id': state_id, 'last_state': 'OK', 'last_state_id': 0,
+        'state_type': 'HARD', 'state_type_id': 1, 'last_chk': t, 'last_state_change': t - 3600,
+        'in_scheduled_downtime': False, 'attempt': 1, 'output': 'Check output',
+        'perf_data': 'time=0.01s;;;0 size=1234B;;;0', 'long_output': '', 'business_impact': 2
+    }
+    if service:
+        data['service_description'] = service
+        data['state'] = SERVICE_STATES[state_id]
+    else:
+        data['state'] = HOST_STATES[state_id]
+    return data
+
+
+def generate_broks(count, hosts, services, seed):
+    """
+    Generate the initial status broks and a mix of log and check result broks
+    """
+    r = random.Random(seed)
+    now = int(time.time())
+    names = [('host-%05d' % h, 'Service-%02d' % s) for h in xrange(hosts) for s in xrange(services)]
+
+    initial = []
+    for h in xrange(hosts):
+        initial.append(Brok('initial_host_status', {'host_name': 'host-%05d' % h, 'business_impact': 2, 'hostgroups': ['all']}))
+    for host, service in names:
+        initial.append(Brok('initial_service_status', {'host_name': host, 'service_description': service,
+                                                       'business_impact': r.randint(0, 5), 'servicegroups': []}))
+
+    broks = []
+    for i in xrange(count):
+        t = now - count + i
+        host, service = names[r.randint(0, len(names) - 1)]
+        k = r.random()
+        if k < 0.4:
+            broks.append(Brok('log', {'log': generate_log_line(r, t, host, service)}))
+        elif k < 0.5:
+            broks.append(Brok('host_check_result', check_result_data(r, t, host, '')))
+        elif k < 0.9:
+            broks.append(Brok('service_check_result', check_result_data(r, t, host, service)))
+        else:
+            broks.append(Brok('update_service_status', check_result_data(r, t, host, service)))
+    return initial, broks
+
+
+def replay_broks(filename):
+    initial, broks = [], []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            if line.startswith('['):
+                broks.append(Brok('log', {'log': line}))
+                continue
+            brok = json.loads(line)
+            target = initial if brok['type'].startswith('initial_') else broks
+            target.append(Brok(brok['type'], brok['data']))
+    return initial, broks
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run_path(name, module, broks, finish, batch_size=100):
+    """
+    Manage broks by batches, then call the finish function (commit, rotation ...)
+    """
+    for brok in broks:
+        brok.reset()
+    batches = [broks[i:i + batch_size] for i in xrange(0, len(broks), batch_size)]
+    RecordingClient.reset()
+    gc.collect()
+    objects = len(gc.get_objects())
+
+    latencies = []
+    manage = module.manage_broks
+    start = default_timer()
+    for batch in batches:
+        t = default_timer()
+        manage(batch)
+        latencies.append((default_timer() - t) / len(batch))
+    finish()
+    duration = default_timer() - start
+
+    gc.collect()
+    latencies.sort()
+    count = len(broks) or 1
+    return {
+        'path': name,
+        'broks': len(broks),
+        'duration': duration,
+        'broks_per_second': len(broks) / duration if duration else 0.0,
+        'latency_p50_us': percentile(latencies, 50) * 1e6,
+        'latency_p99_us': percentile(latencies, 99) * 1e6,
+        'db_operations': dict(RecordingClient.operations),
+        'db_operations_per_brok': sum(RecordingClient.operations.values()) / float(count),
+        'db_documents': dict(RecordingClient.documents),
+        'retained_objects': len(gc.get_objects()) - objects,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def run(initial, broks, options):
+    mongo_sink.MongoClient = RecordingClient
+
+    module = mongo_logs.MongoLogs(module_configuration(services_filter=options.services_filter,
+                                                       commit_volume=str(options.commit_volume)))
+    module.writer = SynchronousWriter(module.storage)
+    module.storage.open()
+    module.load_availability()
+
+    def commit_logs():
+        while module.logs_cache:
+            module.commit_logs()
+
+    batch_size = options.batch_size
+    results = [run_path('initial', module, initial, lambda: None, batch_size)]
+    results.append(run_path('logs', module, [b for b in broks if b.type == 'log'], commit_logs, batch_size))
+    results.append(run_path('availability', module, [b for b in broks if b.type.endswith('check_result')],
+                            module.commit_availability, batch_size))
+    results.append(run_path('ignored', module, [b for b in broks if b.type not in ['log', 'host_check_result', 'service_check_result']],
+                            lambda: None, batch_size))
+    results.append(run_path('mixed', module, broks, lambda: (commit_logs(), module.commit_availability()), batch_size))
+    results.append(run_path('rotation', module, [], module.storage.rotate_logs))
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--broks', type='int', default=100000, help="number of generated broks")
+    parser.add_option('--hosts', type='int', default=1000, help="number of generated hosts")
+    parser.add_option('--services', type='int', default=20, help="number of services per generated host")
+    parser.add_option('--seed', type='int', default=1, help="random generator seed")
+    parser.add_option('--replay', help="replay the broks or log lines of this file")
+    parser.add_option('--services-filter', default='bi:>=2', help="module services_filter option")
+    parser.add_option('--commit-volume', type='int', default=1000, help="module commit_volume option")
+    parser.add_option('--batch-size', type='int', default=100, help="number of broks managed at once")
+    parser.add_option('--output', help="write the JSON results to this file")
+    options, args = parser.parse_args()
+
+    if options.replay:
+        initial, broks = replay_broks(options.replay)
+    else:
+        initial, broks = generate_broks(options.broks, options.hosts, options.services, options.seed)
+
+    results = {
+        'python': sys.version.split()[0],
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': options.__dict__,
+        'results': run(initial, broks, options)
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
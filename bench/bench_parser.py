@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Micro-benchmark of the mongo-logs log lines parser.
+
+Generated (or replayed) Shinken log lines are parsed in memory, without the module nor
+the DB. Each path is run several times and the best run is reported:
+
+- parse: parse_log_line of each line
+- filter_parse: the module path, the log lines filter then the parser for the accepted lines
+- pool_parse (--parse-workers N): the module parse_workers path, the lines are parsed by
+  batches split in chunks mapped on a pool of N processes, the parsed documents being sent
+  back to the parent process
+
+Shinken must be importable (PYTHONPATH), as for the module tests:
+
+    python bench/bench_parser.py --lines 200000
+    python bench/bench_parser.py --replay /var/log/shinken/shinken.log --output parser.json
+
+Results are a JSON document, for each path: lines/s, stored lines and the best run duration.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import optparse
+import multiprocessing
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from module.log_line import parse_log_line, LoglineWrongFormat
+from module.filters import LogLinesFilter
+from module.module import parse_log_lines, PARSE_CHUNK_MIN
+from bench_module import generate_log_line
+
+
+def generate_lines(count, hosts, services, seed):
+    r = random.Random(seed)
+    now = int(time.time())
+    lines = []
+    for i in xrange(count):
+        host = 'host-%05d' % r.randint(0, hosts - 1)
+        service = 'Service-%02d' % r.randint(0, services - 1)
+        lines.append(generate_log_line(r, now - count + i, host, service))
+    return lines
+
+
+def replay_lines(filename):
+    with open(filename) as f:
+        return [line.rstrip('\n') for line in f if line.startswith('[')]
+
+
+def parse(lines):
+    stored = 0
+    for line in lines:
+        try:
+            if parse_log_line(line):
+                stored += 1
+        except LoglineWrongFormat:
+            pass
+    return stored
+
+
+def filter_parse(lines, logs_filter):
+    stored = 0
+    check = logs_filter.check
+    for line in lines:
+        if check(line):
+            continue
+        try:
+            if parse_log_line(line):
+                stored += 1
+        except LoglineWrongFormat:
+            pass
+    return stored
+
+
+def pool_parse(lines, pool, workers, batch_size):
+    stored = 0
+    for start in xrange(0, len(lines), batch_size):
+        batch = lines[start:start + batch_size]
+        if len(batch) < 2 * PARSE_CHUNK_MIN:
+            stored += len(parse_log_lines(batch))
+            continue
+        chunk = max(PARSE_CHUNK_MIN, len(batch) / workers + 1)
+        chunks = [batch[i:i + chunk] for i in xrange(0, len(batch), chunk)]
+        for documents in pool.map(parse_log_lines, chunks):
+            stored += len(documents)
+    return stored
+
+
+def run_path(name, function, lines, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = default_timer()
+        stored = function(lines)
+        duration = default_timer() - start
+        if best is None or duration < best:
+            best = duration
+    return {
+        'path': name,
+        'lines': len(lines),
+        'stored': stored,
+        'duration': best,
+        'lines_per_second': len(lines) / best if best else 0.0
+    }
+
+
+def run(lines, options):
+    logs_filter = LogLinesFilter(options.logs_include, options.logs_exclude)
+    results = [
+        run_path('parse', parse, lines, options.repeat),
+        run_path('filter_parse', lambda lines: filter_parse(lines, logs_filter), lines, options.repeat)
+    ]
+    if options.parse_workers:
+        workers = options.parse_workers
+        pool = multiprocessing.Pool(workers)
+        try:
+            results.append(run_path(
+                'pool_parse', lambda lines: pool_parse(lines, pool, workers, options.batch_size),
+                lines, options.repeat
+            ))
+        finally:
+            pool.terminate()
+        results[-1]['parse_workers'] = workers
+        results[-1]['cpu_count'] = multiprocessing.cpu_count()
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--lines', type='int', default=100000, help="number of generated log lines")
+    parser.add_option('--hosts', type='int', default=1000, help="number of generated hosts")
+    parser.add_option('--services', type='int', default=20, help="number of services per generated host")
+    parser.add_option('--seed', type='int', default=1, help="random generator seed")
+    parser.add_option('--replay', help="parse the log lines of this file")
+    parser.add_option('--repeat', type='int', default=3, help="number of runs of each path, the best run is reported")
+    parser.add_option('--parse-workers', type='int', default=0, help="also parse in a pool of N processes")
+    parser.add_option('--batch-size', type='int', default=5000, help="log lines per pool parsing batch")
+    parser.add_option('--logs-include', default='', help="module logs_include option")
+    parser.add_option('--logs-exclude', default='', help="module logs_exclude option")
+    parser.add_option('--output', help="write the JSON results to this file")
+    options, args = parser.parse_args()
+
+    if options.replay:
+        lines = replay_lines(options.replay)
+    else:
+        lines = generate_lines(options.lines, options.hosts, options.services, options.seed)
+
+    results = {
+        'python': sys.version.split()[0],
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': options.__dict__,
+        'results': run(lines, options)
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
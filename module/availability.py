@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This is the availability accounting of the mongo-logs module.
+
+A daily availability record accounts the seconds spent by an host/service in each state
+(daily_0 to daily_3) during a local day. The record is accounted up to its last check
+timestamp, the seconds of the day which are not accounted are in daily_4 (unchecked).
+
+A check result tells the current state and when the state changed: the seconds since the
+last accounted time are split between the previous state and the current state at the state
+change time. When a day ends, the record is closed: the last state lasts until midnight and
+the next day record starts at midnight in this state.
+
+The functions are shared by the broker module and the backfill tool.
+"""
+
+import time
+import datetime
+
+
+class Day(object):
+    """
+    A local day: name (YYYY-MM-DD), start and end timestamps
+
+    Days are 23 or 25 hours long when the daylight saving time changes.
+    """
+    __slots__ = ('date', 'name', 'start', 'end')
+
+    def __init__(self, date):
+        self.date = date
+        self.name = date.strftime('%Y-%m-%d')
+        self.start = int(time.mktime(date.timetuple()))
+        self.end = int(time.mktime((date + datetime.timedelta(days=1)).timetuple()))
+
+    @classmethod
+    def today(cls):
+        return cls(datetime.date.today())
+
+    @classmethod
+    def from_timestamp(cls, timestamp):
+        return cls(datetime.date.fromtimestamp(timestamp))
+
+    def next(self):
+        return Day(self.date + datetime.timedelta(days=1))
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __contains__(self, timestamp):
+        return self.start <= timestamp < self.end
+
+    def __eq__(self, other):
+        return isinstance(other, Day) and self.date == other.date
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return self.name
+
+
+def new_record(hostname, service, day, previous=None):
+    """
+    Get a new daily availability record
+
+    If the previous record was closed at the start of the day, the record continues in its last state.
+    """
+    data = {
+        'hostname': hostname,
+        'service': service,
+        'day': day.name,
+        'day_ts': day.start,
+        'is_downtime': '0',
+        'daily_0': 0,
+        'daily_1': 0,
+        'daily_2': 0,
+        'daily_3': 0,
+        'daily_4': len(day)
+    }
+    if previous is not None and previous.get('last_check_timestamp') == day.start:
+        data['last_check_state'] = previous['last_check_state']
+        data['last_check_timestamp'] = day.start
+        data['is_downtime'] = previous['is_downtime']
+    return data
+
+
+def account(data, state, seconds):
+    if seconds > 0:
+        data['daily_%d' % state] += seconds
+
+
+def update_unchecked(data, day):
+    data['daily_4'] = len(day) - data['daily_0'] - data['daily_1'] - data['daily_2'] - data['daily_3']
+
+
+def record_check(data, day, state_id, check_time, state_change_time=None, downtime=False):
+    """
+    Account a check result in a daily availability record
+
+    - state_id: current state
+    - check_time: check timestamp
+    - state_change_time: timestamp when the current state started, if known
+    """
+    t = min(max(int(check_time), day.start), day.end)
+    change = int(state_change_time) if state_change_time else None
+
+    if 'last_check_timestamp' not in data:
+        # First check of the record, the state is known since its last change
+        if change is not None and change < t:
+            account(data, state_id, t - max(change, day.start))
+    else:
+        last = data['last_check_timestamp']
+        previous = data['last_check_state']
+        if t < last:
+            # Older than the accounted time
+            return data
+        if state_id == previous or change is None:
+            account(data, previous, t - last)
+        elif change <= last:
+            # State changed before the accounted time, the previous state is not reliable
+            account(data, state_id, t - last)
+        else:
+            change = min(change, t)
+            account(data, previous, change - last)
+            account(data, state_id, t - change)
+
+    if 'first_check_timestamp' not in data:
+        data['first_check_state'] = state_id
+        data['first_check_timestamp'] = int(check_time)
+    data['last_check_state'] = state_id
+    data['last_check_timestamp'] = t
+    data['is_downtime'] = '1' if downtime else '0'
+    update_unchecked(data, day)
+    return data
+
+
+def close_record(data, day):
+    """
+    Close a daily availability record at the end of its day: the last state lasts until midnight
+    """
+    if 'last_check_timestamp' in data and data['last_check_timestamp'] < day.end:
+        account(data, data['last_check_state'], day.end - data['last_check_timestamp'])
+        data['last_check_timestamp'] = day.end
+        update_unchecked(data, day)
+    return data
+
+
+def percentages(data):
+    """
+    Set the percentage of the accounted seconds in each state (percent_0 to percent_4) of an
+    availability record, or of the sum of several records
+    """
+    total = sum(data['daily_%d' % state] for state in xrange(5))
+    for state in xrange(5):
+        data['percent_%d' % state] = 100.0 * data['daily_%d' % state] / total if total else 0.0
+    return data
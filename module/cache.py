@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This class is a small results cache of the mongo-logs module queries.
+
+The least recently used results are evicted when the cache is full, and the results
+expire after a time to live. The cache is shared by the WebUI threads.
+"""
+
+import time
+import threading
+
+from collections import deque
+
+
+class ResultsCache(object):
+    """
+    The cache is a dictionary and a queue of its keys, least recently used first
+
+    Python 2.6 has no OrderedDict: a hit moves its key at the end of the queue.
+    """
+
+    def __init__(self, size=100, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        # key -> (expiration time, value)
+        self.entries = {}
+        self.order = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Get a cached value, or None if it is not cached or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.order.remove(key)
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            self.order.append(key)
+            return entry[1]
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.order.remove(key)
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.order.append(key)
+            while len(self.order) > self.size:
+                del self.entries[self.order.popleft()]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.order.clear()
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+These classes are the services filter and the log lines filter of the mongo-logs module.
+
+The filter declaration is compiled once. A filter is a comma separated list of rules, a
+service matches the filter if it matches any rule. A rule is a list of conditions separated
+with &, a service matches the rule if it matches all the conditions:
+
+- regexp: matched against host_name/service_description (also re:regexp or service_description:regexp)
+- bi:>x, bi:>=x, bi:<x, bi:<=x, bi:=x: business impact (bp: is an alias)
+- hg:name: host is a member of the host group
+- sg:name: service is a member of the service group
+
+A condition prefixed with ! is negated.
+
+The log lines filter selects the log lines to store with include/exclude lists of log line
+types (SERVICE ALERT, CURRENT HOST STATE, ...) or logclasses (class:alert, class:state, ...).
+The decision only depends on the line type, it is made before the line is parsed.
+"""
+
+import re
+
+from shinken.log import logger
+
+from .log_line import line_type, log_type_spec, LOGCLASS_NAMES, LOGCLASS_INVALID
+
+
+class ServicesFilterError(Exception):
+    pass
+
+
+BI_OPERATORS = [
+    ('>=', lambda bi, value: bi >= value),
+    ('<=', lambda bi, value: bi <= value),
+    ('>', lambda bi, value: bi > value),
+    ('<', lambda bi, value: bi < value),
+    ('=', lambda bi, value: bi == value),
+]
+
+
+# Regexps which meaning changes when they are combined: backreferences and global flags
+NOT_COMBINED_REGEXP = re.compile(r"\\[1-9]|\(\?P=|\(\?[iLmsux]+\)")
+
+
+def parse_condition(condition):
+    """
+    Parse a filter condition, returns a (negate, kind, value) tuple
+    """
+    negate = condition.startswith('!')
+    if negate:
+        condition = condition[1:].strip()
+
+    kind, value = 're', condition
+    elts = condition.split(':', 1)
+    if len(elts) > 1 and elts[0].lower() in ['re', 'service_description', 'bi', 'bp', 'hg', 'sg']:
+        kind, value = elts[0].lower(), elts[1].strip()
+    if kind == 'service_description':
+        kind = 're'
+    elif kind == 'bp':
+        kind = 'bi'
+    return negate, kind, value
+
+
+def compile_condition(condition):
+    """
+    Compile a filter condition to a function (service_id, bi, hostgroups, servicegroups) -> bool
+    """
+    negate, kind, value = parse_condition(condition)
+
+    if kind == 're':
+        try:
+            search = re.compile(value, re.IGNORECASE).search
+        except re.error, exp:
+            raise ServicesFilterError("invalid regexp %s: %s" % (value, exp))
+        test = lambda service_id, bi, hostgroups, servicegroups: search(service_id) is not None
+
+    elif kind == 'bi':
+        for operator, compare in BI_OPERATORS:
+            if value.startswith(operator):
+                try:
+                    threshold = int(value[len(operator):])
+                except ValueError:
+                    raise ServicesFilterError("invalid business impact: %s" % value)
+                test = (lambda compare, threshold: lambda service_id, bi, hostgroups, servicegroups: compare(bi, threshold))(compare, threshold)
+                break
+        else:
+            raise ServicesFilterError("invalid business impact operator: %s" % value)
+
+    elif kind == 'hg':
+        test = lambda service_id, bi, hostgroups, servicegroups: value in hostgroups
+
+    else:
+        test = lambda service_id, bi, hostgroups, servicegroups: value in servicegroups
+
+    if negate:
+        return lambda *args: not test(*args)
+    return test
+
+
+class ServicesFilter(object):
+    """
+    The rules made of a single regexp, host group or service group condition are combined:
+    one regexp search and one groups intersection test them all.
+    """
+
+    def __init__(self, services_filter):
+        self.rules = []
+        patterns = []
+        groups = {'hg': set(), 'sg': set()}
+        for rule in services_filter.split(','):
+            rule = rule.strip()
+            if not rule:
+                continue
+            logger.info('[mongo-logs] services filtering rule: %s', rule)
+            conditions = [c.strip() for c in rule.split('&') if c.strip()]
+            try:
+                tests = [compile_condition(c) for c in conditions]
+            except ServicesFilterError, exp:
+                logger.error('[mongo-logs] services filtering rule ignored: %s, %s', rule, str(exp))
+                continue
+            negate, kind, value = parse_condition(conditions[0])
+            if len(conditions) > 1 or negate:
+                self.rules.append(tests)
+            elif kind == 're' and not NOT_COMBINED_REGEXP.search(value):
+                patterns.append(value)
+            elif kind in groups:
+                groups[kind].add(value)
+            else:
+                self.rules.append(tests)
+
+        if len(patterns) > 1:
+            try:
+                search = re.compile('|'.join('(?:%s)' % pattern for pattern in patterns), re.IGNORECASE).search
+                self.rules.append([lambda service_id, bi, hostgroups, servicegroups: search(service_id) is not None])
+                patterns = []
+            except re.error:
+                pass
+        for pattern in patterns:
+            self.rules.append([compile_condition('re:' + pattern)])
+        if groups['hg']:
+            self.rules.append([lambda service_id, bi, hostgroups, servicegroups: not groups['hg'].isdisjoint(hostgroups)])
+        if groups['sg']:
+            self.rules.append([lambda service_id, bi, hostgroups, servicegroups: not groups['sg'].isdisjoint(servicegroups)])
+
+        # Memoized decisions: (service_id, bi, hostgroups, servicegroups) -> bool
+        self.decisions = {}
+
+    def __nonzero__(self):
+        return bool(self.rules)
+
+    def match(self, service_id, bi, hostgroups=(), servicegroups=()):
+        """
+        Does a service match the filter?
+        """
+        key = (service_id, bi, hostgroups, servicegroups)
+        decision = self.decisions.get(key)
+        if decision is None:
+            decision = any(all(test(service_id, bi, hostgroups, servicegroups) for test in rule) for rule in self.rules)
+            self.decisions[key] = decision
+        return decision
+
+
+# Log lines types which are never stored: Info:, Warning: ... debug messages
+NOT_STORED_TYPE = re.compile(r"^[A-Z][a-z]*.$")
+
+# Log lines rejection reasons
+REJECT_NOT_STORED = 'not_stored'
+REJECT_INVALID = 'invalid'
+REJECT_EXCLUDED = 'excluded'
+
+# Maximum number of memoized line types, malformed lines may have any type
+MAX_DECISIONS = 1000
+
+
+class LogLinesFilter(object):
+
+    def __init__(self, include='', exclude=''):
+        self.include_types, self.include_classes = self.parse_list(include)
+        self.exclude_types, self.exclude_classes = self.parse_list(exclude)
+        if include:
+            logger.info('[mongo-logs] stored log lines: %s', include)
+        if exclude:
+            logger.info('[mongo-logs] excluded log lines: %s', exclude)
+
+        # Memoized decisions: line type -> rejection reason or None
+        self.decisions = {}
+
+    @staticmethod
+    def parse_list(declaration):
+        types, classes = set(), set()
+        for elt in declaration.split(','):
+            elt = elt.strip()
+            if not elt:
+                continue
+            if elt.lower().startswith('class:'):
+                name = elt[len('class:'):].strip().lower()
+                if name in LOGCLASS_NAMES:
+                    classes.add(LOGCLASS_NAMES[name])
+                else:
+                    logger.error('[mongo-logs] unknown log lines class ignored: %s, must be one of %s',
+                                 name, sorted(LOGCLASS_NAMES))
+            else:
+                types.add(elt.upper())
+        return types, classes
+
+    def decide(self, type):
+        if NOT_STORED_TYPE.match(type):
+            return REJECT_NOT_STORED
+
+        logclass = log_type_spec(type)[1]
+        if logclass == LOGCLASS_INVALID:
+            return REJECT_INVALID
+
+        if (self.include_types or self.include_classes) and \
+                type not in self.include_types and logclass not in self.include_classes:
+            return REJECT_EXCLUDED
+        if type in self.exclude_types or logclass in self.exclude_classes:
+            return REJECT_EXCLUDED
+        return None
+
+    def check(self, line):
+        """
+        Get the reason why a log line is not to be stored, or None if the line is to be stored
+        """
+        type = line_type(line)
+        try:
+            return self.decisions[type]
+        except KeyError:
+            decision = self.decide(type)
+            if len(self.decisions) < MAX_DECISIONS:
+                self.decisions[type] = decision
+            return decision
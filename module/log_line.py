@@ -31,6 +31,15 @@ LOGCLASS_COMMAND = 5       # external commands
 LOGCLASS_STATE = 6         # initial or current states
 LOGCLASS_INVALID = -1      # never stored
 LOGCLASS_ALL = 0xffff
+LOGCLASS_NAMES = {
+    'info': LOGCLASS_INFO,
+    'alert': LOGCLASS_ALERT,
+    'program': LOGCLASS_PROGRAM,
+    'notification': LOGCLASS_NOTIFICATION,
+    'passivecheck': LOGCLASS_PASSIVECHECK,
+    'command': LOGCLASS_COMMAND,
+    'state': LOGCLASS_STATE
+}
 LOGOBJECT_INFO = 0
 LOGOBJECT_HOST = 1
 LOGOBJECT_SERVICE = 2
@@ -42,6 +51,296 @@ class LoglineWrongFormat(Exception):
     pass
 
 
+SERVICE_STATES = {
+    'OK': 0,
+    'WARNING': 1,
+    'CRITICAL': 2,
+    'UNKNOWN': 3,
+    'RECOVERY': 0
+}
+HOST_STATES = {
+    'UP': 0,
+    'DOWN': 1,
+    'UNREACHABLE': 2,
+    'UNKNOWN': 3,
+    'RECOVERY': 0
+}
+
+# Log line types parsing specifications
+# kind: (logobject, logclass, fields, states, state field)
+# - fields: names of the ';' separated fields of the line details, None for a field that is not stored
+# - states: states map used to convert the state field to the state value, or None
+SERVICE_STATE_FIELDS = ('host_name', 'service_description', 'state', 'state_type', 'attempt', 'plugin_output')
+HOST_STATE_FIELDS = ('host_name', 'state', 'state_type', 'attempt', 'plugin_output')
+LOG_TYPES = {
+    'CURRENT SERVICE STATE': (LOGOBJECT_SERVICE, LOGCLASS_STATE, SERVICE_STATE_FIELDS, None, None),
+    'INITIAL SERVICE STATE': (LOGOBJECT_SERVICE, LOGCLASS_STATE, SERVICE_STATE_FIELDS, None, None),
+    # SERVICE ALERT: srv-40;Service-9;CRITICAL;HARD;1;[Errno 2] No such file or directory
+    'SERVICE ALERT': (LOGOBJECT_SERVICE, LOGCLASS_ALERT, SERVICE_STATE_FIELDS, SERVICE_STATES, 'state'),
+    'SERVICE DOWNTIME ALERT': (LOGOBJECT_SERVICE, LOGCLASS_ALERT,
+                               ('host_name', 'service_description', 'state_type', 'comment'), None, None),
+    'SERVICE FLAPPING ALERT': (LOGOBJECT_SERVICE, LOGCLASS_ALERT,
+                               ('host_name', 'service_description', 'state_type', 'comment'), None, None),
+
+    'CURRENT HOST STATE': (LOGOBJECT_HOST, LOGCLASS_STATE, HOST_STATE_FIELDS, None, None),
+    'INITIAL HOST STATE': (LOGOBJECT_HOST, LOGCLASS_STATE, HOST_STATE_FIELDS, None, None),
+    'HOST ALERT': (LOGOBJECT_HOST, LOGCLASS_ALERT, HOST_STATE_FIELDS, HOST_STATES, 'state'),
+    'HOST DOWNTIME ALERT': (LOGOBJECT_HOST, LOGCLASS_ALERT, ('host_name', 'state_type', 'comment'), None, None),
+    'HOST FLAPPING ALERT': (LOGOBJECT_HOST, LOGCLASS_ALERT, ('host_name', 'state_type', 'comment'), None, None),
+
+    # tust_cuntuct;test_host_0;test_ok_0;CRITICAL;notify-service;i am CRITICAL  <-- normal
+    # SERVICE NOTIFICATION: test_contact;test_host_0;test_ok_0;DOWNTIMESTART (OK);notify-service;OK
+    # downtime/flapping/etc-notifications take the type UNKNOWN
+    'SERVICE NOTIFICATION': (LOGOBJECT_SERVICE, LOGCLASS_NOTIFICATION,
+                             ('contact_name', 'host_name', 'service_description', 'state_type', 'command_name', None),
+                             SERVICE_STATES, 'state_type'),
+    # tust_cuntuct;test_host_0;DOWN;notify-host;i am DOWN
+    'HOST NOTIFICATION': (LOGOBJECT_HOST, LOGCLASS_NOTIFICATION,
+                          ('contact_name', 'host_name', 'state_type', 'command_name', None),
+                          HOST_STATES, 'state_type'),
+
+    'PASSIVE SERVICE CHECK': (LOGOBJECT_SERVICE, LOGCLASS_PASSIVECHECK,
+                              ('host_name', 'service_description', 'state', None), None, None),
+    'PASSIVE HOST CHECK': (LOGOBJECT_HOST, LOGCLASS_PASSIVECHECK, ('host_name', 'state', None), None, None),
+
+    'SERVICE EVENT HANDLER': (LOGOBJECT_SERVICE, LOGCLASS_NOTIFICATION,
+                              ('host_name', 'service_description', 'state', 'state_type', 'attempt', 'command_name'),
+                              SERVICE_STATES, 'state'),
+    'HOST EVENT HANDLER': (LOGOBJECT_HOST, LOGCLASS_NOTIFICATION,
+                           ('host_name', 'state', 'state_type', 'attempt', 'command_name'),
+                           HOST_STATES, 'state'),
+
+    'EXTERNAL COMMAND': (LOGOBJECT_INFO, LOGCLASS_COMMAND, (), None, None),
+
+    'TIMEPERIOD TRANSITION': (LOGOBJECT_INFO, LOGCLASS_PROGRAM, (), None, None),
+
+    'INFO': (LOGOBJECT_INFO, LOGCLASS_PROGRAM, (), None, None),
+    'WARNING': (LOGOBJECT_INFO, LOGCLASS_PROGRAM, (), None, None),
+    'ERROR': (LOGOBJECT_INFO, LOGCLASS_PROGRAM, (), None, None),
+}
+PROGRAM_TYPE_PREFIXES = ('starting...', 'shutting down...', 'Bailing out', 'active mode...', 'standby mode...', 'Warning')
+PROGRAM_TYPE_SPEC = (LOGOBJECT_INFO, LOGCLASS_PROGRAM, (), None, None)
+INVALID_TYPE_SPEC = (LOGOBJECT_INFO, LOGCLASS_INVALID, (), None, None)
+
+
+def log_type_spec(type):
+    """
+    Get the parsing specification of a log line type
+    """
+    spec = LOG_TYPES.get(type)
+    if spec is None:
+        if type.startswith(PROGRAM_TYPE_PREFIXES):
+            return PROGRAM_TYPE_SPEC
+        return INVALID_TYPE_SPEC
+    return spec
+
+
+def line_type(line):
+    """
+    Get the type of a Shinken log line: [1278280765] SERVICE ALERT: ... is a SERVICE ALERT line
+    """
+    return line[line.find(' ') + 1:line.find(':')]
+
+
+def parse_line(line):
+    """
+    Parse a Shinken log line and return the document to store for this line
+
+    The logclass of the returned document is LOGCLASS_INVALID if the line type is unknown.
+    Raises LoglineWrongFormat if the line is malformed.
+    """
+    if isinstance(line, unicode):
+        line = line.encode('UTF-8').rstrip()
+
+    # [1278280765] SERVICE ALERT: test_host_0
+    if line[:1] != '[':
+        logger.warning("[Livestatus Log Lines] Invalid line: %s" % line)
+        raise LoglineWrongFormat
+
+    last_type_pos = line.find(':')
+    type = line_type(line)
+    logobject, logclass, fields, states, state_field = log_type_spec(type)
+
+    try:
+        doc = {
+            'logobject': logobject,
+            'attempt': 0,
+            'logclass': logclass,
+            'command_name': '',
+            'comment': '',
+            'contact_name': '',
+            'host_name': '',
+            'message': line,
+            'options': '',  # Fix a mismatch of number of fields with old databases and new ones
+            'plugin_output': '',
+            'service_description': '',
+            'state': 0,
+            'state_type': '',
+            'time': int(line[1:line.find(']')]),
+            'type': type
+        }
+
+        if fields:
+            values = line[last_type_pos + 2:].split(';', len(fields) - 1)
+            if len(values) != len(fields):
+                raise ValueError("%d fields expected" % len(fields))
+            for field, value in zip(fields, values):
+                if field:
+                    doc[field] = value
+            if state_field == 'state_type' and '(' in doc['state_type']:
+                doc['state_type'] = 'UNKNOWN'
+            if states:
+                doc['state'] = states[doc[state_field]]
+            if 'attempt' in fields:
+                doc['attempt'] = int(doc['attempt'])
+    except (ValueError, KeyError), exp:
+        logger.warning("[Livestatus Log Lines] Invalid line: %s (%s)" % (line, exp))
+        raise LoglineWrongFormat
+
+    return doc
+
+
+def parse_log_line(line):
+    """
+    Parse a Shinken log line and return the document to store, or None if the line is not to be stored
+    """
+    doc = parse_line(line)
+    if doc['logclass'] == LOGCLASS_INVALID:
+        return None
+    return doc
+
+
+# Compact storage schema: short keys, the empty/default values are not stored
+# full key: (compact key, default value)
+COMPACT_FIELDS = {
+    'logobject': ('o', LOGOBJECT_INFO),
+    'attempt': ('a', 0),
+    'logclass': ('c', LOGCLASS_INFO),
+    'command_name': ('cn', ''),
+    'comment': ('co', ''),
+    'contact_name': ('ct', ''),
+    'host_name': ('h', ''),
+    'message': ('m', ''),
+    'options': ('op', ''),
+    'plugin_output': ('p', ''),
+    'service_description': ('s', ''),
+    'state': ('st', 0),
+    'state_type': ('sy', ''),
+    'time': ('t', 0),
+    'type': ('y', ''),
+}
+EXPANDED_FIELDS = dict((compact, (full, default)) for full, (compact, default) in COMPACT_FIELDS.iteritems())
+
+
+# Names of the states values, RECOVERY is not rebuilt
+SERVICE_STATES_NAMES = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}
+HOST_STATES_NAMES = {0: 'UP', 1: 'DOWN', 2: 'UNREACHABLE', 3: 'UNKNOWN'}
+
+
+def rebuild_message(doc):
+    """
+    Rebuild the message of a log line document from its type and fields, or None if it can not be rebuilt
+    """
+    logobject, logclass, fields, states, state_field = log_type_spec(doc['type'])
+    if not fields or None in fields:
+        return None
+    values = []
+    for field in fields:
+        if field == 'state' and states:
+            names = SERVICE_STATES_NAMES if states is SERVICE_STATES else HOST_STATES_NAMES
+            values.append(names.get(doc['state'], ''))
+        else:
+            values.append('%s' % doc[field])
+    return '[%d] %s: %s' % (doc['time'], doc['type'], ';'.join(values))
+
+
+def compact_document(doc, message=True):
+    """
+    Get the compact form of a log line document
+
+    The message is not stored if message is False and it can be rebuilt from the other fields.
+    The fields which are not log line columns (date, _id) are kept as they are.
+    """
+    result = {}
+    for key, value in doc.iteritems():
+        compact = COMPACT_FIELDS.get(key)
+        if compact is None:
+            result[key] = value
+        elif value != compact[1]:
+            result[compact[0]] = value
+    if not message and 'm' in result and rebuild_message(doc) == doc['message']:
+        del result['m']
+    return result
+
+
+def expand_document(doc):
+    """
+    Get the full form of a log line document stored with the compact schema
+    """
+    result = dict((full, default) for full, default in EXPANDED_FIELDS.itervalues())
+    for key, value in doc.iteritems():
+        expanded = EXPANDED_FIELDS.get(key)
+        result[expanded[0] if expanded else key] = value
+    if not result['message']:
+        result['message'] = rebuild_message(result) or ''
+    return result
+
+
+# Bucketed storage: the log lines of an hour are stored in bucket documents, by item or by logclass
+# bucketing: full keys of the log lines fields shared by a bucket
+BUCKET_KEYS = {
+    'item': ('host_name', 'service_description'),
+    'logclass': ('logclass', ),
+}
+# Bucket documents fields which are not log lines fields
+BUCKET_FIELDS = frozenset(['_id', 'hour', 'min_time', 'max_time', 'count', 'logs', 'date'])
+
+
+def buckets_query(start=None, end=None):
+    """
+    Get the query selecting the buckets which may contain log lines of a time range
+    """
+    query = {}
+    if start is not None:
+        query['hour'] = {'$gt': start - 3600}
+        query['max_time'] = {'$gte': start}
+    if end is not None:
+        query.setdefault('hour', {})['$lte'] = end
+        query['min_time'] = {'$lte': end}
+    return query
+
+
+def expand_bucket(bucket, start=None, end=None):
+    """
+    Get the log lines documents of a bucket in their full form, in time order
+
+    The lines may be limited to a time range. A batch of lines pushed twice in a bucket,
+    when a write is retried, is only returned once.
+    """
+    shared = dict((key, value) for key, value in bucket.iteritems() if key not in BUCKET_FIELDS)
+    time_field = COMPACT_FIELDS['time'][0]
+    compact = bool(bucket['logs']) and time_field in bucket['logs'][0]
+    if not compact:
+        time_field = 'time'
+
+    seen = set()
+    result = []
+    for entry in bucket['logs']:
+        t = entry.get(time_field, 0)
+        if (start is not None and t < start) or (end is not None and t > end):
+            continue
+        id = entry.get('_id')
+        if id is not None:
+            if id in seen:
+                continue
+            seen.add(id)
+        doc = dict(shared)
+        doc.update(entry)
+        result.append(expand_document(doc) if compact else doc)
+    result.sort(key=lambda doc: doc['time'])
+    return result
+
+
 class Logline(dict):
     """A class which represents a line from the logfile
     Public functions:
@@ -64,167 +363,10 @@ class Logline(dict):
                 else:
                     setattr(self, col[0], sqlite_row[idx])
         elif line != None:
-            if isinstance(line, unicode):
-                line = line.encode('UTF-8').rstrip()
-
-            # [1278280765] SERVICE ALERT: test_host_0
-            if line[0] != '[' and line[11] != ']':
-                logger.warning("[Livestatus Log Lines] Invalid line: %s" % line)
-                raise LoglineWrongFormat
-            else:
-                service_states = {
-                    'OK': 0,
-                    'WARNING': 1,
-                    'CRITICAL': 2,
-                    'UNKNOWN': 3,
-                    'RECOVERY': 0
-                }
-                host_states = {
-                    'UP': 0,
-                    'DOWN': 1,
-                    'UNREACHABLE': 2,
-                    'UNKNOWN': 3,
-                    'RECOVERY': 0
-                }
-
-                # type is 0:info, 1:state, 2:program, 3:notification, 4:passive, 5:command
-                logobject = LOGOBJECT_INFO
-                logclass = LOGCLASS_INVALID
-                attempt, state = [0] * 2
-                command_name, comment, contact_name, host_name, message, plugin_output, service_description, state_type = [''] * 8
-                time = line[1:11]
-                first_type_pos = line.find(' ') + 1
-                last_type_pos = line.find(':')
-                first_detail_pos = last_type_pos + 2
-                type = line[first_type_pos:last_type_pos]
-                options = line[first_detail_pos:]
-                message = line
-                if type == 'CURRENT SERVICE STATE':
-                    logobject = LOGOBJECT_SERVICE
-                    logclass = LOGCLASS_STATE
-                    host_name, service_description, state, state_type, attempt, plugin_output = options.split(';', 5)
-                elif type == 'INITIAL SERVICE STATE':
-                    logobject = LOGOBJECT_SERVICE
-                    logclass = LOGCLASS_STATE
-                    host_name, service_description, state, state_type, attempt, plugin_output = options.split(';', 5)
-                elif type == 'SERVICE ALERT':
-                    # SERVICE ALERT: srv-40;Service-9;CRITICAL;HARD;1;[Errno 2] No such file or directory
-                    logobject = LOGOBJECT_SERVICE
-                    logclass = LOGCLASS_ALERT
-                    host_name, service_description, state, state_type, attempt, plugin_output = options.split(';', 5)
-                    state = service_states[state]
-                elif type == 'SERVICE DOWNTIME ALERT':
-                    logobject = LOGOBJECT_SERVICE
-                    logclass = LOGCLASS_ALERT
-                    host_name, service_description, state_type, comment = options.split(';', 3)
-                elif type == 'SERVICE FLAPPING ALERT':
-                    logobject = LOGOBJECT_SERVICE
-                    logclass = LOGCLASS_ALERT
-                    host_name, service_description, state_type, comment = options.split(';', 3)
-
-                elif type == 'CURRENT HOST STATE':
-                    logobject = LOGOBJECT_HOST
-                    logclass = LOGCLASS_STATE
-                    host_name, state, state_type, attempt, plugin_output = options.split(';', 4)
-                elif type == 'INITIAL HOST STATE':
-                    logobject = LOGOBJECT_HOST
-                    logclass = LOGCLASS_STATE
-                    host_name, state, state_type, attempt, plugin_output = options.split(';', 4)
-                elif type == 'HOST ALERT':
-                    logobject = LOGOBJECT_HOST
-                    logclass = LOGCLASS_ALERT
-                    host_name, state, state_type, attempt, plugin_output = options.split(';', 4)
-                    state = host_states[state]
-                elif type == 'HOST DOWNTIME ALERT':
-                    logobject = LOGOBJECT_HOST
-                    logclass = LOGCLASS_ALERT
-                    host_name, state_type, comment = options.split(';', 2)
-                elif type == 'HOST FLAPPING ALERT':
-                    logobject = LOGOBJECT_HOST
-                    logclass = LOGCLASS_ALERT
-                    host_name, state_type, comment = options.split(';', 2)
-
-                elif type == 'SERVICE NOTIFICATION':
-                    # tust_cuntuct;test_host_0;test_ok_0;CRITICAL;notify-service;i am CRITICAL  <-- normal
-                    # SERVICE NOTIFICATION: test_contact;test_host_0;test_ok_0;DOWNTIMESTART (OK);notify-service;OK
-                    logobject = LOGOBJECT_SERVICE
-                    logclass = LOGCLASS_NOTIFICATION
-                    contact_name, host_name, service_description, state_type, command_name, check_plugin_output = options.split(';', 5)
-                    if '(' in state_type:  # downtime/flapping/etc-notifications take the type UNKNOWN
-                        state_type = 'UNKNOWN'
-                    state = service_states[state_type]
-                elif type == 'HOST NOTIFICATION':
-                    # tust_cuntuct;test_host_0;DOWN;notify-host;i am DOWN
-                    logobject = LOGOBJECT_HOST
-                    logclass = LOGCLASS_NOTIFICATION
-                    contact_name, host_name, state_type, command_name, check_plugin_output = options.split(';', 4)
-                    if '(' in state_type:
-                        state_type = 'UNKNOWN'
-                    state = host_states[state_type]
-
-                elif type == 'PASSIVE SERVICE CHECK':
-                    logobject = LOGOBJECT_SERVICE
-                    logclass = LOGCLASS_PASSIVECHECK
-                    host_name, service_description, state, check_plugin_output = options.split(';', 3)
-                elif type == 'PASSIVE HOST CHECK':
-                    logobject = LOGOBJECT_HOST
-                    logclass = LOGCLASS_PASSIVECHECK
-                    host_name, state, check_plugin_output = options.split(';', 2)
-
-                elif type == 'SERVICE EVENT HANDLER':
-                    logobject = LOGOBJECT_SERVICE
-                    logclass = LOGCLASS_NOTIFICATION
-                    host_name, service_description, state, state_type, attempt, command_name = options.split(';', 5)
-                    state = service_states[state]
-                elif type == 'HOST EVENT HANDLER':
-                    logobject = LOGOBJECT_HOST
-                    logclass = LOGCLASS_NOTIFICATION
-                    host_name, state, state_type, attempt, command_name = options.split(';', 4)
-                    state = host_states[state]
-
-                elif type == 'EXTERNAL COMMAND':
-                    logobject = LOGOBJECT_INFO
-                    logclass = LOGCLASS_COMMAND
-
-                elif type == 'TIMEPERIOD TRANSITION':
-                    logobject = LOGOBJECT_INFO
-                    logclass = LOGCLASS_PROGRAM
-
-                elif type == 'INFO' or \
-                     type == 'WARNING' or \
-                     type == 'ERROR':
-                    logobject = LOGOBJECT_INFO
-                    logclass = LOGCLASS_PROGRAM
-
-                elif type.startswith('starting...') or \
-                     type.startswith('shutting down...') or \
-                     type.startswith('Bailing out') or \
-                     type.startswith('active mode...') or \
-                     type.startswith('standby mode...') or \
-                     type.startswith('Warning'):
-                    logobject = LOGOBJECT_INFO
-                    logclass = LOGCLASS_PROGRAM
-                else:
-                    logger.debug("[Livestatus Log Lines] Does not match")
-                    pass
-
-                Logline.id += 1
-                # self.lineno = Logline.id
-                setattr(self, 'logobject', int(logobject))
-                setattr(self, 'attempt', int(attempt))
-                setattr(self, 'logclass', int(logclass))
-                setattr(self, 'command_name', command_name)
-                setattr(self, 'comment', comment)
-                setattr(self, 'contact_name', contact_name)
-                setattr(self, 'host_name', host_name)
-                setattr(self, 'message', message)
-                setattr(self, 'options', '') # Fix a mismatch of number of fields with old databases and new ones
-                setattr(self, 'plugin_output', plugin_output)
-                setattr(self, 'service_description', service_description)
-                setattr(self, 'state', state)
-                setattr(self, 'state_type', state_type)
-                setattr(self, 'time', int(time))
-                setattr(self, 'type', type)
+            Logline.id += 1
+            # self.lineno = Logline.id
+            for col, value in parse_line(line).iteritems():
+                setattr(self, col, value)
 
 
     def as_tuple(self):
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This class is the metrics registry of the mongo-logs module.
+
+Counters and histograms are declared once and then updated with a dictionary operation,
+each thread updating its own counters that are summed when the metrics are collected, gauges are functions called when the metrics are collected. The metrics are exposed in
+the Prometheus text format by a small HTTP server thread.
+"""
+
+import bisect
+import threading
+import BaseHTTPServer
+
+from shinken.log import logger
+
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+
+    def __init__(self, prefix='mongo_logs'):
+        self.prefix = prefix
+        # name -> (type, help, label name)
+        self.declarations = {}
+        # Counters of each thread: (name, label value) -> value
+        self.threads_counters = []
+        self.local = threading.local()
+        # name -> Histogram
+        self.histograms = {}
+        # name -> function
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, label=None):
+        self.declarations[name] = ('counter', help, label)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self.declarations[name] = ('histogram', help, None)
+        self.histograms[name] = Histogram(buckets)
+
+    def gauge(self, name, help, function):
+        self.declarations[name] = ('gauge', help, None)
+        self.gauges[name] = function
+
+    def new_counters(self):
+        """
+        Get the counters of the calling thread
+        """
+        counters = self.local.counters = {}
+        with self.lock:
+            self.threads_counters.append(counters)
+        return counters
+
+    def inc(self, name, value=1, label=None):
+        try:
+            counters = self.local.counters
+        except AttributeError:
+            counters = self.new_counters()
+        key = (name, label)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    @property
+    def counters(self):
+        """
+        Get the counters of all the threads summed: (name, label value) -> value
+        """
+        with self.lock:
+            threads_counters = list(self.threads_counters)
+        result = {}
+        for counters in threads_counters:
+            for key, value in counters.items():
+                result[key] = result.get(key, 0) + value
+        return result
+
+    def get(self, name, label=None):
+        key = (name, label)
+        with self.lock:
+            threads_counters = list(self.threads_counters)
+        return sum(counters.get(key, 0) for counters in threads_counters)
+
+    def collect(self):
+        """
+        Get the current metrics values as a dictionary, histograms are summarized with their count and sum
+        """
+        result = {}
+        for (name, label), value in self.counters.items():
+            result[name if label is None else '%s{%s}' % (name, label)] = value
+        with self.lock:
+            for name, histogram in self.histograms.items():
+                result[name + '_count'] = histogram.count
+                result[name + '_sum'] = histogram.sum
+        for name, function in self.gauges.items():
+            try:
+                result[name] = function()
+            except Exception:
+                pass
+        return result
+
+    def render(self):
+        """
+        Get the metrics in the Prometheus text exposition format
+        """
+        counters = {}
+        for (name, label), value in self.counters.items():
+            counters.setdefault(name, []).append((label, value))
+
+        lines = []
+        for name in sorted(self.declarations):
+            kind, help, label_name = self.declarations[name]
+            full_name = '%s_%s' % (self.prefix, name)
+
+            if kind == 'gauge':
+                try:
+                    value = self.gauges[name]()
+                except Exception:
+                    continue
+                samples = [(full_name, value)]
+            elif kind == 'counter':
+                samples = []
+                for label, value in sorted(counters.get(name, [])):
+                    if label is None:
+                        samples.append((full_name, value))
+                    else:
+                        samples.append(('%s{%s="%s"}' % (full_name, label_name, str(label).replace('"', '\\"')), value))
+                if not samples and label_name is None:
+                    samples.append((full_name, 0))
+            else:
+                with self.lock:
+                    histogram = self.histograms[name]
+                    counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+                samples = []
+                cumulated = 0
+                for bound, bucket_count in zip(list(histogram.buckets) + ['+Inf'], counts):
+                    cumulated += bucket_count
+                    samples.append(('%s_bucket{le="%s"}' % (full_name, bound), cumulated))
+                samples.append(('%s_sum' % full_name, total))
+                samples.append(('%s_count' % full_name, count))
+
+            lines.append('# HELP %s %s' % (full_name, help))
+            lines.append('# TYPE %s %s' % (full_name, kind))
+            for sample, value in samples:
+                lines.append('%s %s' % (sample, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(threading.Thread):
+    """
+    A HTTP server thread exposing the metrics on /metrics
+    """
+
+    def __init__(self, metrics, host='127.0.0.1', port=9117):
+        threading.Thread.__init__(self, name='mongo-logs-metrics')
+        self.daemon = True
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ['/', '/metrics']:
+                    handler.send_error(404)
+                    return
+                body = metrics.render()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logger.debug("[mongo-logs] metrics request: %s", format % args)
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        logger.info("[mongo-logs] metrics available on http://%s:%d/metrics", host, port)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
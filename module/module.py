@@ -29,42 +29,34 @@ This class is for attaching a mongodb database to a broker module.
 It is one possibility for an exchangeable storage for log broks
 """
 
-import os
 import time
 import datetime
 import re
-import sys
-import pymongo
-import traceback
-
-from shinken.objects.service import Service
-from shinken.modulesctx import modulesctx
-
-# Import a class from the livestatus module, should be already loaded!
-# livestatus = modulesctx.get_module('livestatus')
-
-# LiveStatusStack = livestatus.LiveStatusStack
-# LOGCLASS_INVALID = livestatus.LOGCLASS_INVALID
-# Logline = livestatus.Logline
-from .log_line import (
-    Logline,
-    LOGCLASS_INVALID
+import threading
+import multiprocessing
+
+from .log_line import LoglineWrongFormat, parse_log_line
+from .writer import (
+    MongoLogsWriter,
+    OVERFLOW_POLICIES,
+    OVERFLOW_BLOCK,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_SPILL
+)
+from .filters import ServicesFilter, LogLinesFilter, REJECT_INVALID
+from .metrics import Metrics, MetricsServer
+from .sinks import create_sink
+from .mongo_sink import MongoSink, MongoLogsError, ObjectId, CONNECTED
+from .registry import ServicesRegistry
+from .availability import Day, new_record, record_check, close_record, percentages
+from .cache import ResultsCache
+from .spool import (
+    Spool,
+    FSYNC_POLICIES,
+    FSYNC_SEGMENT
 )
-
-
-try:
-    import pymongo
-    from pymongo import MongoClient
-    from pymongo.errors import AutoReconnect, ConnectionFailure
-except ImportError:
-    logger.error('[mongo-logs] Can not import pymongo and/or MongoClient'
-                 'Your pymongo lib is too old. '
-                 'Please install it with a 3.x+ version from '
-                 'https://pypi.python.org/pypi/pymongo')
-    MongoClient = None
 
 from shinken.basemodule import BaseModule
-from shinken.objects.module import Module
 from shinken.log import logger
 
 from collections import deque
@@ -84,33 +76,64 @@ def get_instance(plugin):
     return instance
 
 
-CONNECTED = 1
-DISCONNECTED = 2
-SWITCHING = 3
+# Minimum number of log lines parsed by a parsing pool worker
+PARSE_CHUNK_MIN = 500
 
+EMPTY_GROUPS = frozenset()
 
-class MongoLogsError(Exception):
-    pass
+# Check results broks, coalesced per item in the broks batches
+CHECK_RESULT_TYPES = frozenset(['host_check_result', 'service_check_result'])
 
 
-class MongoLogs(BaseModule):
+def get_check(data):
+    """
+    Get the check result brok fields used by the availability accounting:
+    (check time, state id, state change time, in scheduled downtime)
+    """
+    return int(data['last_chk']), data['state_id'], data.get('last_state_change'), bool(data['in_scheduled_downtime'])
 
-    def __init__(self, mod_conf):
-        BaseModule.__init__(self, mod_conf)
 
-        self.uri = getattr(mod_conf, 'uri', 'mongodb://localhost')
-        logger.info('[mongo-logs] mongo uri: %s', self.uri)
+def get_groups(groups):
+    """
+    Get the groups names of an host/service brok as a frozenset
+    """
+    if not groups:
+        return EMPTY_GROUPS
+    if isinstance(groups, basestring):
+        groups = groups.split(',')
+    return frozenset(g.strip() for g in groups)
+
+
+def prepare_log_line(line):
+    """
+    Parse a Shinken log line and return the document to store, or None if the line is invalid
+
+    The line was accepted by the log lines filter.
+    """
+    try:
+        values = parse_log_line(line)
+    except LoglineWrongFormat:
+        values = None
+    if values:
+        logger.debug('[mongo-logs] store log line values: %s', values)
+    else:
+        logger.debug("[mongo-logs] This line is invalid: %s", line)
+    return values
 
-        self.replica_set = getattr(mod_conf, 'replica_set', None)
-        if self.replica_set and int(pymongo.version[0]) < 3:
-            logger.error('[mongo-logs] Can not initialize module with '
-                         'replica_set because your pymongo lib is too old. '
-                         'Please install it with a 3.x+ version from '
-                         'https://pypi.python.org/pypi/pymongo')
-            return None
 
-        self.database = getattr(mod_conf, 'database', 'shinken')
-        logger.info('[mongo-logs] database: %s', self.database)
+def parse_log_lines(lines):
+    """
+    Parse a list of Shinken log lines and return the documents to store, in the same order
+
+    Also used by the parsing pool workers.
+    """
+    return [values for values in (prepare_log_line(line) for line in lines) if values]
+
+
+class MongoLogs(BaseModule):
+
+    def __init__(self, mod_conf):
+        BaseModule.__init__(self, mod_conf)
 
         self.commit_period = int(getattr(mod_conf, 'commit_period', '60'))
         logger.info('[mongo-logs] periodical commit period: %ds', self.commit_period)
@@ -118,14 +141,59 @@ class MongoLogs(BaseModule):
         self.commit_volume = int(getattr(mod_conf, 'commit_volume', '1000'))
         logger.info('[mongo-logs] periodical commit volume: %d lines', self.commit_volume)
 
-        self.db_test_period = int(getattr(mod_conf, 'db_test_period', '0'))
-        logger.info('[mongo-logs] periodical DB connection test period: %ds', self.db_test_period)
-
-        self.logs_collection = getattr(mod_conf, 'logs_collection', 'logs')
-        logger.info('[mongo-logs] logs collection: %s', self.logs_collection)
-
-        self.hav_collection = getattr(mod_conf, 'hav_collection', 'availability')
-        logger.info('[mongo-logs] hosts availability collection: %s', self.hav_collection)
+        self.commit_min_period = int(getattr(mod_conf, 'commit_min_period', '1'))
+        logger.info('[mongo-logs] minimum commit period: %ds', self.commit_min_period)
+
+        self.commit_time_budget = float(getattr(mod_conf, 'commit_time_budget', '1'))
+        logger.info('[mongo-logs] commit time budget: %.2fs', self.commit_time_budget)
+
+        self.parse_workers = int(getattr(mod_conf, 'parse_workers', '0'))
+        logger.info('[mongo-logs] log lines parsing workers: %d', self.parse_workers)
+
+        # Delay before retrying a failed batch, doubled after each failure up to the maximum delay
+        self.retry_min_delay = int(getattr(mod_conf, 'retry_min_delay', '1'))
+        self.retry_max_delay = int(getattr(mod_conf, 'retry_max_delay', '60'))
+        logger.info('[mongo-logs] retry delay: %ds to %ds', self.retry_min_delay, self.retry_max_delay)
+
+        self.writer_queue_size = int(getattr(mod_conf, 'writer_queue_size', '100'))
+        logger.info('[mongo-logs] writer queue size: %d batches', self.writer_queue_size)
+
+        self.writer_overflow = getattr(mod_conf, 'writer_overflow', OVERFLOW_BLOCK)
+        if self.writer_overflow not in OVERFLOW_POLICIES:
+            logger.error('[mongo-logs] Wrong value for writer_overflow. Must be one of %s and not %s', OVERFLOW_POLICIES, self.writer_overflow)
+            self.writer_overflow = OVERFLOW_BLOCK
+        logger.info('[mongo-logs] writer queue overflow policy: %s', self.writer_overflow)
+
+        self.spool_dir = getattr(mod_conf, 'spool_dir', '/var/lib/shinken/mongo-logs')
+        self.spool_threshold = int(getattr(mod_conf, 'spool_threshold', '100000'))
+        self.spool_segment_size = int(getattr(mod_conf, 'spool_segment_size', '16'))
+        self.spool_max_size = int(getattr(mod_conf, 'spool_max_size', '1024'))
+        self.spool_fsync = getattr(mod_conf, 'spool_fsync', FSYNC_SEGMENT)
+        if self.spool_fsync not in FSYNC_POLICIES:
+            logger.error('[mongo-logs] Wrong value for spool_fsync. Must be one of %s and not %s', FSYNC_POLICIES, self.spool_fsync)
+            self.spool_fsync = FSYNC_SEGMENT
+        self.spool_replay_rate = int(getattr(mod_conf, 'spool_replay_rate', '0'))
+        if self.writer_overflow == OVERFLOW_SPILL:
+            logger.info('[mongo-logs] spool directory: %s, max size: %dMB, segment size: %dMB, fsync: %s',
+                        self.spool_dir, self.spool_max_size, self.spool_segment_size, self.spool_fsync)
+            logger.info('[mongo-logs] spool threshold: %d lines, replay rate: %d documents/s',
+                        self.spool_threshold, self.spool_replay_rate)
+
+        self.availability_commit_period = int(getattr(mod_conf, 'availability_commit_period', '60'))
+        logger.info('[mongo-logs] periodical availability commit period: %ds', self.availability_commit_period)
+
+        self.availability_commit_volume = int(getattr(mod_conf, 'availability_commit_volume', '1000'))
+        logger.info('[mongo-logs] availability commit volume: %d records', self.availability_commit_volume)
+
+        # Availability reports cache: number of reports and time to live
+        self.availability_cache_size = int(getattr(mod_conf, 'availability_cache_size', '100'))
+        self.availability_cache_ttl = int(getattr(mod_conf, 'availability_cache_ttl', '300'))
+        logger.info('[mongo-logs] availability reports cache: %d reports, %ds', self.availability_cache_size, self.availability_cache_ttl)
+        self.availability_reports = ResultsCache(self.availability_cache_size, self.availability_cache_ttl)
+
+        # The check results of an item are accounted together, once per broks batch or once per window
+        self.availability_coalesce_window = float(getattr(mod_conf, 'availability_coalesce_window', '0'))
+        logger.info('[mongo-logs] availability check results coalescing window: %.1fs', self.availability_coalesce_window)
 
         max_logs_age = getattr(mod_conf, 'max_logs_age', '365')
         maxmatch = re.match(r'^(\d+)([dwmy]*)$', max_logs_age)
@@ -145,287 +213,649 @@ class MongoLogs(BaseModule):
                 self.max_logs_age = int(maxmatch.group(1)) * 365
         logger.info('[mongo-logs] max_logs_age: %s', self.max_logs_age)
 
-        self.services_cache = {}
+        self.metrics = Metrics()
+        self.declare_metrics()
+
+        # MongoDB storage, the target of the primary writer
+        self.storage = MongoSink(mod_conf, self.metrics, self.max_logs_age, self.availability_loaded)
+        self.logs_stats = self.storage.logs_stats
+        # (hour, day, host_name, service_description, logclass, type, state) -> count
+        self.logs_stats_cache = {}
+        # Current local day: (start, end) timestamps
+        self.logs_stats_day = (0, 0)
+
+        # Registered hosts/services which availability is recorded
+        self.services_cache = ServicesRegistry()
         services_filter = getattr(mod_conf, 'services_filter', '')
         logger.info('[mongo-logs] services filtering: %s', services_filter)
+        self.services_filter = ServicesFilter(services_filter)
+
+        # Log lines filtering, by type or logclass
+        logs_include = getattr(mod_conf, 'logs_include', '')
+        logs_exclude = getattr(mod_conf, 'logs_exclude', '')
+        logger.info('[mongo-logs] log lines filtering, include: %s, exclude: %s', logs_include, logs_exclude)
+        self.logs_filter = LogLinesFilter(logs_include, logs_exclude)
+
+        # Metrics HTTP endpoint, disabled if port is 0
+        self.metrics_host = getattr(mod_conf, 'metrics_host', '127.0.0.1')
+        self.metrics_port = int(getattr(mod_conf, 'metrics_port', '0'))
+        logger.info('[mongo-logs] metrics endpoint: %s:%d', self.metrics_host, self.metrics_port)
+        self.metrics_server = None
+        # Secondary storage sinks, each one has its own writer
+        sinks = getattr(mod_conf, 'sinks', '')
+        logger.info('[mongo-logs] secondary sinks: %s', sinks)
+        self.sinks = []
+        for name in sinks.split(','):
+            name = name.strip()
+            if name:
+                sink = create_sink(name, mod_conf, self.max_logs_age)
+                if sink is not None:
+                    self.sinks.append(sink)
+        self.sink_queue_size = int(getattr(mod_conf, 'sink_queue_size', '100'))
+        self.sink_writers = []
+
+        # Background writer and log lines parsing pool, started in the main function
+        self.writer = None
+        self.parse_pool = None
 
-        self.filter_service_description = None
-        self.filter_service_criticality = None
-        if services_filter:
-            # Decode services filter
-            services_filter = [s for s in services_filter.split(',')]
-            for rule in services_filter:
-                rule = rule.strip()
-                if not rule:
-                    continue
-                logger.info('[mongo-logs] services filtering rule: %s', rule)
-                elts = rule.split(':', 1)
+        self.logs_cache = deque()
 
-                t = 'service_description'
-                if len(elts) > 1:
-                    t = elts[0].lower()
-                    s = elts[1].lower()
+        # Today's availability records are loaded from the DB and then updated in place,
+        # each registered item holds its own record
+        self.availability_day = None
+        # Day which records are loaded, the check results are held until then
+        self.availability_loaded_day = None
+        self.availability_lock = threading.Lock()
+        # Items which record was modified since the last availability commit
+        self.availability_cache_backlog = set()
+        # Records copies which could not be sent to the writer: (hostname, service, day) -> record
+        self.availability_unsent = {}
+        self.availability_load_pending = False
+        # Check results not yet accounted: item -> list of checks (see get_check), in brok order
+        self.pending_checks = {}
+        self.next_checks_flush = 0
+
+        # Broks types managed by the module, the other broks are not deserialized
+        self.handled_brok_types = frozenset(match.group(1) for match in
+                                            (re.match(r'^manage_(\w+)_brok$', name) for name in dir(self)) if match)
+
+    def declare_metrics(self):
+        m = self.metrics
+        m.counter('broks_total', 'Managed broks', label='type')
+        m.counter('log_lines_queued_total', 'Log lines queued for commit')
+        m.counter('log_lines_rejected_total', 'Log lines not stored', label='reason')
+        m.counter('log_lines_spilled_total', 'Log lines spilled to the spool by the commit')
+        m.counter('log_lines_inserted_total', 'Log lines inserted in the DB')
+        m.counter('log_lines_dropped_total', 'Log lines which insertion failed and was not retried')
+        m.counter('availability_records_stored_total', 'Availability records stored in the DB')
+        m.counter('availability_reports_total', 'Availability reports requests', label='cache')
+        m.counter('check_results_coalesced_total', 'Check results accounted with a previous check result of the same item')
+        m.counter('logs_stats_updated_total', 'Logs statistics counters updated in the DB')
+        m.counter('db_connections_total', 'Successful DB connections')
+        m.counter('db_connection_errors_total', 'DB connection errors', label='operation')
+        m.counter('db_failovers_total', 'Primary server losses')
+        m.counter('log_lines_duplicates_total', 'Retried log lines which were already inserted')
+        m.histogram('broks_batch_seconds', 'Time to manage a batch of broks')
+        m.histogram('logs_insert_seconds', 'Time to insert a batch of logs')
+        m.histogram('availability_upsert_seconds', 'Time to store a batch of availability records')
+        m.histogram('logs_rotation_seconds', 'Time to rotate the logs')
+        m.gauge('logs_cache_depth', 'Log lines waiting for commit', lambda: len(self.logs_cache))
+        m.gauge('availability_backlog_depth', 'Availability records waiting for commit', lambda: len(self.availability_cache_backlog))
+        m.gauge('registered_items', 'Hosts/services which availability is recorded', lambda: len(self.services_cache))
+        m.gauge('broks_queue_depth', 'Broks batches waiting in the module queue', lambda: self.to_q.qsize())
+
+    def declare_writer_metrics(self):
+        """
+        Writers statistics are exposed as gauges
+        """
+        writers = [('writer_', self.writer)]
+        writers.extend(('sink_%s_' % writer.module.name, writer) for writer in self.sink_writers)
+        for prefix, writer in writers:
+            for name in writer.stats():
+                self.metrics.gauge(prefix + name, '%s %s' % (writer.name, name.replace('_', ' ')),
+                                   (lambda writer, name: lambda: writer.stats()[name])(writer, name))
+
+    def submit(self, operation, payload, spill=False, timeout=0):
+        """
+        Send a batch to the storage writer and to the secondary sinks writers
 
-                if t == 'service_description':
-                    self.filter_service_description = rule
-                    logger.info('[mongo-logs] services will be filtered by description: %s', self.filter_service_description)
+        The sinks get a copy of the documents, the storage writer modifies them. Returns False if
+        the storage writer queue is full: the batch is not sent, it is to be submitted again later.
+        While the DB is not available (connection lost, primary election), the queue is not waited for.
+        """
+        if self.storage.is_connected != CONNECTED:
+            timeout = 0
+        copies = [(writer, [dict(doc) for doc in payload]) for writer in self.sink_writers
+                  if operation in writer.module.operations]
+        if spill:
+            self.writer.spill((operation, payload))
+        elif not self.writer.submit(operation, payload, timeout):
+            return False
+        for writer, documents in copies:
+            writer.submit(operation, documents)
+        return True
 
-                if t == 'bp' or t == 'bi':
-                    self.filter_service_criticality = s
-                    logger.info('[mongo-logs] services will be filtered by criticality: %s', self.filter_service_criticality)
+    def load(self, app):
+        self.app = app
 
+    def init(self):
+        return True
 
-        # Elasticsearch configuration part ... prepare next version !
-        # self.elasticsearch_uri = getattr(mod_conf, 'elasticsearch_uri', None)
-        # if self.elasticsearch_uri:
-            # try:
-                # import rawes
-                # from rawes.elastic_exception import ElasticException
-            # except ImportError:
-                # logger.error('[mongo-logs] Can not import rawes library. Data will not be sent to your configured ElasticSearch: %s', self.elasticsearch_uri)
-                # self.elasticsearch_uri = None
-            # else:
-                # logger.info('[mongo-logs] data will be sent to ElasticSearch: %s', self.elasticsearch_uri)
+    def commit(self):
+        pass
 
+    def commit_logs(self, budget=None):
+        """
+        Peridically called (commit_period), this method prepares the queued logs in bunches of commit_volume lines to insert them in the DB
 
-        self.is_connected = DISCONNECTED
+        All the queued logs are prepared, unless it takes more than the time budget, commit_time_budget seconds by
+        default. The writer queue is waited for at most the remaining budget, the lines which could not be queued
+        are kept in the logs cache for the next commit.
+        The documents ids are assigned here, a batch retried after a failover is not inserted twice.
+        Returns the number of queued logs when the commit started.
+        """
+        backlog = len(self.logs_cache)
+        if not backlog:
+            return 0
 
-        self.next_logs_rotation = time.time() + 5000
+        logger.debug("[mongo-logs] commiting ...")
 
-        self.logs_cache = deque()
+        logger.debug("[mongo-logs] %d lines to insert in database (insertion by %d lines)", backlog, self.commit_volume)
 
-        self.availability_cache = {}
-        self.availability_cache_backlog = []
+        now = time.time()
+        deadline = now + (self.commit_time_budget if budget is None else budget)
+        while self.logs_cache:
+            some_logs = [self.logs_cache.popleft() for _ in xrange(min(self.commit_volume, len(self.logs_cache)))]
+            for values in some_logs:
+                values['_id'] = ObjectId()
+            if not self.submit('logs', some_logs, timeout=max(0, deadline - time.time())):
+                self.logs_cache.extendleft(reversed(some_logs))
+                logger.warning("[mongo-logs] commit time budget exceeded, writer queue is full, %d lines still to commit",
+                               len(self.logs_cache))
+                break
+            if time.time() > deadline:
+                logger.warning("[mongo-logs] commit time budget exceeded, %d lines still to commit", len(self.logs_cache))
+                break
+        logger.debug("[mongo-logs] time to prepare %s logs for commit (%2.4f)", backlog - len(self.logs_cache), time.time() - now)
+        logger.debug("[mongo-logs] writer: %s", self.writer.stats())
+
+        # Too many lines waiting in memory, move them to the spool
+        if self.writer_overflow == OVERFLOW_SPILL and len(self.logs_cache) > self.spool_threshold:
+            logger.warning("[mongo-logs] %d lines waiting for commit, spilling them to the spool", len(self.logs_cache))
+            while self.logs_cache:
+                some_logs = [self.logs_cache.popleft() for _ in xrange(min(self.commit_volume, len(self.logs_cache)))]
+                for values in some_logs:
+                    values['_id'] = ObjectId()
+                self.submit('logs', some_logs, spill=True)
+                self.metrics.inc('log_lines_spilled_total', len(some_logs))
+
+        return backlog
+
+    def get_commit_period(self, backlog):
+        """
+        Get the delay before the next logs commit
 
-    def load(self, app):
-        self.app = app
+        When more than commit_volume lines were queued during the last period, the period is
+        shortened so that a commit happens about every commit_volume lines.
+        """
+        if self.logs_cache:
+            return self.commit_min_period
+        if backlog <= self.commit_volume:
+            return self.commit_period
+        return max(self.commit_min_period, self.commit_period * self.commit_volume / backlog)
 
-    def init(self):
-        return True
+    def get_day_start(self, timestamp):
+        """
+        Get the timestamp of the local midnight of a timestamp day, the current day is cached
+        """
+        start, end = self.logs_stats_day
+        if start <= timestamp < end:
+            return start
+        day = datetime.date.fromtimestamp(timestamp)
+        start = int(time.mktime(day.timetuple()))
+        end = int(time.mktime((day + datetime.timedelta(days=1)).timetuple()))
+        self.logs_stats_day = (start, end)
+        return start
+
+    def count_logs(self, some_logs):
+        """
+        Count the queued log lines in the hourly/daily logs statistics
+        """
+        cache = self.logs_stats_cache
+        for values in some_logs:
+            t = int(values['time'])
+            key = (t - t % 3600, self.get_day_start(t), values['host_name'], values['service_description'],
+                   values['logclass'], values['type'], values['state'])
+            cache[key] = cache.get(key, 0) + 1
+
+    def commit_logs_stats(self, timeout=0):
+        """
+        Periodically called with the logs commit, this method prepares the counted logs statistics to increment them in the DB
 
-    def open(self):
+        When the writer queue is still full after timeout seconds, the statistics are kept for the next commit.
         """
-        Connect to the Mongo DB with configured URI.
+        if not self.logs_stats_cache:
+            return
 
-        Execute a command to check if connected on master to activate immediate connection to
-        the DB because we need to know if DB server is available.
+        counters = {}
+        for (hour, day, host_name, service_description, logclass, type, state), count in self.logs_stats_cache.iteritems():
+            for period, start in (('hour', hour), ('day', day)):
+                key = (period, start, host_name, service_description, logclass, type, state)
+                counters[key] = counters.get(key, 0) + count
+
+        some_stats = []
+        for (period, start, host_name, service_description, logclass, type, state), count in counters.iteritems():
+            some_stats.append({
+                'period': period, 'time': start, 'host_name': host_name, 'service_description': service_description,
+                'logclass': logclass, 'type': type, 'state': state, 'count': count
+            })
+        logger.debug("[mongo-logs] %d logs statistics to update in database", len(some_stats))
+        if self.submit('logs_stats', some_stats, timeout=timeout):
+            self.logs_stats_cache = {}
+        else:
+            logger.warning("[mongo-logs] writer queue is full, %d logs statistics still to commit", len(some_stats))
 
-        Update log rotation time to force a log rotation
+    def load_availability(self):
+        """
+        Set the current day for the availability records and request the writer to load
+        the records of this day from the DB into the availability cache.
         """
-        self.con = MongoClient(self.uri, connect=False)
-        logger.info("[mongo-logs] trying to connect MongoDB: %s", self.uri)
-        try:
-            result = self.con.admin.command("ismaster")
-            logger.info("[mongo-logs] connected to MongoDB, admin: %s", result)
-            logger.debug("[mongo-logs] server information: %s", self.con.server_info())
+        self.availability_day = Day.today()
+        self.submit_availability_load()
 
-            self.db = getattr(self.con, self.database)
-            logger.info("[mongo-logs] connected to the database: %s (%s)", self.database, self.db)
+    def submit_availability_load(self):
+        """
+        Request the writer to load the current day availability records, the request is submitted
+        again by the main loop while the writer queue is full
+        """
+        self.availability_load_pending = not self.writer.submit('availability_load', self.availability_day.date)
 
-            self.is_connected = CONNECTED
-            self.next_logs_rotation = time.time()
+    def availability_loaded(self, day, records):
+        """
+        Called by the storage writer thread, this method loads a day availability records into
+        the availability cache.
 
-            logger.info('[mongo-logs] database connection established')
-        except ConnectionFailure as e:
-            logger.error("[mongo-logs] Server is not available: %s", str(e))
-            return False
-        except Exception as e:
-            logger.error("[mongo-logs] Could not open the database", str(e))
-            raise MongoLogsError
+        Records that are already cached are more recent than the stored ones and are kept.
+        """
+        with self.availability_lock:
+            if day != self.availability_day.date:
+                return
+            self.services_cache.clear_loaded()
+            self.services_cache.load_availability(records)
+            # The held check results may now be accounted
+            self.availability_loaded_day = day
 
-        return True
+    def rollover_availability(self):
+        """
+        Close the availability records of the ending day, store them and start the new day
+        """
+        day = self.availability_day
+        closed = 0
+        for item in self.services_cache.items.itervalues():
+            data = item.availability
+            if data is not None and data['day'] == day.name:
+                close_record(data, day)
+                self.availability_cache_backlog.add(item)
+                closed += 1
+        logger.info("[mongo-logs] availability day %s ended, %d records closed", day, closed)
+
+        self.commit_availability()
+        self.load_availability()
+
+    def commit_availability(self, timeout=0):
+        """
+        Periodically called (availability_commit_period), this method prepares the modified availability records to store them in the DB
 
-    def close(self):
-        self.is_connected = DISCONNECTED
-        self.con.close()
-        logger.info('[mongo-logs] database connection closed')
+        When the writer queue is still full after timeout seconds, the records are kept for the next commit.
+        """
+        if not self.availability_cache_backlog and not self.availability_unsent:
+            return
 
-    def commit(self):
-        pass
+        logger.debug("[mongo-logs] %d availability records to update in database", len(self.availability_cache_backlog))
+
+        # Records are still updated in place, the writer gets a copy of them. The copies which could
+        # not be sent are sent with the next commit, unless they are replaced by a newer copy.
+        unsent = self.availability_unsent
+        for item in self.availability_cache_backlog:
+            data = item.availability
+            unsent[(data['hostname'], data['service'], data['day'])] = dict(data)
+        self.availability_cache_backlog.clear()
+        if self.submit('availability', unsent.values(), timeout=timeout):
+            self.availability_unsent = {}
+        else:
+            logger.warning("[mongo-logs] writer queue is full, %d availability records still to commit", len(unsent))
 
-    def rotate_logs(self):
+    def find_logs_pages(self, criteria=None, start=None, end=None, fields=None, descending=False,
+                        batch_size=1000, after=None):
         """
-        For a Mongo DB there is no rotate, but we will delete logs older than configured maximum age.
+        Generator of the pages of log lines matching criteria in a time range, in time order,
+        see MongoSink.find_logs_pages
         """
-        if not self.is_connected == CONNECTED:
-            if not self.open():
-                self.next_logs_rotation = time.time() + 600
-                logger.info("[mongo-logs] log rotation failed, next log rotation at %s " % time.asctime(time.localtime(self.next_logs_rotation)))
-                return
+        return self.storage.find_logs_pages(criteria, start, end, fields, descending, batch_size, after)
 
-        logger.info("[mongo-logs] rotating logs ...")
+    def find_logs(self, criteria=None, start=None, end=None, fields=None, descending=False, batch_size=1000):
+        """
+        Generator of the log lines matching criteria in a time range, in time order, see find_logs_pages
+        """
+        for logs, marker in self.find_logs_pages(criteria, start, end, fields, descending, batch_size):
+            for doc in logs:
+                yield doc
 
-        now = time.time()
-        today = datetime.date.today()
-        today0000 = datetime.datetime(today.year, today.month, today.day, 0, 0, 0)
-        today0005 = datetime.datetime(today.year, today.month, today.day, 0, 5, 0)
-        oldest = today0000 - datetime.timedelta(days=self.max_logs_age)
-        result = self.db[self.logs_collection].delete_many({u'time': {'$lt': time.mktime(oldest.timetuple())}})
-        logger.info("[mongo-logs] removed %d logs older than %s days.", result.deleted_count, self.max_logs_age)
-
-        if now < time.mktime(today0005.timetuple()):
-            next_rotation = today0005
-        else:
-            next_rotation = today0005 + datetime.timedelta(days=1)
+    def get_logs_page(self, criteria=None, start=None, end=None, fields=None, descending=False, limit=100, after=None):
+        """
+        Get a page of log lines and the marker of the next page: (logs, after)
 
-        # See you tomorrow
-        self.next_logs_rotation = time.mktime(next_rotation.timetuple())
-        logger.info("[mongo-logs] next log rotation at %s " % time.asctime(time.localtime(self.next_logs_rotation)))
+        The page is empty when there are no more log lines.
+        """
+        for logs, marker in self.find_logs_pages(criteria, start, end, fields, descending, limit, after):
+            return logs, marker
+        return [], after
 
-    def commit_logs(self):
+    def get_history(self, host_name, service_description=None, start=None, end=None, **kwargs):
         """
-        Peridically called (commit_period), this method prepares a bunch of queued logs (commit_colume) to insert them in the DB
+        Generator of the log lines of an host and its services, or of a service if service_description
+        is not None ('' for the host only lines)
         """
-        if not self.logs_cache:
-            return
+        criteria = {'host_name': host_name}
+        if service_description is not None:
+            criteria['service_description'] = service_description
+        return self.find_logs(criteria, start, end, **kwargs)
 
-        if not self.is_connected == CONNECTED:
-            if not self.open():
-                logger.warning("[mongo-logs] log commiting failed")
-                logger.warning("[mongo-logs] %d lines to insert in database", len(self.logs_cache))
-                return
+    def get_logs_by_class(self, logclass, start=None, end=None, types=None, **kwargs):
+        """
+        Generator of the log lines of a logclass (or a list of logclasses) in a time range, optionally
+        of some log lines types only
+        """
+        criteria = {'logclass': {'$in': list(logclass)} if isinstance(logclass, (list, tuple, set)) else logclass}
+        if types:
+            criteria['type'] = {'$in': list(types)}
+        return self.find_logs(criteria, start, end, **kwargs)
 
-        logger.debug("[mongo-logs] commiting ...")
+    def find_availability(self, start_day, end_day, hostname=None, service=None, batch_size=1000):
+        """
+        Generator of the daily availability records from start_day to end_day (included),
+        see MongoSink.find_availability
+        """
+        return self.storage.find_availability(start_day, end_day, hostname, service, batch_size)
 
-        logger.debug("[mongo-logs] %d lines to insert in database (max insertion is %d lines)", len(self.logs_cache), self.commit_volume)
+    def get_availability_report(self, start_day, end_day, items=None, groups=None):
+        """
+        Get the availability of hosts/services from start_day to end_day (included), summed by the DB
 
-        # Flush all the stored log lines
-        logs_to_commit = 1
-        now = time.time()
-        some_logs = []
-        while True:
-            try:
-                # result = self.db[self.logs_collection].insert_one(self.logs_cache.popleft())
-                some_logs.append(self.logs_cache.popleft())
-                logs_to_commit = logs_to_commit + 1
-                if logs_to_commit >= self.commit_volume:
-                    break
-            except IndexError:
-                logger.debug("[mongo-logs] prepared all available logs for commit")
-                break
-            except Exception, exp:
-                logger.error("[mongo-logs] exception: %s", str(exp))
-        logger.debug("[mongo-logs] time to prepare %s logs for commit (%2.4f)", logs_to_commit, time.time() - now)
+        - items: list of (hostname, service) tuples, service is '' for an host, default is all the items
+        - groups: dictionary of group name -> list of (hostname, service) tuples
+
+        Returns a dictionary:
+        - items: list of the items availability sorted by hostname and service: hostname, service, days
+          (number of daily records), daily_0 to daily_4 (seconds in each state), percent_0 to percent_4
+        - groups: dictionary of group name -> group availability: items (number of items), days,
+          daily_0 to daily_4, percent_0 to percent_4
+
+        The reports are cached, the same report requested again is not computed until it expires. The
+        returned report is shared and must not be modified.
+        """
+        if not isinstance(start_day, basestring):
+            start_day = start_day.strftime('%Y-%m-%d')
+        if not isinstance(end_day, basestring):
+            end_day = end_day.strftime('%Y-%m-%d')
+        items = frozenset(items) if items is not None else None
+        groups = dict((name, frozenset(members)) for name, members in groups.iteritems()) if groups else {}
+
+        key = (start_day, end_day, items, tuple(sorted(groups.iteritems())))
+        report = self.availability_reports.get(key)
+        if report is not None:
+            self.metrics.inc('availability_reports_total', 1, 'hit')
+            return report
+        self.metrics.inc('availability_reports_total', 1, 'miss')
+
+        hostnames = services = None
+        if items is not None:
+            # The hosts and services are matched separately, the other items are ignored below
+            hostnames = sorted(set(hostname for hostname, service in items))
+            services = sorted(set(service for hostname, service in items))
 
         now = time.time()
-        try:
-            # Insert lines to commit
-            result = self.db[self.logs_collection].insert_many(some_logs)
-            logger.debug("[mongo-logs] inserted %d logs.", len(result.inserted_ids))
-
-            # Request the server to flush data on files
-            self.con.fsync(async=True)
-        except AutoReconnect, exp:
-            logger.error("[mongo-logs] Autoreconnect exception when inserting lines: %s", str(exp))
-            self.is_connected = SWITCHING
-            # Abort commit ... will be finished next time!
-        except Exception, exp:
-            self.close()
-            logger.error("[mongo-logs] Database error occurred when commiting: %s", exp)
-        logger.debug("[mongo-logs] time to insert %s logs (%2.4f)", logs_to_commit, time.time() - now)
+        results = {}
+        for data in self.storage.sum_availability(start_day, end_day, hostnames, services):
+            if items is None or (data['hostname'], data['service']) in items:
+                results[(data['hostname'], data['service'])] = percentages(data)
+
+        report = {'items': [results[item] for item in sorted(results)], 'groups': {}}
+        for name, members in groups.iteritems():
+            data = {'items': 0, 'days': 0, 'daily_0': 0, 'daily_1': 0, 'daily_2': 0, 'daily_3': 0, 'daily_4': 0}
+            for item in members:
+                item_data = results.get(item)
+                if item_data is None:
+                    continue
+                data['items'] += 1
+                for field in ('days', 'daily_0', 'daily_1', 'daily_2', 'daily_3', 'daily_4'):
+                    data[field] += item_data[field]
+            report['groups'][name] = percentages(data)
+        logger.debug("[mongo-logs] availability report from %s to %s, %d items (%2.4f)",
+                     start_day, end_day, len(results), time.time() - now)
+
+        self.availability_reports.set(key, report)
+        return report
 
     def manage_brok(self, brok):
         """
         Overloaded parent class manage_brok method:
         - select which broks management functions are to be called
         """
+        self.metrics.inc('broks_total', 1, brok.type)
         manage = getattr(self, 'manage_' + brok.type + '_brok', None)
         if manage:
             return manage(brok)
 
     def manage_initial_host_status_brok(self, brok):
-        start = time.clock()
         host_name = brok.data['host_name']
-        service_description = ''
-        service_id = host_name+"/"+service_description
         logger.debug("[mongo-logs] initial host status received: %s (bi=%d)", host_name, int (brok.data["business_impact"]))
 
-        self.services_cache[service_id] = { "hostname": host_name, "service": service_description }
-        logger.info("[mongo-logs] host registered: %s (bi=%d)", service_id, brok.data["business_impact"])
+        # The writer thread may be loading the availability records into the registry
+        with self.availability_lock:
+            self.services_cache.register(host_name, '', get_groups(brok.data.get('hostgroups')))
+        logger.info("[mongo-logs] host registered: %s/ (bi=%d)", host_name, brok.data["business_impact"])
 
     def manage_host_check_result_brok(self, brok):
-        start = time.clock()
-        host_name = brok.data['host_name']
-        service_description = ''
-        service_id = host_name+"/"+service_description
-        logger.debug("[mongo-logs] host check result received: %s", service_id)
-
-        if self.services_cache and service_id in self.services_cache:
-            self.record_availability(host_name, service_description, brok)
-            logger.debug("[mongo-logs] host check result: %s, %.2gs", service_id, time.clock() - start)
+        self.queue_check(brok)
+        if not self.availability_coalesce_window:
+            self.record_pending_checks()
 
     def manage_initial_service_status_brok(self, brok):
-        start = time.clock()
         host_name = brok.data['host_name']
         service_description = brok.data['service_description']
-        service_id = host_name+"/"+service_description
         logger.debug("[mongo-logs] initial service status received: %s (bi=%d)", host_name, int (brok.data["business_impact"]))
 
-        # Filter service if needed: reference service in services cache ...
-        # ... if description filter matches ...
-        if self.filter_service_description:
-            pat = re.compile(self.filter_service_description, re.IGNORECASE)
-            if pat.search(service_id):
-                self.services_cache[service_id] = { "hostname": host_name, "service": service_description }
-                logger.info("[mongo-logs] service description filter matches for: %s (bi=%d)", service_id, brok.data["business_impact"])
-
-        # ... or if criticality filter matches.
-        if self.filter_service_criticality:
-            include = False
-            bi = int (brok.data["business_impact"])
-            if self.filter_service_criticality.startswith('>='):
-                if bi >= int(self.filter_service_criticality[2:]):
-                    include = True
-            elif self.filter_service_criticality.startswith('<='):
-                if bi <= int(self.filter_service_criticality[2:]):
-                    include = True
-            elif self.filter_service_criticality.startswith('>'):
-                if bi > int(self.filter_service_criticality[1:]):
-                    include = True
-            elif self.filter_service_criticality.startswith('<'):
-                if bi < int(self.filter_service_criticality[1:]):
-                    include = True
-            elif self.filter_service_criticality.startswith('='):
-                if bi == int(self.filter_service_criticality[1:]):
-                    include = True
-            if include:
-                self.services_cache[service_id] = { "hostname": host_name, "service": service_description }
-                logger.info("[mongo-logs] criticality filter matches for: %s (bi=%d)", service_id, brok.data["business_impact"])
+        # Filter service if needed: reference service in services cache if filter matches
+        if not self.services_filter:
+            return
 
-    def manage_service_check_result_brok(self, brok):
-        start = time.clock()
-        host_name = brok.data['host_name']
-        service_description = brok.data['service_description']
         service_id = host_name+"/"+service_description
-        logger.debug("[mongo-logs] service check result received: %s", service_id)
+        bi = int(brok.data["business_impact"])
+        host = self.services_cache.get(host_name)
+        hostgroups = host.groups if host is not None and host.groups else EMPTY_GROUPS
+        servicegroups = get_groups(brok.data.get('servicegroups'))
+        if self.services_filter.match(service_id, bi, hostgroups, servicegroups):
+            with self.availability_lock:
+                self.services_cache.register(host_name, service_description)
+            logger.info("[mongo-logs] services filter matches for: %s (bi=%d)", service_id, bi)
 
-        if self.services_cache and service_id in self.services_cache:
-            self.record_availability(host_name, service_description, brok)
-            logger.debug("[mongo-logs] service check result: %s, %.2gs", service_id, time.clock() - start)
+    def manage_service_check_result_brok(self, brok):
+        self.queue_check(brok)
+        if not self.availability_coalesce_window:
+            self.record_pending_checks()
 
     def manage_log_brok(self, brok):
         """
         Parse a Shinken log brok to enqueue a log line for DB insertion
         """
         line = brok.data['log']
-        if re.match("^\[[0-9]*\] [A-Z][a-z]*.:", line):
-            # Match log which NOT have to be stored
-            logger.warning('[mongo-logs] do not store: %s', line)
+        reason = self.logs_filter.check(line)
+        if reason:
+            self.metrics.inc('log_lines_rejected_total', 1, reason)
             return
 
-        logline = Logline(line=line)
-        values = logline.as_dict()
-        if logline.logclass != LOGCLASS_INVALID:
-            logger.debug('[mongo-logs] store log line values: %s', values)
+        values = prepare_log_line(line)
+        if values:
             self.logs_cache.append(values)
+            self.metrics.inc('log_lines_queued_total')
+            if self.logs_stats:
+                self.count_logs((values,))
         else:
-            logger.info("[mongo-logs] This line is invalid: %s", line)
+            self.metrics.inc('log_lines_rejected_total', 1, REJECT_INVALID)
 
         return
 
-    def record_availability(self, hostname, service, b):
+    def manage_log_lines(self, lines):
         """
-        Parse a Shinken check brok to compute availability and store a daily availability record in the DB
+        Parse a list of Shinken log lines to enqueue them for DB insertion
+
+        The lines are split in chunks parsed by the parsing pool workers. The log lines are
+        enqueued in the same order as they were received.
+        """
+        self.metrics.inc('broks_total', len(lines), 'log')
+        check = self.logs_filter.check
+        accepted = []
+        for line in lines:
+            reason = check(line)
+            if reason:
+                self.metrics.inc('log_lines_rejected_total', 1, reason)
+            else:
+                accepted.append(line)
+        lines = accepted
+
+        if len(lines) < 2 * PARSE_CHUNK_MIN:
+            parsed = [parse_log_lines(lines)]
+        else:
+            chunk = max(PARSE_CHUNK_MIN, len(lines) / self.parse_workers + 1)
+            chunks = [lines[i:i + chunk] for i in xrange(0, len(lines), chunk)]
+            try:
+                parsed = self.parse_pool.map(parse_log_lines, chunks)
+            except Exception, exp:
+                logger.error("[mongo-logs] parsing pool exception: %s, parsing %d lines inline", str(exp), len(lines))
+                parsed = [parse_log_lines(lines)]
+
+        queued = 0
+        for some_logs in parsed:
+            self.logs_cache.extend(some_logs)
+            if self.logs_stats:
+                self.count_logs(some_logs)
+            queued += len(some_logs)
+        self.metrics.inc('log_lines_queued_total', queued)
+        self.metrics.inc('log_lines_rejected_total', len(lines) - queued, REJECT_INVALID)
+
+    def manage_broks(self, broks):
+        """
+        Manage a batch of broks received from the broker
+
+        The broks which type is not managed by the module are counted but not deserialized.
+        With a parsing pool, the log lines of the batch are parsed together by the pool workers.
+        The check results of the batch are grouped per item and accounted once per item, at the
+        end of the batch or when the coalescing window ends.
+        """
+        handled = self.handled_brok_types
+        lines = []
+        for b in broks:
+            if b.type not in handled:
+                self.metrics.inc('broks_total', 1, b.type)
+                continue
+            b.prepare()
+            if b.type in CHECK_RESULT_TYPES:
+                self.metrics.inc('broks_total', 1, b.type)
+                self.queue_check(b)
+            elif b.type == 'log' and self.parse_pool:
+                lines.append(b.data['log'])
+            else:
+                self.manage_brok(b)
+        if lines:
+            self.manage_log_lines(lines)
+
+        if not self.availability_coalesce_window:
+            self.record_pending_checks()
+
+    def queue_check(self, brok):
+        """
+        Queue a check result of a registered item until its item checks are accounted
+
+        While the checks are held (availability records not yet loaded), a check in the same state as
+        the previous queued check replaces it: the accounting is the same, the queue does not grow.
+        The first queued check of an item is never replaced.
+        """
+        item = self.services_cache.items.get((brok.data['host_name'], brok.data.get('service_description', '')))
+        if item is None:
+            return
+        if not self.pending_checks:
+            self.next_checks_flush = time.time() + self.availability_coalesce_window
+        # Only the needed fields are kept, not the whole brok data
+        check = get_check(brok.data)
+        checks = self.pending_checks.get(item)
+        if checks is None:
+            self.pending_checks[item] = [check]
+            return
+        last = checks[-1]
+        if len(checks) > 1 and check[1:] == last[1:] and check[2] is not None and check[0] >= last[0] and \
+                (check[0] < self.availability_day.end) == (last[0] < self.availability_day.end):
+            checks[-1] = check
+            self.metrics.inc('check_results_coalesced_total')
+        else:
+            checks.append(check)
+
+    def is_availability_loaded(self):
+        """
+        Are the current day availability records loaded from the DB?
+        """
+        return self.availability_loaded_day == self.availability_day.date
+
+    def record_pending_checks(self):
+        """
+        Account the queued check results, once per item
+
+        The checks are held until the current day availability records are loaded from the DB: the
+        stored records are updated, not replaced by new records. The checks of the ending day are
+        accounted for all the items before the day rollover, the next day checks are then held until
+        the next day records are loaded.
+        """
+        if not self.pending_checks or not self.is_availability_loaded():
+            return
+        pending = self.pending_checks
+        self.pending_checks = {}
+
+        end = self.availability_day.end
+        late = []
+        coalesced = 0
+        for item, checks in pending.iteritems():
+            split = len(checks)
+            while split and checks[split - 1][0] >= end:
+                split -= 1
+            if split < len(checks):
+                late.append((item, checks[split:]))
+                checks = checks[:split]
+            if checks:
+                coalesced += len(checks) - 1
+                self.record_checks(item, checks)
+        self.metrics.inc('check_results_coalesced_total', coalesced)
+        if not late:
+            return
+
+        if time.time() < end:
+            # Checks of the next day received before the day end: the local clock is late
+            for item, checks in late:
+                self.record_checks(item, checks)
+            return
+
+        # Day rollover: close and store the ending day records, start the new day
+        self.rollover_availability()
+        for item, checks in late:
+            self.pending_checks[item] = checks
+        self.next_checks_flush = time.time() + self.availability_coalesce_window
+
+    def record_checks(self, item, checks):
+        """
+        Parse the Shinken check broks of an item, in brok order, to compute availability and store
+        a daily availability record in the DB
+
+        The checks are (check time, state id, state change time, in scheduled downtime) tuples got
+        from the brok data with get_check.
 
         Main principles:
 
@@ -451,171 +881,128 @@ class MongoLogs(BaseModule):
         'last_chk': 1433785101 / 'last_state_change': 1433736035.927526
         'in_scheduled_downtime': False
         """
-        if not self.is_connected == CONNECTED:
-            logger.warning("[mongo-logs] availability not recorded: %s/%s: %s", hostname, service, b.data)
-            return
+        logger.debug("[mongo-logs] record availability for: %s: %d checks", item, len(checks))
+
+        day = self.availability_day
+        recorded = False
+        # The writer thread loads the records of the day into the items
+        with self.availability_lock:
+            for check_time, state_id, state_change_time, downtime in checks:
+                if check_time < day.start:
+                    # Not yet checked, or checked before the current day
+                    continue
 
-        logger.debug("[mongo-logs] record availability for: %s/%s: %s", hostname, service, b.data['state'])
-        logger.debug("[mongo-logs] record availability: %s/%s: %s", hostname, service, b.data)
-
-
-        # Ignoring SOFT states ...
-        # if b.data['state_type_id']==0:
-            # logger.warning("[mongo-logs] record availability for: %s/%s, but no HARD state, ignoring ...", hostname, service)
-
-
-        # Compute number of seconds today ...
-        midnight = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
-        midnight_timestamp = time.mktime (midnight.timetuple())
-        seconds_today = int(b.data['last_chk']) - midnight_timestamp
-        # Scheduled downtime
-        scheduled_downtime = bool(b.data['in_scheduled_downtime'])
-        # Day
-        day = datetime.date.today()
-        yesterday = day - datetime.timedelta(days=1)
-
-        # Cache index ...
-        query = """%s/%s_%s""" % (hostname, service, day)
-        q_day = { "hostname": hostname, "service": service, "day": day.strftime('%Y-%m-%d') }
-        q_yesterday = { "hostname": hostname, "service": service, "day": yesterday.strftime('%Y-%m-%d') }
-
-        # Test if record for current day still exists
-        exists = False
-        try:
-            self.availability_cache[query] = self.db[self.hav_collection].find_one( q_day )
-            if '_id' in self.availability_cache[query]:
-                exists = True
-                logger.debug("[mongo-logs] found a today record for: %s", query)
-
-                # Test if yesterday record exists ...
-                # TODO: Not yet implemented:
-                # - update yesterday with today's first received check will provide a more accurate information.
-                # data_yesterday = self.db[self.hav_collection].find_one( q_yesterday )
-                # if '_id' in data_yesterday:
-                    # exists = True
-                    # logger.info("[mongo-logs] found a yesterday record for: %s", query)
-        except TypeError, exp:
-            logger.debug("[mongo-logs] Exception when querying database - no cache query available: %s", str(exp))
-        except Exception, exp:
-            logger.error("[mongo-logs] Exception when querying database: %s", str(exp))
-            return
+                data = item.availability
+                if data is None or data['day'] != day.name:
+                    # Create new daily record, it continues the previous day record
+                    data = new_record(item.hostname, item.service, day, data)
+                    item.availability = data
 
-        # Configure recorded data
-        current_state = b.data['state']
-        current_state_id = b.data['state_id']
-        last_state = b.data['last_state']
-        last_check_state = self.availability_cache[query]['last_check_state'] if exists else 3
-        last_check_timestamp = self.availability_cache[query]['last_check_timestamp'] if exists else midnight_timestamp
-        since_last_check = 0
-        logger.debug("[mongo-logs] current state: %s, last state: %s", current_state, last_state)
-
-        # Host/service check
-        last_check = b.data['last_chk']
-        since_last_check = int(last_check - last_check_timestamp)
-
-        if exists:
-            # Update existing record
-            data = self.availability_cache[query]
-
-            # Update record
-            if since_last_check > seconds_today:
-                # Last state changed before today ...
-                # Current state duration for all seconds of today
-                data["daily_%d" % data['last_check_state']] = seconds_today
-            else:
-                # Increase current state duration with seconds since last state
-                data["daily_%d" % data['last_check_state']] += (since_last_check)
+                record_check(data, day, state_id, check_time, state_change_time, downtime)
+                recorded = True
 
-        else:
-            # Create new daily record
-            data = {}
-            data['hostname'] = hostname
-            data['service'] = service
-            data['day'] = day.strftime('%Y-%m-%d')
-            data['day_ts'] = midnight_timestamp
-            data['is_downtime'] = '1' if bool(b.data['in_scheduled_downtime']) else '0'
-
-            # All possible states are 0 seconds duration.
-            data['daily_0'] = 0
-            data['daily_1'] = 0
-            data['daily_2'] = 0
-            data['daily_3'] = 0
-            data['daily_4'] = 0
-
-            # First check state and timestamp
-            data['first_check_state'] = current_state_id
-            data['first_check_timestamp'] = int(b.data['last_chk'])
-
-        # Update cache ...
-        self.availability_cache[query] = data
-
-        # Unchecked state for all day duration minus all states duration
-        data['daily_4'] = 86400
-        for value in [ data['daily_0'], data['daily_1'], data['daily_2'], data['daily_3'] ]:
-            data['daily_4'] -= int(value)
-
-        # Last check state and timestamp
-        data['last_check_state'] = current_state_id
-        data['last_check_timestamp'] = int(b.data['last_chk'])
-
-        self.availability_cache[query] = data
-
-        # Store cached values ...
-        try:
-            logger.debug("[mongo-logs] store for: %s", self.availability_cache[query])
-            # self.db[self.hav_collection].save(self.availability_cache[query])
-            self.db[self.hav_collection].replace_one(q_day, self.availability_cache[query], upsert=True)
-        except AutoReconnect, exp:
-            logger.error("[mongo-logs] Autoreconnect exception when updating availability: %s", str(exp))
-            self.is_connected = SWITCHING
-            # Abort update ... no backlog management currently!
-        except Exception, exp:
-            self.is_connected = DISCONNECTED
-            logger.error("[mongo-logs] Database error occurred: %s", exp)
-            raise MongoLogsError
+        if not recorded:
+            return
+
+        # Record will be stored on next availability commit ...
+        self.availability_cache_backlog.add(item)
+        if len(self.availability_cache_backlog) >= self.availability_commit_volume:
+            self.commit_availability()
 
     def main(self):
         self.set_proctitle(self.name)
         self.set_exit_handler()
 
-        # Open database connection
-        self.open()
+        # Start the parsing pool before the writer thread, workers are forked processes
+        if self.parse_workers:
+            self.parse_pool = multiprocessing.Pool(self.parse_workers)
+            logger.info("[mongo-logs] started %d log lines parsing workers", self.parse_workers)
+
+        # Start the storage writer thread, it will open the database connection
+        spool = None
+        if self.writer_overflow == OVERFLOW_SPILL:
+            spool = Spool(self.spool_dir, segment_size=self.spool_segment_size * 1024 * 1024,
+                          max_size=self.spool_max_size * 1024 * 1024, fsync=self.spool_fsync)
+        self.writer = MongoLogsWriter(self.storage, queue_size=self.writer_queue_size, overflow=self.writer_overflow,
+                                      spool=spool, replay_rate=self.spool_replay_rate,
+                                      retry_min_delay=self.retry_min_delay, retry_max_delay=self.retry_max_delay)
+        self.writer.start()
+        self.load_availability()
+
+        # Secondary sinks writers drop their oldest batches rather than slowing down the module
+        for sink in self.sinks:
+            writer = MongoLogsWriter(sink, queue_size=self.sink_queue_size, overflow=OVERFLOW_DROP_OLDEST,
+                                     retry_min_delay=self.retry_min_delay, retry_max_delay=self.retry_max_delay,
+                                     name='mongo-logs-sink-%s' % sink.name)
+            writer.start()
+            self.sink_writers.append(writer)
+
+        self.declare_writer_metrics()
+        if self.metrics_port:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, self.metrics_host, self.metrics_port)
+                self.metrics_server.start()
+            except Exception, exp:
+                logger.error("[mongo-logs] could not start the metrics endpoint: %s", str(exp))
 
         db_commit_next_time = time.time()
-        db_test_connection = time.time()
+        db_availability_next_time = time.time()
 
         while not self.interrupted:
             logger.debug("[mongo-logs] queue length: %s", self.to_q.qsize())
             now = time.time()
 
-            # DB connection test ?
-            if self.db_test_period and db_test_connection < now:
-                logger.debug("[mongo-logs] Testing database connection ...")
-                # Test connection every 5 seconds ...
-                db_test_connection = now + self.db_test_period
-                if self.is_connected == DISCONNECTED:
-                    logger.warning("[mongo-logs] Trying to connect database ...")
-                    self.open()
-
             # Logs commit ?
             if db_commit_next_time < now:
                 logger.debug("[mongo-logs] Logs commit time ...")
-                # Commit periodically ...
-                db_commit_next_time = now + self.commit_period
-                self.commit_logs()
-
-            # Logs rotation ?
-            if self.next_logs_rotation < now:
-                logger.debug("[mongo-logs] Logs rotation time ...")
-                self.rotate_logs()
+                # Commit periodically, more often if many logs are received ...
+                backlog = self.commit_logs()
+                db_commit_next_time = now + self.get_commit_period(backlog)
+                if self.logs_stats:
+                    self.commit_logs_stats()
+
+            # Coalesced check results accounting ?
+            if self.pending_checks and (self.next_checks_flush <= now or now >= self.availability_day.end
+                                        or db_availability_next_time < now):
+                self.record_pending_checks()
+
+            # Availability day rollover, once the ending day checks are accounted ?
+            if now >= self.availability_day.end and self.is_availability_loaded():
+                self.rollover_availability()
+            elif self.availability_load_pending:
+                self.submit_availability_load()
+
+            # Availability commit ?
+            if db_availability_next_time < now:
+                logger.debug("[mongo-logs] Availability commit time ...")
+                db_availability_next_time = now + self.availability_commit_period
+                self.commit_availability()
 
             # Broks management ...
             l = self.to_q.get()
-            for b in l:
-                b.prepare()
-                self.manage_brok(b)
+            start = time.time()
+            self.manage_broks(l)
 
             logger.debug("[mongo-logs] time to manage %s broks (%3.4fs)", len(l), time.time() - now)
-
-        # Close database connection
-        self.close()
+            self.metrics.observe('broks_batch_seconds', time.time() - start)
+
+        # Store pending logs and availability records, the writer closes the database connection when it stops
+        while self.logs_cache:
+            backlog = len(self.logs_cache)
+            self.commit_logs(self.commit_period)
+            if len(self.logs_cache) == backlog:
+                logger.error("[mongo-logs] writer queue is full, %d lines could not be committed", backlog)
+                break
+        if self.logs_stats:
+            self.commit_logs_stats(self.commit_period)
+        self.record_pending_checks()
+        self.commit_availability(self.commit_period)
+        self.writer.stop(self.commit_period)
+        for writer in self.sink_writers:
+            writer.stop(self.commit_period)
+
+        if self.parse_pool:
+            self.parse_pool.terminate()
+
+        if self.metrics_server:
+            self.metrics_server.stop()
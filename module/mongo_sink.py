@@ -0,0 +1,1009 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This class is the MongoDB storage of the mongo-logs module.
+
+MongoDB is the primary storage: the module primary writer targets a MongoSink, it writes the
+batches of logs, availability records and logs statistics, tests the DB connection and rotates
+the logs in maintain(). The module reads the stored logs and availability records with the
+MongoSink query methods.
+"""
+
+import re
+import time
+import datetime
+
+from shinken.log import logger
+
+from .sinks import Sink
+from .log_line import (
+    compact_document,
+    expand_document,
+    expand_bucket,
+    buckets_query,
+    COMPACT_FIELDS,
+    BUCKET_KEYS
+)
+
+try:
+    import pymongo
+    from pymongo import MongoClient, ReplaceOne, UpdateOne, WriteConcern
+    from pymongo.errors import AutoReconnect, ConnectionFailure, OperationFailure, BulkWriteError, InvalidOperation
+    from bson import ObjectId
+except ImportError:
+    logger.error('[mongo-logs] Can not import pymongo and/or MongoClient'
+                 'Your pymongo lib is too old. '
+                 'Please install it with a 3.x+ version from '
+                 'https://pypi.python.org/pypi/pymongo')
+    MongoClient = ObjectId = None
+
+try:
+    from pymongo.monitoring import TopologyListener
+except ImportError:
+    # pymongo < 3.3, the topology changes are not logged
+    TopologyListener = None
+
+
+CONNECTED = 1
+DISCONNECTED = 2
+SWITCHING = 3
+
+# Duplicate key error code, a retried insert of already inserted documents
+DUPLICATE_KEY_ERROR = 11000
+
+# Logs documents storage schemas
+SCHEMA_FULL = 'full'
+SCHEMA_COMPACT = 'compact'
+STORAGE_SCHEMAS = [SCHEMA_FULL, SCHEMA_COMPACT]
+
+# Logs bucketing: one document per log line, or hourly buckets by item or by logclass
+BUCKETING_NONE = 'none'
+BUCKETING_ITEM = 'item'
+BUCKETING_LOGCLASS = 'logclass'
+LOGS_BUCKETINGS = [BUCKETING_NONE, BUCKETING_ITEM, BUCKETING_LOGCLASS]
+
+# Logs retention strategies
+RETENTION_DELETE = 'delete'
+RETENTION_TTL = 'ttl'
+RETENTION_PARTITIONED = 'partitioned'
+RETENTION_STRATEGIES = [RETENTION_DELETE, RETENTION_TTL, RETENTION_PARTITIONED]
+
+# Default collections indexes
+LOGS_INDEXES = 'host_name+service_description+time, logclass+time, time'
+LOGS_INDEXES_COMPACT = 'h+s+t, c+t, t'
+HAV_INDEXES = 'unique:hostname+service+day, day'
+LOGS_STATS_INDEXES = 'unique:period+time+host_name+service_description+logclass+type+state'
+
+# Logs statistics rollups periods
+LOGS_STATS_PERIODS = ['hour', 'day']
+
+
+def parse_indexes(indexes):
+    """
+    Parse an indexes declaration: a comma separated list of indexes
+
+    An index is a list of fields separated with +, a field prefixed with - is a descending key.
+    An index prefixed with unique: is a unique index.
+
+    Returns a list of (keys, unique) tuples
+    """
+    result = []
+    for index in indexes.split(','):
+        index = index.strip()
+        if not index:
+            continue
+        unique = index.startswith('unique:')
+        if unique:
+            index = index[len('unique:'):]
+        keys = []
+        for field in index.split('+'):
+            field = field.strip()
+            if field.startswith('-'):
+                keys.append((field[1:], pymongo.DESCENDING))
+            else:
+                keys.append((field, pymongo.ASCENDING))
+        result.append((keys, unique))
+    return result
+
+
+def get_index_hint(indexes, fields, sort_field):
+    """
+    Get the keys of the declared index matching an equality query on fields sorted by sort_field,
+    or None if no declared index matches
+    """
+    fields = set(fields)
+    for keys, unique in indexes:
+        names = [name for name, direction in keys]
+        if len(names) > len(fields) and set(names[:len(fields)]) == fields and names[len(fields)] == sort_field:
+            return keys
+    return None
+
+
+def match_criteria(doc, criteria):
+    """
+    Check if a log line document matches the query criteria: field -> value or {'$in': values}
+    """
+    for field, value in criteria.iteritems():
+        if isinstance(value, dict):
+            if doc.get(field) not in value['$in']:
+                return False
+        elif doc.get(field) != value:
+            return False
+    return True
+
+
+class MongoLogsError(Exception):
+    pass
+
+
+if TopologyListener is not None:
+    class TopologyLogger(TopologyListener):
+        """
+        Log the replica set topology changes seen by the pymongo monitoring threads
+
+        The writable server (primary) availability is logged and counted, the server selection
+        of the next DB operation waits for the new primary.
+        """
+
+        def __init__(self, metrics):
+            self.metrics = metrics
+
+        def opened(self, event):
+            logger.debug("[mongo-logs] topology opened: %s", event.topology_id)
+
+        def description_changed(self, event):
+            previous = event.previous_description
+            new = event.new_description
+            if previous.has_writable_server() and not new.has_writable_server():
+                logger.warning("[mongo-logs] no primary server available, topology: %s", new.topology_type_name)
+                self.metrics.inc('db_failovers_total')
+            elif new.has_writable_server() and not previous.has_writable_server():
+                logger.info("[mongo-logs] primary server available, topology: %s", new.topology_type_name)
+
+        def closed(self, event):
+            logger.debug("[mongo-logs] topology closed: %s", event.topology_id)
+
+
+class MongoSink(Sink):
+    """
+    Store the batches in the MongoDB database, this sink is the module primary storage
+
+    - logs are stored in the logs collection, in monthly collections with the partitioned retention,
+      one document per log line or in hourly buckets
+    - availability records in the availability collection, one document per item and day
+    - logs statistics in the logs statistics collection, counts are incremented
+
+    The availability records of a day are loaded by the availability_load operation, the loaded
+    records are given to the availability_loaded(day, records) callback.
+    """
+    name = 'mongodb'
+    operations = ('logs', 'availability', 'logs_stats', 'availability_load')
+
+    def __init__(self, mod_conf, metrics, max_logs_age=365, availability_loaded=None):
+        self.metrics = metrics
+        self.max_logs_age = max_logs_age
+        self.availability_loaded = availability_loaded
+
+        self.uri = getattr(mod_conf, 'uri', 'mongodb://localhost')
+        logger.info('[mongo-logs] mongo uri: %s', self.uri)
+
+        self.replica_set = getattr(mod_conf, 'replica_set', None)
+        if self.replica_set and int(pymongo.version[0]) < 3:
+            logger.error('[mongo-logs] Can not initialize module with '
+                         'replica_set because your pymongo lib is too old. '
+                         'Please install it with a 3.x+ version from '
+                         'https://pypi.python.org/pypi/pymongo')
+            return None
+
+        self.database = getattr(mod_conf, 'database', 'shinken')
+        logger.info('[mongo-logs] database: %s', self.database)
+
+        # Write concern: number of acknowledging servers (or majority) and journal acknowledgement
+        self.write_concern_w = getattr(mod_conf, 'write_concern_w', '1')
+        if self.write_concern_w.isdigit():
+            self.write_concern_w = int(self.write_concern_w)
+        self.write_concern_j = getattr(mod_conf, 'write_concern_j', '0') == '1'
+        logger.info('[mongo-logs] write concern: w=%s, j=%s', self.write_concern_w, self.write_concern_j)
+
+        self.db_test_period = int(getattr(mod_conf, 'db_test_period', '0'))
+        logger.info('[mongo-logs] periodical DB connection test period: %ds', self.db_test_period)
+
+        # Maximum time to wait for an available server (primary) before an operation fails
+        self.server_selection_timeout = int(getattr(mod_conf, 'server_selection_timeout', '5'))
+        logger.info('[mongo-logs] server selection timeout: %ds', self.server_selection_timeout)
+
+        self.logs_collection = getattr(mod_conf, 'logs_collection', 'logs')
+        logger.info('[mongo-logs] logs collection: %s', self.logs_collection)
+
+        self.hav_collection = getattr(mod_conf, 'hav_collection', 'availability')
+        logger.info('[mongo-logs] hosts availability collection: %s', self.hav_collection)
+
+        self.storage_schema = getattr(mod_conf, 'storage_schema', SCHEMA_FULL)
+        if self.storage_schema not in STORAGE_SCHEMAS:
+            logger.error('[mongo-logs] Wrong value for storage_schema. Must be one of %s and not %s', STORAGE_SCHEMAS, self.storage_schema)
+            self.storage_schema = SCHEMA_FULL
+        self.storage_message = getattr(mod_conf, 'storage_message', '1') == '1'
+        logger.info('[mongo-logs] logs storage schema: %s, store messages: %s', self.storage_schema, self.storage_message)
+        # Name of the logs time field in the DB
+        self.logs_time_field = 'time' if self.storage_schema == SCHEMA_FULL else COMPACT_FIELDS['time'][0]
+
+        # Bucketed logs storage, the log lines of an hour are pushed in bucket documents
+        self.logs_bucketing = getattr(mod_conf, 'logs_bucketing', BUCKETING_NONE)
+        if self.logs_bucketing not in LOGS_BUCKETINGS:
+            logger.error('[mongo-logs] Wrong value for logs_bucketing. Must be one of %s and not %s', LOGS_BUCKETINGS, self.logs_bucketing)
+            self.logs_bucketing = BUCKETING_NONE
+        self.logs_bucket_size = int(getattr(mod_conf, 'logs_bucket_size', '1000'))
+        logger.info('[mongo-logs] logs bucketing: %s, bucket size: %d lines', self.logs_bucketing, self.logs_bucket_size)
+        # Buckets keys: (name in the DB, default value)
+        self.logs_bucket_keys = []
+        if self.logs_bucketing != BUCKETING_NONE:
+            for key in BUCKET_KEYS[self.logs_bucketing]:
+                compact, default = COMPACT_FIELDS[key]
+                self.logs_bucket_keys.append((key if self.storage_schema == SCHEMA_FULL else compact, default))
+
+        if self.logs_bucketing != BUCKETING_NONE:
+            logs_indexes = '%s+hour, hour' % '+'.join(name for name, default in self.logs_bucket_keys)
+        elif self.storage_schema == SCHEMA_FULL:
+            logs_indexes = LOGS_INDEXES
+        else:
+            logs_indexes = LOGS_INDEXES_COMPACT
+        self.logs_indexes = parse_indexes(getattr(mod_conf, 'logs_indexes', logs_indexes))
+        logger.info('[mongo-logs] logs collection indexes: %s', self.logs_indexes)
+
+        self.hav_indexes = parse_indexes(getattr(mod_conf, 'hav_indexes', HAV_INDEXES))
+        logger.info('[mongo-logs] availability collection indexes: %s', self.hav_indexes)
+
+        self.logs_retention = getattr(mod_conf, 'logs_retention', RETENTION_DELETE)
+        if self.logs_retention not in RETENTION_STRATEGIES:
+            logger.error('[mongo-logs] Wrong value for logs_retention. Must be one of %s and not %s', RETENTION_STRATEGIES, self.logs_retention)
+            self.logs_retention = RETENTION_DELETE
+        logger.info('[mongo-logs] logs retention: %s', self.logs_retention)
+        # Monthly logs collections which indexes were created
+        self.logs_partitions = set()
+
+        # Logs statistics rollups
+        self.logs_stats = getattr(mod_conf, 'logs_stats', '0') == '1'
+        self.logs_stats_collection = getattr(mod_conf, 'logs_stats_collection', 'logs_stats')
+        self.logs_stats_indexes = parse_indexes(getattr(mod_conf, 'logs_stats_indexes', LOGS_STATS_INDEXES))
+        if self.logs_stats:
+            logger.info('[mongo-logs] logs statistics collection: %s', self.logs_stats_collection)
+            logger.info('[mongo-logs] logs statistics collection indexes: %s', self.logs_stats_indexes)
+
+        self.con = None
+        self.db = None
+        self.is_connected = DISCONNECTED
+        self.indexes_checked = False
+
+        self.next_db_test = time.time()
+        self.next_logs_rotation = time.time() + 5000
+
+    def open(self):
+        """
+        Connect to the Mongo DB with configured URI.
+
+        The client is created once and monitors the replica set topology in background: after a
+        connection loss or a failover, the server selection waits for an available primary, at most
+        server_selection_timeout seconds, and the connection is established again.
+
+        Update log rotation time to force a log rotation
+        """
+        if self.con is None:
+            kwargs = {'connect': False, 'serverSelectionTimeoutMS': self.server_selection_timeout * 1000}
+            if TopologyListener is not None:
+                kwargs['event_listeners'] = [TopologyLogger(self.metrics)]
+            self.con = MongoClient(self.uri, **kwargs)
+        if self.is_connected == SWITCHING:
+            logger.info("[mongo-logs] waiting for a primary server: %s", self.uri)
+        else:
+            logger.info("[mongo-logs] trying to connect MongoDB: %s", self.uri)
+        try:
+            try:
+                # Blocks until a server is selected
+                address = self.con.address
+            except InvalidOperation:
+                # Load balanced mongos servers, a server is selected for each operation
+                address = self.con.nodes
+            logger.info("[mongo-logs] connected to MongoDB: %s", address)
+
+            self.db = self.con.get_database(self.database,
+                                            write_concern=WriteConcern(w=self.write_concern_w, j=self.write_concern_j))
+            logger.info("[mongo-logs] connected to the database: %s (%s)", self.database, self.db)
+
+            self.is_connected = CONNECTED
+            self.next_logs_rotation = time.time()
+            self.metrics.inc('db_connections_total')
+
+            logger.info('[mongo-logs] database connection established')
+        except ConnectionFailure as e:
+            logger.error("[mongo-logs] Server is not available: %s", str(e))
+            self.metrics.inc('db_connection_errors_total', 1, 'open')
+            return False
+        except Exception as e:
+            logger.error("[mongo-logs] Could not open the database: %s", str(e))
+            raise MongoLogsError
+
+        if not self.indexes_checked:
+            self.indexes_checked = True
+            if self.logs_retention != RETENTION_PARTITIONED:
+                self.create_indexes(self.logs_collection, self.logs_indexes)
+            if self.logs_retention == RETENTION_TTL:
+                self.create_ttl_index()
+            self.create_indexes(self.hav_collection, self.hav_indexes)
+            if self.logs_stats:
+                self.create_indexes(self.logs_stats_collection, self.logs_stats_indexes)
+
+        return True
+
+    def create_indexes(self, collection, indexes):
+        """
+        Make sure the declared indexes exist for a collection, and log the indexes usage
+
+        Indexes are built in background to avoid locking the collection
+        """
+        for keys, unique in indexes:
+            try:
+                name = self.db[collection].create_index(keys, unique=unique, background=True)
+                logger.info("[mongo-logs] index %s exists for the collection %s", name, collection)
+            except Exception, exp:
+                logger.error("[mongo-logs] Could not create the index %s for the collection %s: %s", keys, collection, str(exp))
+
+        try:
+            for stats in self.db[collection].aggregate([{'$indexStats': {}}]):
+                logger.info("[mongo-logs] index %s of the collection %s used %d times since %s",
+                            stats['name'], collection, stats['accesses']['ops'], stats['accesses']['since'])
+        except Exception, exp:
+            logger.info("[mongo-logs] No indexes usage statistics for the collection %s: %s", collection, str(exp))
+
+    def create_ttl_index(self):
+        """
+        Make sure the logs collection has a TTL index to remove the logs older than the configured maximum age
+        """
+        expire = self.max_logs_age * 86400
+        try:
+            self.db[self.logs_collection].create_index('date', expireAfterSeconds=expire, background=True)
+            logger.info("[mongo-logs] logs TTL index exists, logs expire after %d seconds", expire)
+        except OperationFailure:
+            # Index exists with another expiration delay
+            try:
+                self.db.command('collMod', self.logs_collection,
+                                index={'keyPattern': {'date': 1}, 'expireAfterSeconds': expire})
+                logger.info("[mongo-logs] logs TTL index updated, logs expire after %d seconds", expire)
+            except Exception, exp:
+                logger.error("[mongo-logs] Could not update the logs TTL index: %s", str(exp))
+        except Exception, exp:
+            logger.error("[mongo-logs] Could not create the logs TTL index: %s", str(exp))
+
+    def get_logs_collection(self, timestamp):
+        """
+        Get the name of the collection where a log line is stored
+
+        With the partitioned retention, the logs are stored in monthly collections: logs_YYYY_MM
+        """
+        if self.logs_retention != RETENTION_PARTITIONED:
+            return self.logs_collection
+        t = time.localtime(timestamp)
+        return '%s_%04d_%02d' % (self.logs_collection, t.tm_year, t.tm_mon)
+
+    def close(self):
+        self.is_connected = DISCONNECTED
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+        logger.info('[mongo-logs] database connection closed')
+
+    def connection_lost(self, state=DISCONNECTED):
+        """
+        Called when a DB operation failed because of the connection, the operation will be retried
+
+        The client is kept: it reconnects by itself and follows the replica set failovers.
+        """
+        self.is_connected = state
+
+    def maintain(self):
+        """
+        Called by the writer thread, this method tests the DB connection and rotates the logs when it is time to
+        """
+        now = time.time()
+
+        # DB connection test ?
+        if self.db_test_period and self.next_db_test < now:
+            logger.debug("[mongo-logs] Testing database connection ...")
+            self.next_db_test = now + self.db_test_period
+            if self.is_connected != CONNECTED:
+                logger.warning("[mongo-logs] Trying to connect database ...")
+                self.open()
+
+        # Logs rotation ?
+        if self.next_logs_rotation < now:
+            logger.debug("[mongo-logs] Logs rotation time ...")
+            self.rotate_logs()
+
+    def rotate_logs(self):
+        """
+        For a Mongo DB there is no rotate, but we will delete logs older than configured maximum age.
+
+        With the ttl retention, the logs are removed by the DB server. With the partitioned retention,
+        the monthly collections which all logs are older than configured maximum age are dropped.
+
+        The logs stored before the retention was changed are deleted as with the delete retention:
+        the logs without a date field with the ttl retention, and the logs of the logs collection with
+        the partitioned retention. This collection is dropped when it is empty.
+        """
+        if not self.is_connected == CONNECTED:
+            if not self.open():
+                self.next_logs_rotation = time.time() + 600
+                logger.info("[mongo-logs] log rotation failed, next log rotation at %s " % time.asctime(time.localtime(self.next_logs_rotation)))
+                return
+
+        logger.info("[mongo-logs] rotating logs ...")
+
+        now = time.time()
+        today = datetime.date.today()
+        today0000 = datetime.datetime(today.year, today.month, today.day, 0, 0, 0)
+        today0005 = datetime.datetime(today.year, today.month, today.day, 0, 5, 0)
+        oldest = today0000 - datetime.timedelta(days=self.max_logs_age)
+        try:
+            if self.logs_retention == RETENTION_TTL:
+                logger.info("[mongo-logs] logs older than %s days are removed by the TTL index.", self.max_logs_age)
+                deleted = self.delete_logs(self.logs_collection, oldest, {'date': {'$exists': False}})
+                if deleted:
+                    logger.info("[mongo-logs] removed %d logs without date older than %s days.", deleted, self.max_logs_age)
+            elif self.logs_retention == RETENTION_PARTITIONED:
+                self.drop_logs_partitions(oldest.date())
+                if self.logs_collection in self.db.collection_names():
+                    deleted = self.delete_logs(self.logs_collection, oldest)
+                    logger.info("[mongo-logs] removed %d logs older than %s days from %s.", deleted, self.max_logs_age, self.logs_collection)
+                    if self.db[self.logs_collection].find_one() is None:
+                        self.db.drop_collection(self.logs_collection)
+                        logger.info("[mongo-logs] dropped the empty logs collection %s.", self.logs_collection)
+            else:
+                deleted = self.delete_logs(self.logs_collection, oldest)
+                logger.info("[mongo-logs] removed %d logs older than %s days.", deleted, self.max_logs_age)
+        except ConnectionFailure, exp:
+            self.connection_lost()
+            self.next_logs_rotation = time.time() + 600
+            logger.error("[mongo-logs] Database connection error occurred when rotating logs: %s", exp)
+            self.metrics.inc('db_connection_errors_total', 1, 'rotation')
+            return
+        except Exception, exp:
+            self.next_logs_rotation = time.time() + 600
+            logger.error("[mongo-logs] Database error occurred when rotating logs: %s", exp)
+            return
+        self.metrics.observe('logs_rotation_seconds', time.time() - now)
+
+        if now < time.mktime(today0005.timetuple()):
+            next_rotation = today0005
+        else:
+            next_rotation = today0005 + datetime.timedelta(days=1)
+
+        # See you tomorrow
+        self.next_logs_rotation = time.mktime(next_rotation.timetuple())
+        logger.info("[mongo-logs] next log rotation at %s " % time.asctime(time.localtime(self.next_logs_rotation)))
+
+    def delete_logs(self, collection, oldest, query=None):
+        """
+        Delete the logs of a collection older than the oldest day to keep, returns the deleted logs count
+        """
+        time_field = self.logs_time_field if self.logs_bucketing == BUCKETING_NONE else 'max_time'
+        query = dict(query or {})
+        query[time_field] = {'$lt': time.mktime(oldest.timetuple())}
+        return self.db[collection].delete_many(query).deleted_count
+
+    def get_logs_partitions(self, names=None):
+        """
+        Get the monthly logs collections, in time order
+        """
+        if names is None:
+            names = self.db.collection_names()
+        partition = re.compile(r'^%s_(\d{4})_(\d{2})$' % re.escape(self.logs_collection))
+        return sorted(name for name in names if partition.match(name))
+
+    def drop_logs_partitions(self, oldest):
+        """
+        Drop the monthly logs collections which month ended before the oldest day to keep
+        """
+        for name in self.get_logs_partitions():
+            year, month = [int(value) for value in name[len(self.logs_collection) + 1:].split('_')]
+            next_month = datetime.date(year + month / 12, month % 12 + 1, 1)
+            if next_month <= oldest:
+                self.db.drop_collection(name)
+                self.logs_partitions.discard(name)
+                logger.info("[mongo-logs] dropped logs collection %s, older than %s days.", name, self.max_logs_age)
+
+    def write_logs(self, some_logs):
+        """
+        Called by the writer thread, this method inserts a bunch of logs in the DB
+
+        Returns False if the logs could not be inserted and must be retried
+        """
+        if not self.is_connected == CONNECTED:
+            if not self.open():
+                logger.warning("[mongo-logs] log commiting failed")
+                logger.warning("[mongo-logs] %d lines to insert in database", len(some_logs))
+                return False
+
+        now = time.time()
+        try:
+            if self.logs_retention == RETENTION_TTL and self.logs_bucketing == BUCKETING_NONE:
+                # Date used by the TTL index
+                for log in some_logs:
+                    log['date'] = datetime.datetime.utcfromtimestamp(log['time'])
+
+            if self.logs_retention == RETENTION_PARTITIONED:
+                partitions = {}
+                for log in some_logs:
+                    partitions.setdefault(self.get_logs_collection(log['time']), []).append(log)
+            else:
+                partitions = {self.logs_collection: some_logs}
+
+            # Insert lines to commit
+            for collection, logs in sorted(partitions.items()):
+                if self.logs_retention == RETENTION_PARTITIONED and collection not in self.logs_partitions:
+                    self.create_indexes(collection, self.logs_indexes)
+                    self.logs_partitions.add(collection)
+                if self.storage_schema == SCHEMA_COMPACT:
+                    logs = [compact_document(log, self.storage_message) for log in logs]
+                if self.logs_bucketing != BUCKETING_NONE:
+                    inserted = self.push_logs_buckets(collection, logs)
+                    logger.debug("[mongo-logs] pushed %d logs in the %s buckets.", inserted, collection)
+                    self.metrics.inc('log_lines_inserted_total', inserted)
+                    continue
+                try:
+                    result = self.db[collection].insert_many(logs, ordered=False)
+                    inserted = len(result.inserted_ids)
+                except BulkWriteError, exp:
+                    # Retried batch: the documents already inserted are duplicates
+                    inserted = exp.details.get('nInserted', 0)
+                    errors = exp.details.get('writeErrors', [])
+                    duplicates = len([e for e in errors if e.get('code') == DUPLICATE_KEY_ERROR])
+                    self.metrics.inc('log_lines_duplicates_total', duplicates)
+                    if duplicates < len(errors):
+                        logger.error("[mongo-logs] %d logs not inserted in %s: %s", len(errors) - duplicates, collection,
+                                     [e.get('errmsg') for e in errors if e.get('code') != DUPLICATE_KEY_ERROR][0])
+                        self.metrics.inc('log_lines_dropped_total', len(errors) - duplicates)
+                logger.debug("[mongo-logs] inserted %d logs in %s.", inserted, collection)
+                self.metrics.inc('log_lines_inserted_total', inserted)
+        except AutoReconnect, exp:
+            logger.error("[mongo-logs] Autoreconnect exception when inserting lines: %s", str(exp))
+            self.connection_lost(SWITCHING)
+            self.metrics.inc('db_connection_errors_total', 1, 'logs')
+            # Abort commit ... will be finished next time!
+            return False
+        except ConnectionFailure, exp:
+            self.connection_lost()
+            logger.error("[mongo-logs] Database connection error occurred when commiting: %s", exp)
+            self.metrics.inc('db_connection_errors_total', 1, 'logs')
+            return False
+        except Exception, exp:
+            logger.error("[mongo-logs] Database error occurred when commiting: %s", exp)
+            self.metrics.inc('log_lines_dropped_total', len(some_logs))
+        logger.debug("[mongo-logs] time to insert %s logs (%2.4f)", len(some_logs), time.time() - now)
+        self.metrics.observe('logs_insert_seconds', time.time() - now)
+        return True
+
+    def push_logs_buckets(self, collection, some_logs):
+        """
+        Called by the writer thread, this method appends a bunch of logs, in their stored form, to the hourly
+        buckets of a collection with bulk upserts
+
+        A bucket holds at most about logs_bucket_size lines, a new bucket is created for the same hour when
+        it is full. The bucket shared fields are not stored in its lines.
+        Returns the number of appended logs
+        """
+        time_field = self.logs_time_field
+        buckets = {}
+        for log in some_logs:
+            t = int(log[time_field])
+            entry = dict(log)
+            key = (t - t % 3600, ) + tuple(entry.pop(name, default) for name, default in self.logs_bucket_keys)
+            entries = buckets.get(key)
+            if entries is None:
+                buckets[key] = [entry]
+            else:
+                entries.append(entry)
+
+        requests = []
+        sizes = []
+        for key, entries in sorted(buckets.items()):
+            for i in xrange(0, len(entries), self.logs_bucket_size):
+                chunk = entries[i:i + self.logs_bucket_size]
+                times = [entry[time_field] for entry in chunk]
+                query = {'hour': key[0], 'count': {'$lt': self.logs_bucket_size}}
+                query.update(zip([name for name, default in self.logs_bucket_keys], key[1:]))
+                update = {
+                    '$push': {'logs': {'$each': chunk}},
+                    '$inc': {'count': len(chunk)},
+                    '$min': {'min_time': min(times)},
+                    '$max': {'max_time': max(times)}
+                }
+                if self.logs_retention == RETENTION_TTL:
+                    # Date used by the TTL index
+                    update['$setOnInsert'] = {'date': datetime.datetime.utcfromtimestamp(key[0])}
+                requests.append(UpdateOne(query, update, upsert=True))
+                sizes.append(len(chunk))
+
+        try:
+            self.db[collection].bulk_write(requests, ordered=False)
+        except BulkWriteError, exp:
+            errors = exp.details.get('writeErrors', [])
+            dropped = sum(sizes[error['index']] for error in errors)
+            logger.error("[mongo-logs] %d logs not pushed in the %s buckets: %s", dropped, collection,
+                         errors[0].get('errmsg') if errors else '')
+            self.metrics.inc('log_lines_dropped_total', dropped)
+            return sum(sizes) - dropped
+        return sum(sizes)
+
+    def write_logs_stats(self, some_stats):
+        """
+        Called by the writer thread, this method increments a bunch of logs statistics in the DB
+
+        Returns False if the statistics could not be updated and must be retried
+        """
+        if not self.is_connected == CONNECTED:
+            if not self.open():
+                logger.warning("[mongo-logs] logs statistics commiting failed")
+                return False
+
+        now = time.time()
+        requests = []
+        for data in some_stats:
+            query = dict(data)
+            count = query.pop('count')
+            requests.append(UpdateOne(query, {'$inc': {'count': count}}, upsert=True))
+
+        try:
+            self.db[self.logs_stats_collection].bulk_write(requests, ordered=False)
+            self.metrics.inc('logs_stats_updated_total', len(requests))
+        except AutoReconnect, exp:
+            logger.error("[mongo-logs] Autoreconnect exception when updating logs statistics: %s", str(exp))
+            self.connection_lost(SWITCHING)
+            self.metrics.inc('db_connection_errors_total', 1, 'logs_stats')
+            return False
+        except ConnectionFailure, exp:
+            self.connection_lost()
+            logger.error("[mongo-logs] Database connection error occurred when updating logs statistics: %s", exp)
+            self.metrics.inc('db_connection_errors_total', 1, 'logs_stats')
+            return False
+        except Exception, exp:
+            logger.error("[mongo-logs] Database error occurred when updating logs statistics: %s", exp)
+        logger.debug("[mongo-logs] time to update %d logs statistics (%2.4f)", len(requests), time.time() - now)
+        return True
+
+    def write_availability_load(self, day):
+        """
+        Called by the writer thread, this method loads a day availability records from the DB and
+        gives them to the availability_loaded callback
+        """
+        if not self.is_connected == CONNECTED:
+            if not self.open():
+                logger.warning("[mongo-logs] availability loading failed")
+                return False
+
+        now = time.time()
+        try:
+            records = list(self.db[self.hav_collection].find({"day": day.strftime('%Y-%m-%d')}))
+        except AutoReconnect, exp:
+            logger.error("[mongo-logs] Autoreconnect exception when loading availability records: %s", str(exp))
+            self.connection_lost(SWITCHING)
+            return False
+        except ConnectionFailure, exp:
+            self.connection_lost()
+            logger.error("[mongo-logs] Database connection error occurred when loading availability records: %s", exp)
+            return False
+        except Exception, exp:
+            # The day records are not loaded, the availability accounting must not wait for them
+            logger.error("[mongo-logs] Exception when loading availability records: %s", str(exp))
+            records = []
+
+        if self.availability_loaded is not None:
+            self.availability_loaded(day, records)
+        logger.info("[mongo-logs] loaded %d availability records for %s (%2.4f)", len(records), day, time.time() - now)
+        return True
+
+    def write_availability(self, some_records):
+        """
+        Called by the writer thread, this method stores a bunch of availability records in the DB
+
+        Returns False if the records could not be stored and must be retried
+        """
+        if not self.is_connected == CONNECTED:
+            if not self.open():
+                logger.warning("[mongo-logs] availability commiting failed")
+                logger.warning("[mongo-logs] %d availability records to update in database", len(some_records))
+                return False
+
+        now = time.time()
+        requests = []
+        for data in some_records:
+            q_day = { "hostname": data['hostname'], "service": data['service'], "day": data['day'] }
+            requests.append(ReplaceOne(q_day, data, upsert=True))
+
+        try:
+            result = self.db[self.hav_collection].bulk_write(requests, ordered=False)
+            logger.debug("[mongo-logs] updated %d availability records.", result.upserted_count + result.modified_count)
+            self.metrics.inc('availability_records_stored_total', len(requests))
+        except AutoReconnect, exp:
+            logger.error("[mongo-logs] Autoreconnect exception when updating availability: %s", str(exp))
+            self.connection_lost(SWITCHING)
+            self.metrics.inc('db_connection_errors_total', 1, 'availability')
+            # Abort commit ... will be finished next time!
+            return False
+        except ConnectionFailure, exp:
+            self.connection_lost()
+            logger.error("[mongo-logs] Database connection error occurred when updating availability: %s", exp)
+            self.metrics.inc('db_connection_errors_total', 1, 'availability')
+            return False
+        except Exception, exp:
+            logger.error("[mongo-logs] Database error occurred when updating availability: %s", exp)
+        logger.debug("[mongo-logs] time to update %d availability records (%2.4f)", len(requests), time.time() - now)
+        self.metrics.observe('availability_upsert_seconds', time.time() - now)
+        return True
+
+    def check_connection(self):
+        """
+        Make sure the DB connection is established before reading, raise MongoLogsError if it is not available
+        """
+        if self.is_connected != CONNECTED and not self.open():
+            raise MongoLogsError("database is not available")
+
+    def get_logs_collections(self, start=None, end=None, descending=False):
+        """
+        Get the logs collections which may contain log lines of a time range, in time order
+
+        With the partitioned retention, the logs collection holds the logs stored before the
+        retention was changed: it is read before the monthly collections.
+        """
+        if self.logs_retention != RETENTION_PARTITIONED:
+            return [self.logs_collection]
+        names = self.db.collection_names()
+        first = self.get_logs_collection(start) if start is not None else None
+        last = self.get_logs_collection(end) if end is not None else None
+        collections = [name for name in self.get_logs_partitions(names)
+                       if (first is None or name >= first) and (last is None or name <= last)]
+        if self.logs_collection in names:
+            collections.insert(0, self.logs_collection)
+        if descending:
+            collections.reverse()
+        return collections
+
+    def get_stored_criteria(self, criteria):
+        """
+        Get the query on the stored log lines fields from criteria on the full fields
+
+        With the compact schema, the default values are not stored: they are matched with null.
+        """
+        if self.storage_schema == SCHEMA_FULL:
+            return dict(criteria)
+        query = {}
+        for field, value in criteria.iteritems():
+            compact, default = COMPACT_FIELDS[field]
+            if isinstance(value, dict):
+                value = {'$in': [None if v == default else v for v in value['$in']]}
+            elif value == default:
+                value = None
+            query[compact] = value
+        return query
+
+    def find_logs_pages(self, criteria=None, start=None, end=None, fields=None, descending=False,
+                        batch_size=1000, after=None):
+        """
+        Generator of the pages of log lines matching criteria in a time range, in time order
+
+        - criteria: full fields name -> value or {'$in': values}
+        - start, end: time range timestamps, included
+        - fields: full fields names of the returned documents, default is all the fields
+        - after: marker of the last read page, the lines are read from this marker
+
+        A page is a (logs, marker) tuple, the logs documents are in their full form. The pages are
+        read with queries limited to batch_size lines, ranged by time: the next page starts at the
+        marker time, without the lines of this time already read.
+
+        With the bucketed storage, the marker also holds the hour of the buckets of the last line.
+        """
+        self.check_connection()
+        criteria = criteria or {}
+        if self.logs_bucketing != BUCKETING_NONE:
+            for page in self.find_buckets_pages(criteria, start, end, fields, descending, batch_size, after):
+                yield page
+            return
+
+        time_field = self.logs_time_field
+        query = self.get_stored_criteria(criteria)
+        hint = get_index_hint(self.logs_indexes, query.keys(), time_field)
+        projection = None
+        if fields:
+            if self.storage_schema == SCHEMA_FULL:
+                projection = dict((field, True) for field in fields)
+            elif self.storage_message or 'message' not in fields:
+                projection = dict((COMPACT_FIELDS[field][0], True) for field in fields if field in COMPACT_FIELDS)
+            if projection is not None:
+                projection[time_field] = True
+        direction = pymongo.DESCENDING if descending else pymongo.ASCENDING
+
+        last_time, last_ids = after if after else (None, [])
+        for collection in self.get_logs_collections(start, end, descending):
+            while True:
+                time_range = {}
+                if start is not None:
+                    time_range['$gte'] = start
+                if end is not None:
+                    time_range['$lte'] = end
+                if last_time is not None:
+                    if descending:
+                        time_range['$lte'] = min(last_time, end) if end is not None else last_time
+                    else:
+                        time_range['$gte'] = max(last_time, start) if start is not None else last_time
+                page_query = dict(query)
+                if time_range:
+                    page_query[time_field] = time_range
+                if last_ids:
+                    page_query['_id'] = {'$nin': last_ids}
+
+                cursor = self.db[collection].find(page_query, projection, sort=[(time_field, direction)], limit=batch_size)
+                if hint:
+                    cursor = cursor.hint(hint)
+                logs = []
+                for doc in cursor:
+                    if doc[time_field] != last_time:
+                        last_time, last_ids = doc[time_field], []
+                    last_ids.append(doc['_id'])
+                    if self.storage_schema == SCHEMA_COMPACT:
+                        doc = expand_document(doc)
+                    if fields:
+                        doc = dict((field, doc.get(field)) for field in fields)
+                    logs.append(doc)
+                if logs:
+                    yield logs, (last_time, list(last_ids))
+                if len(logs) < batch_size:
+                    break
+
+    def find_buckets_pages(self, criteria, start, end, fields, descending, batch_size, after):
+        """
+        Generator of the pages of log lines stored in buckets
+
+        The buckets are read hour by hour and their lines are split in pages of batch_size lines.
+        The marker of a page is the hour, the time and the ids of its last lines: the next page
+        starts in this hour, without the lines already read. The criteria on the buckets keys
+        select the buckets, the other criteria are matched on the log lines.
+        """
+        keys = BUCKET_KEYS[self.logs_bucketing]
+        bucket_criteria = dict((field, value) for field, value in criteria.iteritems() if field in keys)
+        lines_criteria = dict((field, value) for field, value in criteria.iteritems() if field not in keys)
+        # The buckets keys are always stored, even with their default values
+        query = {}
+        for field, value in bucket_criteria.iteritems():
+            query[field if self.storage_schema == SCHEMA_FULL else COMPACT_FIELDS[field][0]] = value
+        hint = get_index_hint(self.logs_indexes, query.keys(), 'hour')
+        query.update(buckets_query(start, end))
+        last_hour, last_time, last_ids = after if after else (None, None, [])
+        if last_hour is not None:
+            hours = query.setdefault('hour', {})
+            if descending:
+                hours['$lte'] = min(last_hour, hours.get('$lte', last_hour))
+            else:
+                hours['$gte'] = last_hour
+        direction = pymongo.DESCENDING if descending else pymongo.ASCENDING
+
+        def hours_lines(cursor):
+            """
+            Generator of the (hour, log lines) of the buckets of each hour
+            """
+            hour = None
+            buckets = []
+            for bucket in cursor:
+                if bucket['hour'] != hour and buckets:
+                    yield hour, buckets
+                    buckets = []
+                hour = bucket['hour']
+                buckets.append(bucket)
+            if buckets:
+                yield hour, buckets
+
+        def page(logs):
+            if fields:
+                logs = [dict((field, doc.get(field)) for field in fields) for doc in logs]
+            return logs, (last_hour, last_time, list(last_ids))
+
+        logs = []
+        for collection in self.get_logs_collections(start, end, descending):
+            cursor = self.db[collection].find(query, sort=[('hour', direction)], batch_size=batch_size)
+            if hint:
+                cursor = cursor.hint(hint)
+            for hour, buckets in hours_lines(cursor):
+                lines = []
+                for bucket in buckets:
+                    lines.extend(doc for doc in expand_bucket(bucket, start, end) if match_criteria(doc, lines_criteria))
+                lines.sort(key=lambda doc: doc['time'], reverse=descending)
+                for doc in lines:
+                    id = doc.get('_id')
+                    if doc['time'] != last_time:
+                        # Lines before the marker, already read
+                        if last_time is not None and (doc['time'] > last_time if descending else doc['time'] < last_time):
+                            continue
+                        last_time, last_ids = doc['time'], []
+                    elif id is not None and id in last_ids:
+                        continue
+                    last_hour = hour
+                    last_ids.append(id)
+                    logs.append(doc)
+                    if len(logs) == batch_size:
+                        yield page(logs)
+                        logs = []
+        if logs:
+            yield page(logs)
+
+    def find_availability(self, start_day, end_day, hostname=None, service=None, batch_size=1000):
+        """
+        Generator of the daily availability records from start_day to end_day (included), of all
+        the hosts/services, of an host and its services or of a service ('' for the host only)
+
+        Days are YYYY-MM-DD strings or dates. The records are sorted by host, service and day when
+        hostname is set, else by day.
+        """
+        self.check_connection()
+        if not isinstance(start_day, basestring):
+            start_day = start_day.strftime('%Y-%m-%d')
+        if not isinstance(end_day, basestring):
+            end_day = end_day.strftime('%Y-%m-%d')
+
+        query = {'day': {'$gte': start_day, '$lte': end_day}}
+        if hostname is not None:
+            query['hostname'] = hostname
+            if service is not None:
+                query['service'] = service
+            sort = [('hostname', pymongo.ASCENDING), ('service', pymongo.ASCENDING), ('day', pymongo.ASCENDING)]
+            hint = get_index_hint(self.hav_indexes, ['hostname', 'service'], 'day')
+        else:
+            sort = [('day', pymongo.ASCENDING)]
+            hint = get_index_hint(self.hav_indexes, [], 'day')
+
+        cursor = self.db[self.hav_collection].find(query, {'_id': False}, sort=sort, batch_size=batch_size)
+        if hint:
+            cursor = cursor.hint(hint)
+        for data in cursor:
+            yield data
+
+    def sum_availability(self, start_day, end_day, hostnames=None, services=None):
+        """
+        Generator of the availability of the hosts/services from start_day to end_day (included),
+        summed by the DB: hostname, service, days (number of daily records), daily_0 to daily_4
+
+        Days are YYYY-MM-DD strings. The records are optionally matched on lists of hostnames and services.
+        """
+        self.check_connection()
+        query = {'day': {'$gte': start_day, '$lte': end_day}}
+        if hostnames is not None:
+            query['hostname'] = {'$in': hostnames}
+        if services is not None:
+            query['service'] = {'$in': services}
+        group = {'_id': {'hostname': '$hostname', 'service': '$service'}, 'days': {'$sum': 1}}
+        for state in xrange(5):
+            group['daily_%d' % state] = {'$sum': '$daily_%d' % state}
+
+        for data in self.db[self.hav_collection].aggregate([{'$match': query}, {'$group': group}], allowDiskUse=True):
+            data.update(data.pop('_id'))
+            yield data
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This class is the registry of the hosts/services which availability is recorded.
+
+Items are indexed with a (host_name, service_description) tuple, service_description
+is empty for an host. The check result broks are matched with a single dictionary lookup.
+"""
+
+
+# Canonical unicode names, only byte strings may be interned
+UNICODE_NAMES = {}
+
+
+def intern_name(name):
+    """
+    Get the single instance of a host/service name
+
+    The broks names are unicode strings: they are kept in a dictionary of canonical names.
+    """
+    if isinstance(name, str):
+        return intern(name)
+    if isinstance(name, unicode):
+        return UNICODE_NAMES.setdefault(name, name)
+    return name
+
+
+class MonitoredItem(object):
+    """
+    A registered host/service and its availability state
+    """
+    __slots__ = ('hostname', 'service', 'groups', 'availability')
+
+    def __init__(self, hostname, service, groups):
+        self.hostname = hostname
+        self.service = service
+        # Host groups of an host
+        self.groups = groups
+        # Current day availability record
+        self.availability = None
+
+    def __repr__(self):
+        return "%s/%s" % (self.hostname, self.service)
+
+
+class ServicesRegistry(object):
+
+    def __init__(self):
+        self.items = {}
+        # Availability records loaded from the DB for items not yet registered
+        self.loaded = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, hostname, service=''):
+        return self.items.get((hostname, service))
+
+    def register(self, hostname, service='', groups=None):
+        """
+        Register an host/service, or get the already registered item
+        """
+        key = (intern_name(hostname), intern_name(service))
+        item = self.items.get(key)
+        if item is None:
+            item = MonitoredItem(key[0], key[1], groups)
+            item.availability = self.loaded.pop(key, None)
+            self.items[key] = item
+        elif groups is not None:
+            item.groups = groups
+        return item
+
+    def load_availability(self, records):
+        """
+        Set the loaded availability records of the items that do not yet have one
+        """
+        for data in records:
+            key = (data['hostname'], data['service'])
+            item = self.items.get(key)
+            if item is None:
+                self.loaded.setdefault(key, data)
+            elif item.availability is None or item.availability['day'] < data['day']:
+                item.availability = data
+
+    def clear_loaded(self):
+        self.loaded.clear()
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+These classes are the storage sinks of the mongo-logs module.
+
+The batches of logs, availability records and logs statistics are written by sinks. MongoDB is
+the primary storage (see MongoSink), the batches are also sent to the configured secondary sinks.
+Each sink has its own writer thread and queue: a sink is a writer target, it implements
+write_<operation>(payload) methods returning False when the batch must be retried, maintain()
+called periodically by the writer to test the connection and to rotate the stored logs according
+to the logs maximum age, and close().
+"""
+
+import time
+import json
+import socket
+import urllib2
+import datetime
+import threading
+
+from shinken.log import logger
+
+
+class Sink(object):
+    """
+    Base sink, operations which are not implemented are ignored
+    """
+    name = None
+    operations = ()
+
+    def maintain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemorySink(Sink):
+    """
+    Keep the batches in memory, a local stand-in for the tests and benchmarks
+    """
+    name = 'memory'
+    operations = ('logs', 'availability', 'logs_stats')
+
+    def __init__(self, max_logs=100000):
+        self.max_logs = max_logs
+        self.lock = threading.Lock()
+        self.logs = []
+        # (hostname, service, day) -> record
+        self.availability = {}
+        # statistics key -> count
+        self.logs_stats = {}
+
+    def write_logs(self, some_logs):
+        with self.lock:
+            self.logs.extend(some_logs)
+            del self.logs[:-self.max_logs]
+        return True
+
+    def write_availability(self, some_records):
+        with self.lock:
+            for data in some_records:
+                self.availability[(data['hostname'], data['service'], data['day'])] = data
+        return True
+
+    def write_logs_stats(self, some_stats):
+        with self.lock:
+            for data in some_stats:
+                key = tuple(sorted((k, v) for k, v in data.iteritems() if k != 'count'))
+                self.logs_stats[key] = self.logs_stats.get(key, 0) + data['count']
+        return True
+
+
+class ElasticsearchSink(Sink):
+    """
+    Index the batches in Elasticsearch with the bulk API
+
+    - logs are indexed in daily indexes: <prefix>-logs-YYYY.MM.DD
+    - availability records in the <prefix>-availability index, with a hostname/service/day id
+    - logs statistics in the <prefix>-logs-stats index, counts are incremented with a script
+    """
+    name = 'elasticsearch'
+    operations = ('logs', 'availability', 'logs_stats')
+
+    def __init__(self, uri='http://localhost:9200', prefix='shinken', doc_type='', timeout=10, max_logs_age=0):
+        self.uri = uri.rstrip('/')
+        self.prefix = prefix
+        self.doc_type = doc_type
+        self.timeout = timeout
+        self.max_logs_age = max_logs_age
+        self.next_logs_rotation = time.time()
+
+    def request(self, method, path, body=None, content_type='application/json'):
+        request = urllib2.Request(self.uri + path, body)
+        request.get_method = lambda: method
+        if body is not None:
+            request.add_header('Content-Type', content_type)
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+
+    def action(self, action, index, id=None):
+        meta = {'_index': index}
+        if self.doc_type:
+            meta['_type'] = self.doc_type
+        if id is not None:
+            meta['_id'] = id
+        return {action: meta}
+
+    def bulk(self, actions):
+        """
+        Send a list of (action, document) to the bulk API
+
+        Returns False if the request failed and must be retried
+        """
+        lines = []
+        for action, doc in actions:
+            try:
+                document = json.dumps(doc)
+            except (TypeError, ValueError), exp:
+                logger.warning("[mongo-logs] elasticsearch sink, document not indexed: %s", str(exp))
+                continue
+            lines.append(json.dumps(action))
+            lines.append(document)
+        if not lines:
+            return True
+
+        now = time.time()
+        try:
+            result = self.request('POST', '/_bulk', '\n'.join(lines) + '\n', 'application/x-ndjson')
+        except (urllib2.URLError, socket.error), exp:
+            logger.error("[mongo-logs] elasticsearch sink, bulk request failed: %s", str(exp))
+            return False
+        except Exception, exp:
+            logger.error("[mongo-logs] elasticsearch sink, bulk request error: %s", str(exp))
+            return True
+
+        if result.get('errors'):
+            errors = [item.values()[0] for item in result.get('items', []) if item.values()[0].get('error')]
+            logger.error("[mongo-logs] elasticsearch sink, %d documents not indexed: %s",
+                         len(errors), errors[0]['error'] if errors else '')
+        logger.debug("[mongo-logs] elasticsearch sink, indexed %d documents (%2.4f)", len(actions), time.time() - now)
+        return True
+
+    def logs_index(self, timestamp):
+        return '%s-logs-%s' % (self.prefix, time.strftime('%Y.%m.%d', time.localtime(timestamp)))
+
+    def write_logs(self, some_logs):
+        # The documents ids assigned by the module make the retried batches idempotent
+        actions = []
+        for log in some_logs:
+            id = log.pop('_id', None)
+            actions.append((self.action('index', self.logs_index(log['time']), str(id) if id is not None else None), log))
+        return self.bulk(actions)
+
+    def write_availability(self, some_records):
+        # The records loaded from MongoDB have an ObjectId, the hostname/service/day is the document id
+        index = '%s-availability' % self.prefix
+        actions = []
+        for data in some_records:
+            data.pop('_id', None)
+            actions.append((self.action('index', index, '%s/%s/%s' % (data['hostname'], data['service'], data['day'])), data))
+        return self.bulk(actions)
+
+    def write_logs_stats(self, some_stats):
+        index = '%s-logs-stats' % self.prefix
+        actions = []
+        for data in some_stats:
+            id = '%(period)s/%(time)d/%(host_name)s/%(service_description)s/%(logclass)d/%(type)s/%(state)s' % data
+            actions.append((self.action('update', index, id), {
+                'script': {'source': 'ctx._source.count += params.count', 'params': {'count': data['count']}},
+                'upsert': data
+            }))
+        return self.bulk(actions)
+
+    def maintain(self):
+        """
+        Delete the daily logs indexes older than the logs maximum age, once a day
+        """
+        if not self.max_logs_age or self.next_logs_rotation > time.time():
+            return
+        self.next_logs_rotation = time.time() + 86400
+
+        oldest = (datetime.date.today() - datetime.timedelta(days=self.max_logs_age)).strftime('%Y.%m.%d')
+        pattern = '%s-logs-' % self.prefix
+        try:
+            for index in self.request('GET', '/_cat/indices/%s*?format=json&h=index' % pattern):
+                name = index['index']
+                day = name[len(pattern):]
+                if len(day) == 10 and day < oldest:
+                    self.request('DELETE', '/' + name)
+                    logger.info("[mongo-logs] elasticsearch sink, deleted index %s", name)
+        except Exception, exp:
+            logger.error("[mongo-logs] elasticsearch sink, logs rotation failed: %s", str(exp))
+            self.next_logs_rotation = time.time() + 600
+
+
+def create_sink(name, mod_conf, max_logs_age=0):
+    """
+    Create a secondary sink from the module configuration
+    """
+    if name == MemorySink.name:
+        return MemorySink()
+
+    if name == ElasticsearchSink.name:
+        uri = getattr(mod_conf, 'elasticsearch_uri', 'http://localhost:9200')
+        prefix = getattr(mod_conf, 'elasticsearch_index_prefix', 'shinken')
+        doc_type = getattr(mod_conf, 'elasticsearch_doc_type', '')
+        timeout = int(getattr(mod_conf, 'elasticsearch_timeout', '10'))
+        logger.info('[mongo-logs] elasticsearch sink: %s, indexes prefix: %s', uri, prefix)
+        return ElasticsearchSink(uri, prefix, doc_type, timeout, max_logs_age)
+
+    logger.error('[mongo-logs] unknown sink: %s, must be one of %s', name, [MemorySink.name, ElasticsearchSink.name])
+    return None
@@ -0,0 +1,283 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This class is an on-disk spool for the mongo-logs module.
+
+The spool is an append-only list of segment files stored in a directory. Each segment
+contains BSON records, a BSON document being prefixed with its own length. Records are
+read back in the order they were appended; a segment is removed once all its records
+are read and acknowledged. The read position is stored in a checkpoint file so that a
+module restart continues where it stopped.
+"""
+
+import os
+import struct
+import threading
+
+from bson import BSON
+from shinken.log import logger
+
+
+# Fsync policies
+FSYNC_ALWAYS = 'always'
+FSYNC_SEGMENT = 'segment'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = [FSYNC_ALWAYS, FSYNC_SEGMENT, FSYNC_NEVER]
+
+SEGMENT_SUFFIX = '.spool'
+CHECKPOINT_FILE = 'spool.checkpoint'
+
+
+class Spool(object):
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_size=1024 * 1024 * 1024, fsync=FSYNC_SEGMENT):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync = fsync
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Existing segments, a new segment is always started for writing
+        self.segments = sorted(int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(self.directory)
+                               if f.endswith(SEGMENT_SUFFIX))
+        self.size = sum(os.path.getsize(self.segment_path(s)) for s in self.segments)
+
+        self.read_segment, self.read_offset = self.load_checkpoint()
+        self.read_file = None
+        self.next_record = None
+
+        self.write_segment = (self.segments[-1] if self.segments else 0) + 1
+        self.write_file = None
+        self.write_offset = 0
+
+        # Metrics
+        self.appended_records = 0
+        self.read_records = 0
+        self.dropped_records = 0
+
+        if self.segments:
+            logger.info("[mongo-logs] spool %s contains %d segments (%d bytes)", self.directory, len(self.segments), self.size)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, '%012d%s' % (segment, SEGMENT_SUFFIX))
+
+    def load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                segment, offset = [int(v) for v in f.read().split()]
+            if segment in self.segments:
+                return segment, offset
+        except (IOError, ValueError):
+            pass
+        return (self.segments[0] if self.segments else 0), 0
+
+    def save_checkpoint(self):
+        filename = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(filename + '.tmp', 'w') as f:
+            f.write('%d %d' % (self.read_segment, self.read_offset))
+        os.rename(filename + '.tmp', filename)
+
+    def empty(self):
+        return not self.segments or (self.read_segment == self.write_segment and self.read_offset >= self.write_offset)
+
+    def append(self, record):
+        """
+        Append a record (a dictionary) to the spool
+
+        Returns False if the record could not be stored
+        """
+        data = BSON.encode(record)
+        with self.lock:
+            if self.write_file is None or self.write_offset + len(data) > self.segment_size and self.write_offset:
+                self.open_segment()
+
+            while self.size + len(data) > self.max_size:
+                if not self.drop_oldest_segment():
+                    self.dropped_records += 1
+                    logger.error("[mongo-logs] spool %s is full, record dropped", self.directory)
+                    return False
+
+            self.write_file.write(data)
+            self.write_file.flush()
+            if self.fsync == FSYNC_ALWAYS:
+                os.fsync(self.write_file.fileno())
+            self.write_offset += len(data)
+            self.size += len(data)
+            self.appended_records += 1
+        return True
+
+    def prepend(self, records):
+        """
+        Insert records (dictionaries) before the records of the spool, in their order
+
+        The records are written in a new segment, followed by the records of the read segment
+        not read yet; this new segment replaces the read segment. The spool may exceed its
+        maximum size by these records.
+        """
+        if self.empty():
+            for record in records:
+                self.append(record)
+            return
+
+        data = ''.join(BSON.encode(record) for record in records)
+        with self.lock:
+            self.close_reader()
+            filename = self.segment_path(self.read_segment)
+            if self.read_segment == self.write_segment and self.write_file is not None:
+                # The next records are appended to a new segment
+                self.write_file.close()
+                self.write_file = None
+                self.write_segment += 1
+            with open(filename, 'rb') as f:
+                f.seek(self.read_offset)
+                data += f.read()
+
+            segment = self.segments[0] - 1
+            with open(self.segment_path(segment) + '.tmp', 'wb') as f:
+                f.write(data)
+                if self.fsync != FSYNC_NEVER:
+                    os.fsync(f.fileno())
+            os.rename(self.segment_path(segment) + '.tmp', self.segment_path(segment))
+            self.segments.insert(0, segment)
+            self.size += len(data)
+            # Read from the new segment
+            self.remove_segment(self.read_segment)
+
+    def open_segment(self):
+        if self.write_file is not None:
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self.write_file.fileno())
+            self.write_file.close()
+            self.write_segment += 1
+
+        self.write_file = open(self.segment_path(self.write_segment), 'ab')
+        self.write_offset = 0
+        if not self.segments:
+            self.read_segment, self.read_offset = self.write_segment, 0
+        self.segments.append(self.write_segment)
+
+    def drop_oldest_segment(self):
+        """
+        Remove the oldest segment to free some room, the current write segment is never removed
+        """
+        if len(self.segments) < 2:
+            return False
+
+        segment = self.segments[0]
+        filename = self.segment_path(segment)
+        logger.error("[mongo-logs] spool %s is full, dropped the oldest segment %s", self.directory, filename)
+        self.remove_segment(segment)
+        return True
+
+    def remove_segment(self, segment):
+        filename = self.segment_path(segment)
+        if segment == self.read_segment:
+            self.close_reader()
+        self.size -= os.path.getsize(filename)
+        os.remove(filename)
+        self.segments.remove(segment)
+        if segment == self.read_segment:
+            self.read_segment = self.segments[0] if self.segments else self.write_segment
+            self.read_offset = 0
+            self.save_checkpoint()
+
+    def close_reader(self):
+        if self.read_file is not None:
+            self.read_file.close()
+        self.read_file = None
+        self.next_record = None
+
+    def peek(self):
+        """
+        Get the oldest record of the spool without removing it, or None if the spool is empty
+        """
+        with self.lock:
+            while self.next_record is None:
+                if self.empty():
+                    return None
+
+                if self.read_file is None:
+                    self.read_file = open(self.segment_path(self.read_segment), 'rb')
+                self.read_file.seek(self.read_offset)
+                header = self.read_file.read(4)
+                data = None
+                if len(header) == 4:
+                    length = struct.unpack('<i', header)[0]
+                    data = header + self.read_file.read(length - 4)
+                    if len(data) != length:
+                        data = None
+
+                if data is None:
+                    if self.read_segment == self.write_segment:
+                        # Record is being written ...
+                        return None
+                    if self.read_offset < os.path.getsize(self.segment_path(self.read_segment)):
+                        logger.warning("[mongo-logs] spool segment %s is truncated", self.segment_path(self.read_segment))
+                    self.remove_segment(self.read_segment)
+                    continue
+
+                try:
+                    self.next_record = (BSON(data).decode(), len(data))
+                except Exception, exp:
+                    logger.error("[mongo-logs] invalid spool record in %s: %s", self.segment_path(self.read_segment), str(exp))
+                    self.dropped_records += 1
+                    self.read_offset += len(data)
+
+            return self.next_record[0]
+
+    def ack(self):
+        """
+        Remove the oldest record, returned by peek, from the spool
+        """
+        with self.lock:
+            if self.next_record is None:
+                return
+            self.read_offset += self.next_record[1]
+            self.next_record = None
+            self.read_records += 1
+            self.save_checkpoint()
+
+    def stats(self):
+        return {
+            'spool_segments': len(self.segments),
+            'spool_size': self.size,
+            'spool_appended_records': self.appended_records,
+            'spool_read_records': self.read_records,
+            'spool_dropped_records': self.dropped_records
+        }
+
+    def close(self):
+        with self.lock:
+            self.close_reader()
+            if self.write_file is not None:
+                if self.fsync != FSYNC_NEVER:
+                    os.fsync(self.write_file.fileno())
+                self.write_file.close()
+                self.write_file = None
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This class is the background writer of the mongo-logs module.
+
+The broks management loop only prepares batches of documents and queues them
+in a bounded queue. The writer thread owns the database operations: it writes
+the queued batches, tests the DB connection and rotates the logs.
+"""
+
+import time
+import random
+import threading
+import Queue
+
+from shinken.log import logger
+
+
+# Overflow policies when the writer queue is full
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL]
+
+# Operations which jobs may be spilled to the spool
+SPOOLED_OPERATIONS = ['logs', 'availability', 'logs_stats']
+
+# Operations which jobs wait for the spooled jobs to be replayed: the availability records
+# are loaded once the spooled availability records are stored
+DEFERRED_OPERATIONS = ['availability_load']
+
+
+class MongoLogsWriter(threading.Thread):
+    """
+    A batch queued for the writer is a job: (operation, payload)
+
+    The writer calls the module write_<operation>(payload) method for each job. This method
+    returns True if the job is done (or can not be done and must be dropped) and False if it
+    is to be retried later, for instance when the DB connection is not available.
+
+    A job that failed is retried after an exponential backoff delay, from retry_min_delay up to
+    retry_max_delay seconds, with a random jitter so that several writers do not retry together.
+
+    With the spill overflow policy, the jobs that do not fit in the queue are appended to
+    the spool. Once the spool is not empty, all the new jobs are appended to the spool to
+    keep them in order, until the writer has replayed the spooled jobs. The jobs of the
+    DEFERRED_OPERATIONS wait until the spooled jobs are replayed.
+    """
+
+    def __init__(self, module, queue_size=100, overflow=OVERFLOW_BLOCK, spool=None, replay_rate=0, retry_min_delay=1,
+                 retry_max_delay=60, name='mongo-logs-writer'):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+
+        self.module = module
+        self.queue = Queue.Queue(queue_size)
+        self.overflow = overflow
+        self.spool = spool if overflow == OVERFLOW_SPILL else None
+        self.replay_rate = replay_rate
+        self.retry_min_delay = retry_min_delay
+        self.retry_max_delay = retry_max_delay
+        self.stopping = False
+        # Set to interrupt a retry delay when stopping
+        self.wakeup = threading.Event()
+
+        # Job currently retried because it could not be written
+        self.pending = None
+        self.pending_spooled = False
+        # Job waiting for the spooled jobs to be replayed
+        self.deferred = None
+        # Consecutive failures of the pending job
+        self.retries = 0
+
+        # Metrics
+        self.written_jobs = 0
+        self.failed_jobs = 0
+        self.dropped_jobs = 0
+        self.spilled_jobs = 0
+        # Jobs not queued because the queue was full, kept by the caller
+        self.rejected_jobs = 0
+        self.flush_count = 0
+        self.flush_latency_total = 0.0
+        self.flush_latency_last = 0.0
+        self.flush_latency_max = 0.0
+
+    def submit(self, operation, payload, timeout=0):
+        """
+        Queue a job for the writer thread, applying the overflow policy if the queue is full
+
+        With the block policy, and for the jobs which are not spooled, the caller waits at most timeout
+        seconds for room in the queue. Returns False if the job was not queued: the caller keeps it
+        and submits it again later.
+        """
+        job = (operation, payload)
+        if self.spool is not None and operation in SPOOLED_OPERATIONS and not self.spool.empty():
+            self.spill(job)
+            return True
+
+        if self.overflow == OVERFLOW_BLOCK or operation not in SPOOLED_OPERATIONS:
+            try:
+                if timeout > 0:
+                    self.queue.put(job, timeout=timeout)
+                else:
+                    self.queue.put_nowait(job)
+            except Queue.Full:
+                self.rejected_jobs += 1
+                return False
+            return True
+
+        try:
+            self.queue.put_nowait(job)
+            return True
+        except Queue.Full:
+            pass
+
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            self.drop_oldest(job)
+            return True
+
+        # Spill to disk ...
+        self.spill(job)
+        return True
+
+    def drop_oldest(self, job):
+        """
+        Queue a job in the full queue in place of the oldest queued job of a spooled operation
+
+        The jobs of the other operations, such as the availability load, are never dropped: if the
+        queue only holds such jobs, the new job is dropped.
+        """
+        queue = self.queue
+        with queue.mutex:
+            if queue._qsize() >= queue.maxsize > 0:
+                for index, queued in enumerate(queue.queue):
+                    if queued[0] in SPOOLED_OPERATIONS:
+                        del queue.queue[index]
+                        break
+                else:
+                    self.dropped_jobs += 1
+                    logger.warning("[mongo-logs] writer queue is full, dropped a %s job", job[0])
+                    return
+                self.dropped_jobs += 1
+                logger.warning("[mongo-logs] writer queue is full, dropped the oldest %s job", queued[0])
+            else:
+                queue.unfinished_tasks += 1
+            queue.queue.append(job)
+            queue.not_empty.notify()
+
+    def spill(self, job):
+        operation, payload = job
+        try:
+            if self.spool.append({'operation': operation, 'payload': payload}):
+                self.spilled_jobs += 1
+                logger.debug("[mongo-logs] spilled a %s job to the spool", operation)
+                return
+        except Exception, exp:
+            logger.error("[mongo-logs] could not spill a %s job to the spool: %s", operation, str(exp))
+        self.dropped_jobs += 1
+
+    def respill(self, jobs):
+        """
+        Spill the jobs not written when the writer stops
+
+        These jobs are older than the spilled jobs, they are stored before them to be replayed first.
+        """
+        try:
+            self.spool.prepend([{'operation': operation, 'payload': payload} for operation, payload in jobs])
+            self.spilled_jobs += len(jobs)
+        except Exception, exp:
+            logger.error("[mongo-logs] could not spill %d jobs to the spool: %s", len(jobs), str(exp))
+            self.dropped_jobs += len(jobs)
+
+    def unspill(self):
+        """
+        Get the oldest spilled job, if any
+        """
+        if self.spool is None:
+            return None
+
+        record = self.spool.peek()
+        if record is None:
+            return None
+        return (record['operation'], record['payload'])
+
+    def stats(self):
+        """
+        Get the writer metrics
+        """
+        stats = {
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue.maxsize,
+            'written_jobs': self.written_jobs,
+            'failed_jobs': self.failed_jobs,
+            'retries': self.retries,
+            'dropped_jobs': self.dropped_jobs,
+            'spilled_jobs': self.spilled_jobs,
+            'rejected_jobs': self.rejected_jobs,
+            'flush_latency_last': self.flush_latency_last,
+            'flush_latency_max': self.flush_latency_max,
+            'flush_latency_avg': self.flush_latency_total / self.flush_count if self.flush_count else 0.0
+        }
+        if self.spool is not None:
+            stats.update(self.spool.stats())
+        return stats
+
+    def execute(self, job):
+        operation, payload = job
+        now = time.time()
+        try:
+            done = getattr(self.module, 'write_' + operation)(payload)
+        except Exception, exp:
+            logger.error("[mongo-logs] writer exception for %s: %s", operation, str(exp))
+            done = True
+        latency = time.time() - now
+
+        self.flush_count += 1
+        self.flush_latency_total += latency
+        self.flush_latency_last = latency
+        self.flush_latency_max = max(self.flush_latency_max, latency)
+        if done:
+            self.written_jobs += 1
+        else:
+            self.failed_jobs += 1
+        return done
+
+    def stop(self, timeout=None):
+        """
+        Request the writer to stop once all the queued jobs are written
+        """
+        self.stopping = True
+        self.wakeup.set()
+        self.join(timeout)
+
+    def retry_delay(self):
+        """
+        Get the delay before retrying the pending job: doubled after each failure, with jitter
+        """
+        delay = min(self.retry_max_delay, self.retry_min_delay * 2 ** min(self.retries - 1, 16))
+        return delay * random.uniform(0.5, 1.0)
+
+    def next_job(self):
+        """
+        Get the next job to write and whether it comes from the spool
+        """
+        if self.pending is not None:
+            return self.pending, self.pending_spooled
+
+        if self.deferred is not None and self.spool.empty():
+            job, self.deferred = self.deferred, None
+            return job, False
+
+        try:
+            return self.queue.get_nowait(), False
+        except Queue.Empty:
+            pass
+
+        if self.stopping:
+            return None, False
+
+        # Spilled jobs are replayed when the queue is empty
+        job = self.unspill()
+        if job is not None:
+            return job, True
+
+        try:
+            return self.queue.get(timeout=1), False
+        except Queue.Empty:
+            return None, False
+
+    def run(self):
+        logger.info("[mongo-logs] writer thread %s started", self.name)
+
+        while True:
+            self.module.maintain()
+
+            job, spooled = self.next_job()
+            if job is None:
+                if self.stopping:
+                    break
+                continue
+
+            if job[0] in DEFERRED_OPERATIONS and not spooled and self.spool is not None and not self.spool.empty():
+                logger.info("[mongo-logs] %s job deferred until the spooled jobs are replayed", job[0])
+                self.deferred = job
+                continue
+
+            if self.execute(job):
+                self.pending = None
+                self.retries = 0
+                if spooled:
+                    self.spool.ack()
+                    # Replay rate limit, in documents per second
+                    if self.replay_rate and isinstance(job[1], list):
+                        time.sleep(float(len(job[1])) / self.replay_rate)
+            else:
+                self.pending, self.pending_spooled = job, spooled
+                self.retries += 1
+                if self.stopping:
+                    break
+                delay = self.retry_delay()
+                logger.debug("[mongo-logs] %s job failed %d times, retry in %.1fs", job[0], self.retries, delay)
+                self.wakeup.wait(delay)
+
+        # Jobs that could not be written before stopping, spooled jobs are still in the spool
+        remaining = [self.pending] if self.pending and not self.pending_spooled else []
+        while True:
+            try:
+                remaining.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        remaining = [job for job in remaining if job[0] in SPOOLED_OPERATIONS]
+        if remaining:
+            if self.spool is not None:
+                self.respill(remaining)
+            else:
+                logger.error("[mongo-logs] writer stopped, %d jobs could not be written", len(remaining))
+
+        if self.spool is not None:
+            self.spool.close()
+
+        # Close database connection
+        self.module.close()
+        logger.info("[mongo-logs] writer thread %s stopped", self.name)
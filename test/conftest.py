@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Fixtures of the mongo-logs module tests.
+
+Shinken must be importable (PYTHONPATH). The database is a mongomock client shared by all
+the connections of a test, the tests which need it are skipped when mongomock is not installed.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from shinken.objects.module import Module
+
+
+def module_conf(**options):
+    """
+    Get a mongo-logs module configuration, options are the module configuration parameters
+    """
+    params = {'module_name': 'mongo-logs', 'module_type': 'mongo-logs'}
+    params.update((name, str(value)) for name, value in options.iteritems())
+    return Module(params)
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """
+    A mongomock client, returned by the module for every DB connection
+    """
+    mongomock = pytest.importorskip('mongomock')
+    from module import mongo_sink
+
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(mongo_sink, 'MongoClient', lambda *args, **kwargs: client)
+    return client
@@ -0,0 +1,17 @@
+#!/bin/bash
+# Get Shinken and the Python packages needed by the module tests
+#
+# Shinken is cloned in ~/shinken, add it to the PYTHONPATH to run the tests:
+#    export PYTHONPATH=$PYTHONPATH:~/shinken
+#    py.test -v test
+
+set -e
+
+MODULE_DIR=$(cd $(dirname $0)/.. && pwd)
+
+if [ ! -d ~/shinken ]; then
+    git clone --depth 1 --branch 2.4.3 https://github.com/naparuba/shinken.git ~/shinken
+fi
+pip install -r ~/shinken/requirements.txt
+pip install -r $MODULE_DIR/requirements.txt
+pip install -r $MODULE_DIR/test/requirements.txt
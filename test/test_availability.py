@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""
+Availability tests: the accounting of the check results in the daily records, the check results
+received before the current day records are loaded from the DB update the stored records, the
+items are registered while the records are loaded.
+"""
+
+import time
+import datetime
+import threading
+
+import pytest
+
+from shinken.brok import Brok
+
+from conftest import module_conf
+from module.module import MongoLogs
+from module.availability import Day, new_record, record_check, close_record, percentages
+from module.writer import MongoLogsWriter
+
+
+DAY = Day(datetime.date(2015, 10, 16))
+
+
+def daily(data):
+    return [data['daily_%d' % state] for state in xrange(5)]
+
+
+def test_record_check():
+    data = new_record('host-1', '', DAY)
+    assert daily(data) == [0, 0, 0, 0, len(DAY)]
+
+    # First check: the state is known since its last change, before the day start
+    record_check(data, DAY, 0, DAY.start + 100, DAY.start - 3600)
+    assert daily(data) == [100, 0, 0, 0, len(DAY) - 100]
+    assert data['first_check_state'] == 0
+    assert data['first_check_timestamp'] == DAY.start + 100
+
+    # Same state
+    record_check(data, DAY, 0, DAY.start + 200, DAY.start - 3600)
+    # State change between the checks: the seconds are split at the change time
+    record_check(data, DAY, 2, DAY.start + 300, DAY.start + 250)
+    assert daily(data) == [250, 0, 50, 0, len(DAY) - 300]
+    # State changed before the accounted time: the previous state is not reliable
+    record_check(data, DAY, 1, DAY.start + 400, DAY.start + 200)
+    assert daily(data) == [250, 100, 50, 0, len(DAY) - 400]
+    # Older than the accounted time, ignored
+    record_check(data, DAY, 0, DAY.start + 350, DAY.start + 350)
+    assert daily(data) == [250, 100, 50, 0, len(DAY) - 400]
+    assert data['last_check_state'] == 1
+    assert data['last_check_timestamp'] == DAY.start + 400
+
+
+def test_day_rollover():
+    data = record_check(new_record('host-1', 'Load', DAY), DAY, 2, DAY.end - 100, DAY.end - 1000)
+    # The last state lasts until midnight
+    close_record(data, DAY)
+    assert daily(data) == [0, 0, 1000, 0, len(DAY) - 1000]
+    assert data['last_check_timestamp'] == DAY.end
+
+    # The next day starts in the last state
+    next_day = DAY.next()
+    data = new_record('host-1', 'Load', next_day, data)
+    assert data['day'] == next_day.name
+    assert data['last_check_state'] == 2
+    assert 'first_check_timestamp' not in data
+    record_check(data, next_day, 0, next_day.start + 600, next_day.start + 500)
+    assert daily(data) == [100, 0, 500, 0, len(next_day) - 600]
+
+
+def test_percentages():
+    data = close_record(record_check(new_record('host-1', '', DAY), DAY, 0, DAY.start, DAY.start - 60), DAY)
+    assert percentages(data)['percent_0'] == 100.0
+    data = {'daily_0': 3, 'daily_1': 0, 'daily_2': 1, 'daily_3': 0, 'daily_4': 0}
+    assert [percentages(data)['percent_%d' % state] for state in xrange(5)] == [75.0, 0.0, 25.0, 0.0, 0.0]
+
+
+def host_check(timestamp, state, change):
+    return Brok('host_check_result', {
+        'host_name': 'host-1', 'state_id': state, 'last_chk': timestamp,
+        'last_state_change': change, 'in_scheduled_downtime': False
+    })
+
+
+def test_checks_held_until_loaded(mongo):
+    day = Day.today()
+    now = int(time.time())
+    if day.end - now < 300:
+        pytest.skip("the day ends during the test")
+    t0 = max(day.start + 10, now - 7200)
+
+    # Stored before the module restart: the host is down since the day start
+    stored = {
+        'hostname': 'host-1', 'service': '', 'day': day.name, 'day_ts': day.start, 'is_downtime': '0',
+        'daily_0': 0, 'daily_1': 0, 'daily_2': t0 - day.start, 'daily_3': 0, 'daily_4': len(day) - (t0 - day.start),
+        'first_check_state': 2, 'first_check_timestamp': day.start,
+        'last_check_state': 2, 'last_check_timestamp': t0
+    }
+    module = MongoLogs(module_conf(services_filter='bi:>=0'))
+    module.storage.open()
+    module.storage.write_availability([dict(stored)])
+
+    # The day load is queued, the writer is not started yet
+    module.writer = MongoLogsWriter(module.storage)
+    module.load_availability()
+    module.manage_broks([Brok('initial_host_status', {'host_name': 'host-1', 'business_impact': 3})])
+    # The host is up since t0 + 30
+    module.manage_broks([host_check(t0 + 60, 0, t0 + 30)])
+    for i in xrange(100):
+        module.manage_broks([host_check(t0 + 120 + i, 0, t0 + 30)])
+    item = module.services_cache.get('host-1')
+    assert item.availability is None
+    # Consecutive checks in the same state are collapsed
+    assert len(module.pending_checks[item]) == 2
+
+    module.writer.start()
+    deadline = time.time() + 5
+    while not module.is_availability_loaded() and time.time() < deadline:
+        time.sleep(0.05)
+    assert module.is_availability_loaded()
+    module.record_pending_checks()
+    module.commit_availability()
+    module.writer.stop(5)
+
+    records = list(module.storage.db[module.storage.hav_collection].find({}, {'_id': False}))
+    assert len(records) == 1
+    record = records[0]
+    # The stored record is updated, not replaced
+    assert record['first_check_timestamp'] == day.start
+    assert record['daily_2'] == stored['daily_2'] + 30
+    assert record['daily_0'] == 219 - 30
+    assert record['last_check_state'] == 0
+    assert record['last_check_timestamp'] == t0 + 219
+
+
+def test_register_waits_for_the_loading(mongo):
+    module = MongoLogs(module_conf(services_filter='bi:>=0'))
+    brok = Brok('initial_host_status', {'host_name': 'host-1', 'business_impact': 3})
+    brok.prepare()
+
+    # The writer thread is loading the records of the day
+    module.availability_lock.acquire()
+    registering = threading.Thread(target=module.manage_brok, args=(brok, ))
+    registering.start()
+    registering.join(0.2)
+    assert registering.is_alive()
+    assert module.services_cache.get('host-1') is None
+    module.availability_lock.release()
+    registering.join(5)
+    assert module.services_cache.get('host-1') is not None
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Availability backfill tool tests
+"""
+
+import os
+import sys
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+import backfill_availability
+from module.availability import Day
+
+
+DAY = Day(datetime.date(2015, 10, 16))
+
+
+class Options(object):
+
+    def __init__(self, checkpoint_dir, **options):
+        self.uri = 'mongodb://localhost'
+        self.database = 'shinken'
+        self.logs_collection = 'logs'
+        self.logs_retention = 'delete'
+        self.storage_schema = 'full'
+        self.hav_collection = 'availability'
+        self.start = DAY.name
+        self.end = DAY.next().next().name
+        self.overwrite = False
+        self.workers = 1
+        self.hosts_batch = 2
+        self.batch_size = 1000
+        self.checkpoint_dir = checkpoint_dir
+        self.__dict__.update(options)
+
+
+@pytest.fixture
+def db(mongo, monkeypatch):
+    monkeypatch.setattr(backfill_availability, 'MongoClient', lambda *args, **kwargs: mongo)
+    for n in xrange(5):
+        host_name = 'host-%d' % n
+        mongo.shinken.logs.insert_many([
+            {'host_name': host_name, 'service_description': '', 'time': DAY.start + 3600,
+             'type': 'CURRENT HOST STATE', 'state': 'UP'},
+            {'host_name': host_name, 'service_description': '', 'time': DAY.start + 7200,
+             'type': 'HOST ALERT', 'state': 1},
+            {'host_name': host_name, 'service_description': '', 'time': DAY.start + 9000,
+             'type': 'HOST NOTIFICATION', 'state': 1},
+        ])
+    return mongo.shinken
+
+
+def checkpoint(tmpdir):
+    with open(os.path.join(str(tmpdir), backfill_availability.CHECKPOINT_FILE)) as f:
+        return f.read().split()
+
+
+def test_backfill(db, tmpdir):
+    backfill_availability.Backfill(Options(str(tmpdir))).run()
+
+    records = list(db.availability.find({'hostname': 'host-0'}, {'_id': False}).sort('day', 1))
+    assert [data['day'] for data in records] == [DAY.name, DAY.next().name]
+    first, second = records
+    assert first['daily_0'] == 3600
+    assert first['daily_1'] == len(DAY) - 7200
+    assert first['first_check_timestamp'] == DAY.start + 3600
+    # The down state lasts during the next day, without events
+    assert second['daily_1'] == len(DAY.next())
+    assert sorted(checkpoint(tmpdir)) == ['host-%d' % n for n in xrange(5)]
+
+    # The existing records are kept
+    db.availability.update_many({}, {'$set': {'daily_0': 0}})
+    backfill_availability.Backfill(Options(str(tmpdir.join('keep')))).run()
+    assert db.availability.count_documents({'daily_0': {'$ne': 0}}) == 0
+    backfill_availability.Backfill(Options(str(tmpdir.join('overwrite')), overwrite=True)).run()
+    assert db.availability.find_one({'hostname': 'host-0', 'day': DAY.name})['daily_0'] == 3600
+
+
+def test_resume(db, tmpdir):
+    # Interrupted run: the checkpoint does not depend on the number of workers
+    with open(os.path.join(str(tmpdir), backfill_availability.CHECKPOINT_FILE), 'w') as f:
+        f.write('host-1\nhost-3\n')
+    backfill_availability.Backfill(Options(str(tmpdir), workers=3)).run()
+    assert sorted(checkpoint(tmpdir)) == ['host-%d' % n for n in xrange(5)]
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Logs commit tests: the whole backlog is queued by batches within the commit time budget,
+and the commit period adapts to the received lines volume
+"""
+
+import time
+
+from conftest import module_conf
+from module.module import MongoLogs
+from module.writer import MongoLogsWriter
+
+
+def make_module(queue_size=100, **options):
+    module = MongoLogs(module_conf(**options))
+    module.writer = MongoLogsWriter(module.storage, queue_size=queue_size)
+    return module
+
+
+def queue_logs(module, count):
+    for n in xrange(count):
+        module.logs_cache.append({'time': 1445000000 + n, 'n': n})
+
+
+def queued(module):
+    return [[values['n'] for values in payload] for operation, payload in module.writer.queue.queue]
+
+
+def test_commit_whole_backlog():
+    module = make_module(commit_volume=100)
+    queue_logs(module, 250)
+    assert module.commit_logs() == 250
+    assert not module.logs_cache
+    assert queued(module) == [range(0, 100), range(100, 200), range(200, 250)]
+    # Documents ids are assigned before the batches are queued
+    for operation, payload in module.writer.queue.queue:
+        assert all('_id' in values for values in payload)
+
+
+def test_commit_time_budget():
+    module = make_module(queue_size=2, commit_volume=100, commit_time_budget='0.2')
+    queue_logs(module, 500)
+    now = time.time()
+    assert module.commit_logs() == 500
+    assert time.time() - now < 1
+    # The writer queue is full, the remaining lines are kept in order for the next commit
+    assert queued(module) == [range(0, 100), range(100, 200)]
+    assert [values['n'] for values in module.logs_cache] == range(200, 500)
+
+
+def test_commit_period():
+    module = make_module(commit_period=60, commit_min_period=5, commit_volume=1000)
+    assert module.get_commit_period(0) == 60
+    assert module.get_commit_period(1000) == 60
+    assert module.get_commit_period(4000) == 15
+    assert module.get_commit_period(100000) == 5
+    # Lines still waiting for the next commit
+    queue_logs(module, 10)
+    assert module.get_commit_period(10) == 5
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Reconnection and failover tests: the batches are retried after a connection loss without
+duplicates, and the module does not wait for the writer while the DB is not available
+"""
+
+import time
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+from conftest import module_conf
+from module.module import MongoLogs
+from module import mongo_sink
+from module.mongo_sink import CONNECTED, SWITCHING
+from module.writer import MongoLogsWriter
+
+
+def make_module(**options):
+    module = MongoLogs(module_conf(**options))
+    module.writer = MongoLogsWriter(module.storage, queue_size=1)
+    assert module.storage.open()
+    return module
+
+
+def commit(module, count):
+    for n in xrange(count):
+        module.logs_cache.append({'time': 1445000000 + n, 'host_name': 'host-1', 'n': n})
+    module.commit_logs()
+    operation, payload = module.writer.queue.get_nowait()
+    return payload
+
+
+def test_retried_batch_not_duplicated(mongo):
+    module = make_module()
+    some_logs = commit(module, 5)
+    assert module.storage.write_logs([dict(values) for values in some_logs[:2]])
+    # The whole batch is retried after a failover, the inserted logs are duplicates
+    assert module.storage.write_logs(some_logs)
+    assert sorted(doc['n'] for doc in mongo.shinken.logs.find()) == range(5)
+    assert module.metrics.get('log_lines_duplicates_total') == 2
+    assert module.metrics.get('log_lines_inserted_total') == 7 - 2
+    assert module.metrics.get('log_lines_dropped_total') == 0
+
+
+def test_connection_lost(mongo, monkeypatch):
+    module = make_module()
+    some_logs = commit(module, 3)
+    collection = type(mongo.shinken.logs)
+    insert_many = collection.insert_many
+
+    def not_primary(self, *args, **kwargs):
+        raise AutoReconnect('not master')
+
+    monkeypatch.setattr(collection, 'insert_many', not_primary)
+    assert not module.storage.write_logs(some_logs)
+    assert module.storage.is_connected == SWITCHING
+    assert module.metrics.get('db_connection_errors_total', 'logs') == 1
+
+    # The module does not wait for the full writer queue while the DB is not available
+    module.writer.submit('logs', some_logs)
+    now = time.time()
+    assert not module.submit('logs', some_logs, timeout=5)
+    assert time.time() - now < 1
+
+    # Retried once the primary is available
+    monkeypatch.setattr(collection, 'insert_many', insert_many)
+    assert module.storage.write_logs(some_logs)
+    assert module.storage.is_connected == CONNECTED
+    assert mongo.shinken.logs.count_documents({}) == 3
+
+
+class Description(object):
+
+    def __init__(self, writable):
+        self.writable = writable
+        self.topology_type_name = 'ReplicaSetWithPrimary' if writable else 'ReplicaSetNoPrimary'
+
+    def has_writable_server(self):
+        return self.writable
+
+
+class Event(object):
+
+    def __init__(self, previous, new):
+        self.previous_description = Description(previous)
+        self.new_description = Description(new)
+
+
+def test_failovers_counted():
+    if mongo_sink.TopologyListener is None:
+        pytest.skip("pymongo has no topology monitoring")
+    module = MongoLogs(module_conf())
+    listener = mongo_sink.TopologyLogger(module.metrics)
+    listener.description_changed(Event(True, False))
+    listener.description_changed(Event(False, False))
+    listener.description_changed(Event(False, True))
+    assert module.metrics.get('db_failovers_total') == 1
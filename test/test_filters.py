@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""
+Services and log lines filters tests
+"""
+
+import pytest
+
+from module.filters import ServicesFilter, LogLinesFilter, REJECT_NOT_STORED, REJECT_INVALID, REJECT_EXCLUDED
+
+
+def test_services_filter_empty():
+    services_filter = ServicesFilter('')
+    assert not services_filter
+    assert not services_filter.match('host/Load', 5)
+
+
+@pytest.mark.parametrize('rule,service_id,bi,hostgroups,servicegroups,expected', [
+    # Regexps, not case sensitive, combined
+    ('^Load, Disk', 'host/Load', 2, (), (), False),
+    ('/Load, Disk', 'host/load', 2, (), (), True),
+    ('/Load, Disk', 'host/Disk /var', 2, (), (), True),
+    ('re:/Load, service_description:/Disk', 'host/Http', 2, (), (), False),
+    # Regexps with backreferences are not combined
+    ('(o)\\1, Disk', 'host/Pool', 2, (), (), True),
+    ('(o)\\1, Disk', 'host/Disk', 2, (), (), True),
+    ('(o)\\1, Disk', 'host/Load', 2, (), (), False),
+    # Business impact
+    ('bi:>4', 'host/Load', 5, (), (), True),
+    ('bi:>4', 'host/Load', 4, (), (), False),
+    ('bp:>=4', 'host/Load', 4, (), (), True),
+    ('bi:<2', 'host/Load', 1, (), (), True),
+    ('bi:<=2', 'host/Load', 3, (), (), False),
+    ('bi:=0', 'host/Load', 0, (), (), True),
+    # Groups
+    ('hg:linux, hg:windows', 'host/Load', 2, ('windows',), (), True),
+    ('hg:linux, hg:windows', 'host/Load', 2, ('aix',), (), False),
+    ('sg:web', 'host/Http', 2, (), ('web', 'db'), True),
+    ('sg:web', 'host/Http', 2, ('web',), (), False),
+    # Conditions of a rule, negation
+    ('hg:linux & /http & !bi:=0', 'host/Http', 2, ('linux',), (), True),
+    ('hg:linux & /http & !bi:=0', 'host/Http', 0, ('linux',), (), False),
+    ('hg:linux & /http & !bi:=0', 'host/Http', 2, ('windows',), (), False),
+    ('!/Load', 'host/Load', 2, (), (), False),
+    ('!/Load', 'host/Disk', 2, (), (), True),
+    ('bi:>4, hg:linux & /http & !bi:=0', 'host/Load', 5, (), (), True),
+])
+def test_services_filter(rule, service_id, bi, hostgroups, servicegroups, expected):
+    services_filter = ServicesFilter(rule)
+    assert services_filter.match(service_id, bi, hostgroups, servicegroups) == expected
+    # Memoized decision
+    assert services_filter.match(service_id, bi, hostgroups, servicegroups) == expected
+
+
+def test_services_filter_invalid_rules():
+    services_filter = ServicesFilter('[invalid, bi:~2, /Load')
+    assert len(services_filter.rules) == 1
+    assert services_filter.match('host/Load', 2)
+    assert not services_filter.match('host/[invalid', 2)
+
+
+@pytest.mark.parametrize('include,exclude,line,expected', [
+    ('', '', '[1445000000] Info: debug message', REJECT_NOT_STORED),
+    ('', '', '[1445000000] Warning : not stored', REJECT_NOT_STORED),
+    ('', '', '[1445000000] UNKNOWN TYPE: x', REJECT_INVALID),
+    ('', '', '[1445000000] HOST ALERT: h;DOWN;HARD;1;x', None),
+    ('', '', '[1445000000] starting... (Shinken)', None),
+    ('', 'class:state, host notification', '[1445000000] CURRENT HOST STATE: h;UP;HARD;1;ok', REJECT_EXCLUDED),
+    ('', 'class:state, host notification', '[1445000000] HOST NOTIFICATION: a;h;DOWN;c;o', REJECT_EXCLUDED),
+    ('', 'class:state, host notification', '[1445000000] HOST ALERT: h;DOWN;HARD;1;x', None),
+    ('class:alert', 'SERVICE ALERT', '[1445000000] SERVICE ALERT: h;s;OK;HARD;1;ok', REJECT_EXCLUDED),
+    ('class:alert', 'SERVICE ALERT', '[1445000000] HOST ALERT: h;DOWN;HARD;1;x', None),
+    ('class:alert', 'SERVICE ALERT', '[1445000000] EXTERNAL COMMAND: X', REJECT_EXCLUDED),
+    ('external command', '', '[1445000000] EXTERNAL COMMAND: X', None),
+    ('external command', '', '[1445000000] UNKNOWN TYPE: x', REJECT_INVALID),
+])
+def test_log_lines_filter(include, exclude, line, expected):
+    logs_filter = LogLinesFilter(include, exclude)
+    assert logs_filter.check(line) == expected
+    # Memoized decision
+    assert logs_filter.check(line) == expected
+
+
+def test_log_lines_filter_unknown_class():
+    logs_filter = LogLinesFilter('class:unknown, HOST ALERT')
+    assert logs_filter.include_classes == set()
+    assert logs_filter.check('[1445000000] HOST ALERT: h;DOWN;HARD;1;x') is None
+    assert logs_filter.check('[1445000000] SERVICE ALERT: h;s;OK;HARD;1;ok') == REJECT_EXCLUDED
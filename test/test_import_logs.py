@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Logs import tool tests
+"""
+
+import os
+import sys
+import gzip
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+import import_logs
+from module.log_line import parse_log_line
+
+
+class Options(object):
+
+    def __init__(self, **options):
+        self.uri = 'mongodb://localhost'
+        self.database = 'shinken'
+        self.logs_collection = 'logs'
+        self.logs_retention = 'delete'
+        self.logs_bucketing = 'none'
+        self.logs_indexes = ''
+        self.storage_schema = 'full'
+        self.storage_message = 1
+        self.include = ''
+        self.exclude = ''
+        self.dedup = True
+        self.batch_size = 2
+        self.workers = 1
+        self.__dict__.update(options)
+
+
+LINES = [
+    '[1445000000] SERVICE ALERT: host-1;Load;CRITICAL;HARD;3;load average: 12  ',
+    '[1445000010] Info: debug message',
+    '[1445000020] HOST ALERT: host-1;DOWN;HARD;3;down',
+    '[1445000030] HOST NOTIFICATION: admin;host-1;DOWN;notify-host;down',
+]
+
+
+@pytest.fixture
+def db(mongo, monkeypatch):
+    monkeypatch.setattr(import_logs, 'MongoClient', lambda *args, **kwargs: mongo)
+    return mongo.shinken
+
+
+@pytest.fixture
+def log_file(tmpdir):
+    filename = str(tmpdir.join('nagios.log.gz'))
+    f = gzip.open(filename, 'wb')
+    f.write('\n'.join(LINES) + '\n')
+    f.close()
+    return filename
+
+
+def test_import(db, log_file):
+    importer = import_logs.Importer(Options())
+    assert importer.import_file(log_file) == (log_file, 4, 3)
+
+    # Stored as the module stores the received lines
+    stored = list(db.logs.find({}, {'_id': False}).sort('time', 1))
+    assert stored == [parse_log_line(unicode(line)) for line in LINES if 'Info' not in line]
+    assert stored[0]['message'].endswith('load average: 12')
+    assert len(db.logs.index_information()) == 4
+
+    # Already stored lines, also stored by the module, are not imported again
+    db.logs.delete_many({'type': 'HOST ALERT'})
+    assert importer.import_file(log_file) == (log_file, 4, 1)
+    assert db.logs.count_documents({}) == 3
+
+
+def test_import_partitioned_compact(db, log_file):
+    importer = import_logs.Importer(Options(logs_retention='partitioned', storage_schema='compact', storage_message=0))
+    assert importer.import_file(log_file) == (log_file, 4, 3)
+    assert importer.import_file(log_file) == (log_file, 4, 0)
+
+    t = time.localtime(1445000000)
+    collection = db['logs_%04d_%02d' % (t.tm_year, t.tm_mon)]
+    assert collection.count_documents({}) == 3
+    assert sorted(info['key'] for info in collection.index_information().values()) == sorted([
+        [('_id', 1)], [('h', 1), ('s', 1), ('t', 1)], [('c', 1), ('t', 1)], [('t', 1)]
+    ])
+
+
+def test_bucketing_rejected(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['import_logs.py', '--logs-bucketing', 'item', 'nagios.log'])
+    with pytest.raises(SystemExit):
+        import_logs.main()
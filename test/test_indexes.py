@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Collections indexes tests: indexes declarations and their creation
+"""
+
+import pymongo
+
+from conftest import module_conf
+from module.mongo_sink import MongoSink, parse_indexes, get_index_hint, LOGS_INDEXES
+from module.metrics import Metrics
+
+
+def test_parse_indexes():
+    assert parse_indexes(LOGS_INDEXES) == [
+        ([('host_name', pymongo.ASCENDING), ('service_description', pymongo.ASCENDING), ('time', pymongo.ASCENDING)], False),
+        ([('logclass', pymongo.ASCENDING), ('time', pymongo.ASCENDING)], False),
+        ([('time', pymongo.ASCENDING)], False)
+    ]
+    assert parse_indexes(' unique:hostname + service + day ,, -time ') == [
+        ([('hostname', pymongo.ASCENDING), ('service', pymongo.ASCENDING), ('day', pymongo.ASCENDING)], True),
+        ([('time', pymongo.DESCENDING)], False)
+    ]
+    assert parse_indexes('') == []
+
+
+def test_index_hint():
+    indexes = parse_indexes(LOGS_INDEXES)
+    assert get_index_hint(indexes, ['host_name', 'service_description'], 'time') == indexes[0][0]
+    assert get_index_hint(indexes, ['logclass'], 'time') == indexes[1][0]
+    assert get_index_hint(indexes, [], 'time') == indexes[2][0]
+    assert get_index_hint(indexes, ['host_name'], 'time') is None
+
+
+def index_keys(collection):
+    return sorted(info['key'] for name, info in collection.index_information().items() if name != '_id_')
+
+
+def test_indexes_created(mongo):
+    storage = MongoSink(module_conf(), Metrics())
+    assert storage.open()
+    db = mongo[storage.database]
+    assert index_keys(db[storage.logs_collection]) == sorted([
+        [('host_name', 1), ('service_description', 1), ('time', 1)], [('logclass', 1), ('time', 1)], [('time', 1)]
+    ])
+    assert index_keys(db[storage.hav_collection]) == sorted([
+        [('hostname', 1), ('service', 1), ('day', 1)], [('day', 1)]
+    ])
+    unique = [info for info in db[storage.hav_collection].index_information().values() if info.get('unique')]
+    assert [info['key'] for info in unique] == [[('hostname', 1), ('service', 1), ('day', 1)]]
+
+
+def test_configured_indexes(mongo):
+    storage = MongoSink(module_conf(logs_indexes='host_name+-time', hav_indexes='unique:hostname+service+day'), Metrics())
+    assert storage.open()
+    db = mongo[storage.database]
+    assert index_keys(db[storage.logs_collection]) == [[('host_name', 1), ('time', -1)]]
+    assert index_keys(db[storage.hav_collection]) == [[('hostname', 1), ('service', 1), ('day', 1)]]
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""
+Log lines parser tests
+
+The expected documents of data/log_lines.json were stored by the original Logline parser of
+the module: the log lines filter and the parser must store exactly the same documents.
+"""
+
+import os
+import json
+
+import pytest
+
+from module.log_line import parse_log_line, compact_document, expand_document, LoglineWrongFormat
+from module.filters import LogLinesFilter
+from module.module import prepare_log_line
+
+
+def load_log_lines():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'log_lines.json')) as f:
+        return [(elt['line'].encode('UTF-8'), elt['document']) for elt in json.load(f)]
+
+
+LOG_LINES = load_log_lines()
+
+
+def store(line, logs_filter=LogLinesFilter()):
+    """
+    The module log lines management: the filter, then the parser
+    """
+    if logs_filter.check(line):
+        return None
+    return prepare_log_line(line)
+
+
+@pytest.mark.parametrize('line,document', LOG_LINES)
+def test_baseline_document(line, document):
+    assert store(line) == document
+
+
+@pytest.mark.parametrize('line,document', [(line, document) for line, document in LOG_LINES if document])
+def test_compact_round_trip(line, document):
+    values = parse_log_line(line)
+    assert expand_document(compact_document(values)) == document
+    assert expand_document(compact_document(values, message=False)) == document
+
+
+def test_unicode_line():
+    values = parse_log_line(u'[1445000000] HOST ALERT: h\xf4te;DOWN;HARD;1;sortie \xe9')
+    assert values['host_name'] == 'h\xc3\xb4te'
+    assert values['plugin_output'] == 'sortie \xc3\xa9'
+    assert values['state'] == 1
+
+
+def test_wrong_format():
+    with pytest.raises(LoglineWrongFormat):
+        parse_log_line('garbage line')
+    assert store('garbage line') is None
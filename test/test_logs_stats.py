@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Logs statistics tests: the stored log lines are counted per hour and per day
+"""
+
+import time
+import datetime
+
+from shinken.brok import Brok
+
+from conftest import module_conf
+from module.module import MongoLogs
+from module.writer import MongoLogsWriter
+
+
+def log_brok(timestamp, line):
+    brok = Brok('log', {'log': '[%d] %s' % (timestamp, line)})
+    brok.prepare()
+    return brok
+
+
+def commit(module):
+    """
+    Commit the counted statistics and write them as the writer thread does
+    """
+    module.commit_logs_stats()
+    while not module.writer.queue.empty():
+        operation, payload = module.writer.queue.get()
+        assert getattr(module.storage, 'write_' + operation)(payload)
+
+
+def test_logs_stats(mongo):
+    module = MongoLogs(module_conf(logs_stats=1))
+    module.writer = MongoLogsWriter(module.storage)
+    assert module.storage.open()
+
+    day = datetime.date(2015, 10, 16)
+    day_start = int(time.mktime(day.timetuple()))
+    hour = day_start + 10 * 3600
+    for timestamp in (hour + 10, hour + 20, hour + 3700):
+        module.manage_brok(log_brok(timestamp, 'SERVICE ALERT: host-1;Load;CRITICAL;HARD;3;load'))
+    module.manage_brok(log_brok(hour + 30, 'HOST ALERT: host-1;DOWN;HARD;3;down'))
+    # Not stored lines are not counted
+    module.manage_brok(log_brok(hour + 40, 'Info: debug message'))
+    commit(module)
+    assert not module.logs_stats_cache
+
+    def counts(period):
+        collection = mongo.shinken[module.storage.logs_stats_collection]
+        return sorted((doc['time'], doc['service_description'], doc['count'])
+                      for doc in collection.find({'period': period}))
+
+    assert counts('hour') == [(hour, '', 1), (hour, 'Load', 2), (hour + 3600, 'Load', 1)]
+    assert counts('day') == [(day_start, '', 1), (day_start, 'Load', 3)]
+
+    # The counters are incremented by the next commits
+    module.manage_brok(log_brok(hour + 50, 'HOST ALERT: host-1;UP;HARD;1;up'))
+    module.manage_brok(log_brok(hour + 60, 'SERVICE ALERT: host-1;Load;CRITICAL;HARD;3;load'))
+    commit(module)
+    assert counts('hour') == [(hour, '', 1), (hour, '', 1), (hour, 'Load', 3), (hour + 3600, 'Load', 1)]
+    assert counts('day') == [(day_start, '', 1), (day_start, '', 1), (day_start, 'Load', 4)]
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Metrics registry tests: Prometheus text rendering and concurrent updates
+"""
+
+import threading
+
+from module.metrics import Metrics
+
+
+def make_metrics():
+    metrics = Metrics()
+    metrics.counter('broks_total', 'Managed broks', label='type')
+    metrics.counter('lines_total', 'Inserted lines')
+    metrics.histogram('insert_seconds', 'Insert time', buckets=(0.1, 1.0))
+    metrics.gauge('queue_depth', 'Queue depth', lambda: 3)
+    metrics.gauge('broken', 'Failing gauge', lambda: 1 / 0)
+    return metrics
+
+
+def test_render():
+    metrics = make_metrics()
+    metrics.inc('broks_total', 2, 'log')
+    metrics.inc('broks_total', 1, 'say "hi"')
+    metrics.observe('insert_seconds', 0.05)
+    metrics.observe('insert_seconds', 0.5)
+    metrics.observe('insert_seconds', 5)
+    assert metrics.render().split('\n') == [
+        '# HELP mongo_logs_broks_total Managed broks',
+        '# TYPE mongo_logs_broks_total counter',
+        'mongo_logs_broks_total{type="log"} 2',
+        'mongo_logs_broks_total{type="say \\"hi\\""} 1',
+        '# HELP mongo_logs_insert_seconds Insert time',
+        '# TYPE mongo_logs_insert_seconds histogram',
+        'mongo_logs_insert_seconds_bucket{le="0.1"} 1',
+        'mongo_logs_insert_seconds_bucket{le="1.0"} 2',
+        'mongo_logs_insert_seconds_bucket{le="+Inf"} 3',
+        'mongo_logs_insert_seconds_sum 5.55',
+        'mongo_logs_insert_seconds_count 3',
+        # A counter without label is rendered before its first increment
+        '# HELP mongo_logs_lines_total Inserted lines',
+        '# TYPE mongo_logs_lines_total counter',
+        'mongo_logs_lines_total 0',
+        '# HELP mongo_logs_queue_depth Queue depth',
+        '# TYPE mongo_logs_queue_depth gauge',
+        'mongo_logs_queue_depth 3',
+        ''
+    ]
+
+
+def test_collect():
+    metrics = make_metrics()
+    metrics.inc('lines_total', 10)
+    metrics.inc('broks_total', 1, 'log')
+    metrics.observe('insert_seconds', 0.5)
+    assert metrics.collect() == {
+        'lines_total': 10, 'broks_total{log}': 1, 'insert_seconds_count': 1, 'insert_seconds_sum': 0.5, 'queue_depth': 3
+    }
+    assert metrics.get('lines_total') == 10
+    assert metrics.get('broks_total', 'log') == 1
+    assert metrics.get('broks_total', 'check') == 0
+
+
+def test_concurrent_increments():
+    metrics = make_metrics()
+
+    def increment():
+        for _ in xrange(20000):
+            metrics.inc('lines_total')
+            metrics.inc('broks_total', 1, 'log')
+
+    threads = [threading.Thread(target=increment) for _ in xrange(4)]
+    for thread in threads:
+        thread.start()
+    increment()
+    for thread in threads:
+        thread.join()
+    assert metrics.get('lines_total') == 100000
+    assert metrics.collect()['broks_total{log}'] == 100000
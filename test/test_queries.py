@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""
+Logs queries tests: the log lines are read page by page in each storage mode
+"""
+
+import random
+
+import pytest
+from bson import ObjectId
+
+from conftest import module_conf
+from module.module import MongoLogs
+from module.log_line import parse_log_line
+
+
+STORAGE_MODES = [
+    {},
+    {'storage_schema': 'compact', 'storage_message': '0'},
+    {'logs_retention': 'partitioned'},
+    {'logs_bucketing': 'item'},
+    {'logs_bucketing': 'logclass', 'storage_schema': 'compact'},
+]
+
+START = 1445000000
+
+
+def generate_logs(count=300):
+    """
+    Log lines documents over two months, the last lines have the same time
+    """
+    r = random.Random(1)
+    lines = []
+    for i in xrange(count):
+        t = START + i * 18000
+        host = 'host-%d' % r.randint(0, 4)
+        service = 'Service-%d' % r.randint(0, 3)
+        kind = r.randint(0, 3)
+        if kind == 0:
+            lines.append('[%d] SERVICE ALERT: %s;%s;CRITICAL;HARD;3;CRITICAL - timeout' % (t, host, service))
+        elif kind == 1:
+            lines.append('[%d] HOST ALERT: %s;DOWN;SOFT;1;PING CRITICAL' % (t, host))
+        elif kind == 2:
+            lines.append('[%d] CURRENT SERVICE STATE: %s;%s;OK;HARD;1;OK - all good' % (t, host, service))
+        else:
+            lines.append('[%d] EXTERNAL COMMAND: SCHEDULE_FORCED_SVC_CHECK;%s;%s;%d' % (t, host, service, t))
+    t = START + count * 18000
+    lines.extend('[%d] HOST ALERT: host-0;DOWN;HARD;1;same time %d' % (t, i) for i in xrange(30))
+
+    logs = [parse_log_line(line) for line in lines]
+    for values in logs:
+        values['_id'] = ObjectId()
+    return logs
+
+
+def key(doc):
+    return doc['time'], doc['message']
+
+
+@pytest.fixture(params=STORAGE_MODES, ids=lambda options: ','.join('%s=%s' % item for item in sorted(options.items())) or 'default')
+def module(request, mongo):
+    module = MongoLogs(module_conf(**request.param))
+    module.storage.open()
+    logs = generate_logs()
+    for i in xrange(0, len(logs), 100):
+        assert module.storage.write_logs([dict(values) for values in logs[i:i + 100]])
+    module.stored_logs = logs
+    return module
+
+
+def read_pages(module, limit, **kwargs):
+    pages = []
+    after = None
+    while True:
+        logs, after = module.get_logs_page(limit=limit, after=after, **kwargs)
+        if not logs:
+            return pages
+        pages.append(logs)
+
+
+@pytest.mark.parametrize('limit', [7, 50])
+def test_pages(module, limit):
+    pages = read_pages(module, limit)
+    assert all(len(logs) <= limit for logs in pages)
+    logs = [doc for page in pages for doc in page]
+    assert len(logs) == len(module.stored_logs)
+    assert sorted(map(key, logs)) == sorted(map(key, module.stored_logs))
+    assert [doc['time'] for doc in logs] == sorted(doc['time'] for doc in module.stored_logs)
+
+
+def test_pages_descending(module):
+    pages = read_pages(module, 7, descending=True, fields=['time', 'message'])
+    assert all(len(logs) <= 7 for logs in pages)
+    logs = [doc for page in pages for doc in page]
+    assert sorted(map(key, logs)) == sorted(map(key, module.stored_logs))
+    assert [doc['time'] for doc in logs] == sorted((doc['time'] for doc in module.stored_logs), reverse=True)
+    assert set(logs[0]) == set(['time', 'message'])
+
+
+def test_history(module):
+    middle = START + 150 * 18000
+    expected = [doc for doc in module.stored_logs if doc['host_name'] == 'host-1' and doc['time'] >= middle]
+    logs = list(module.get_history('host-1', start=middle, batch_size=7))
+    assert sorted(map(key, logs)) == sorted(map(key, expected))
+    # The host only log lines
+    expected = [doc for doc in module.stored_logs if doc['host_name'] == 'host-1' and not doc['service_description']]
+    logs = list(module.get_history('host-1', ''))
+    assert sorted(map(key, logs)) == sorted(map(key, expected))
+
+
+def test_logs_by_class(module):
+    middle = START + 150 * 18000
+    expected = [doc for doc in module.stored_logs
+                if doc['logclass'] in (1, 5) and doc['type'] != 'HOST ALERT' and doc['time'] <= middle]
+    logs = list(module.get_logs_by_class([1, 5], end=middle, types=['SERVICE ALERT', 'EXTERNAL COMMAND'], descending=True))
+    assert sorted(map(key, logs)) == sorted(map(key, expected))
+    assert [doc['time'] for doc in logs] == sorted((doc['time'] for doc in expected), reverse=True)
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Services registry tests
+"""
+
+from module.registry import ServicesRegistry, intern_name
+
+
+def record(hostname, service, day):
+    return {'hostname': hostname, 'service': service, 'day': day}
+
+
+def test_register():
+    registry = ServicesRegistry()
+    host = registry.register('host-1', '', frozenset(['linux']))
+    service = registry.register('host-1', 'Load')
+    assert len(registry) == 2
+    assert ('host-1', 'Load') in registry
+    assert registry.get('host-1') is host
+    assert registry.get('host-1', 'Load') is service
+    assert registry.get('host-2') is None
+    assert host.groups == frozenset(['linux'])
+
+    # Registered again: the same item, the groups are updated when given
+    assert registry.register('host-1', '', frozenset(['web'])) is host
+    assert host.groups == frozenset(['web'])
+    assert registry.register('host-1') is host
+    assert host.groups == frozenset(['web'])
+    assert len(registry) == 2
+
+
+def test_shared_names():
+    # The broks names are unicode strings, a single instance of each name is kept
+    name = u''.join([u'h\xf4te', u'-1'])
+    assert intern_name(name) is intern_name(u''.join([u'h\xf4te', u'-1']))
+    assert intern_name('host-1') is intern_name(''.join(['host', '-1']))
+
+    registry = ServicesRegistry()
+    item = registry.register(name, u''.join([u'Lo', u'ad']))
+    other = registry.register(u''.join([u'h\xf4te', u'-1']), u'Disk')
+    assert item.hostname is other.hostname
+
+
+def test_load_availability():
+    registry = ServicesRegistry()
+    host = registry.register('host-1')
+    service = registry.register('host-1', 'Load')
+    service.availability = record('host-1', 'Load', '2015-10-17')
+
+    registry.load_availability([
+        record('host-1', '', '2015-10-16'),
+        record('host-1', 'Load', '2015-10-16'),
+        record('host-2', '', '2015-10-16')
+    ])
+    assert host.availability == record('host-1', '', '2015-10-16')
+    # The cached record is more recent than the loaded one
+    assert service.availability['day'] == '2015-10-17'
+
+    # Loaded before the item is registered
+    assert registry.register('host-2').availability == record('host-2', '', '2015-10-16')
+    registry.load_availability([record('host-3', '', '2015-10-16')])
+    registry.clear_loaded()
+    assert registry.register('host-3').availability is None
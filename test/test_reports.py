@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Availability reports tests: the records summed by the DB, and the reports cache
+"""
+
+import time
+
+from conftest import module_conf
+from module.module import MongoLogs
+from module.cache import ResultsCache
+
+
+def record(hostname, service, day, daily):
+    data = {'hostname': hostname, 'service': service, 'day': day, 'day_ts': 0, 'is_downtime': '0'}
+    data.update(('daily_%d' % state, seconds) for state, seconds in enumerate(daily))
+    return data
+
+
+def make_module(**options):
+    module = MongoLogs(module_conf(**options))
+    assert module.storage.open()
+    assert module.storage.write_availability([
+        record('host-1', '', '2015-10-15', [100, 0, 0, 0, 0]),
+        record('host-1', '', '2015-10-16', [50, 50, 0, 0, 0]),
+        record('host-1', '', '2015-10-17', [0, 100, 0, 0, 0]),
+        record('host-1', 'Load', '2015-10-16', [60, 0, 20, 0, 20]),
+        record('host-2', '', '2015-10-16', [0, 0, 0, 0, 100]),
+    ])
+    return module
+
+
+def daily(data):
+    return [data['daily_%d' % state] for state in xrange(5)]
+
+
+def test_report(mongo):
+    module = make_module()
+    report = module.get_availability_report('2015-10-15', '2015-10-16')
+    assert [(data['hostname'], data['service'], data['days'], daily(data)) for data in report['items']] == [
+        ('host-1', '', 2, [150, 50, 0, 0, 0]),
+        ('host-1', 'Load', 1, [60, 0, 20, 0, 20]),
+        ('host-2', '', 1, [0, 0, 0, 0, 100]),
+    ]
+    assert report['items'][0]['percent_0'] == 75.0
+    assert report['groups'] == {}
+
+
+def test_report_items_and_groups(mongo):
+    module = make_module()
+    # host-2/Load is not stored, host-2 is not requested
+    report = module.get_availability_report('2015-10-16', '2015-10-17', items=[('host-1', ''), ('host-2', 'Load')],
+                                            groups={'linux': [('host-1', ''), ('host-2', '')]})
+    assert [(data['hostname'], data['service'], daily(data)) for data in report['items']] == [
+        ('host-1', '', [50, 150, 0, 0, 0])
+    ]
+    group = report['groups']['linux']
+    assert (group['items'], group['days'], daily(group)) == (1, 2, [50, 150, 0, 0, 0])
+    assert group['percent_1'] == 75.0
+
+
+def test_report_cached(mongo):
+    module = make_module(availability_cache_ttl=60)
+    report = module.get_availability_report('2015-10-15', '2015-10-17')
+    assert module.get_availability_report('2015-10-15', '2015-10-17') is report
+    assert module.metrics.get('availability_reports_total', 'miss') == 1
+    assert module.metrics.get('availability_reports_total', 'hit') == 1
+    # Another report
+    assert module.get_availability_report('2015-10-15', '2015-10-16') is not report
+
+
+def test_results_cache(monkeypatch):
+    cache = ResultsCache(size=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # The least recently used entry is evicted
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert len(cache) == 2
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 20)
+    assert cache.get('a') is None
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0
+
+    # Disabled cache
+    cache = ResultsCache(size=0)
+    cache.set('a', 1)
+    assert cache.get('a') is None
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Logs retention tests: delete, ttl and partitioned retention strategies
+"""
+
+import time
+import datetime
+
+from conftest import module_conf
+from module.module import MongoLogs
+
+
+DAY = 86400
+
+
+def make_storage(**options):
+    storage = MongoLogs(module_conf(max_logs_age='30d', **options)).storage
+    assert storage.open()
+    return storage
+
+
+def log(timestamp, n=0):
+    return {'time': timestamp, 'host_name': 'host-1', 'service_description': '', 'logclass': 1, 'n': n}
+
+
+def month_collection(timestamp):
+    t = time.localtime(timestamp)
+    return 'logs_%04d_%02d' % (t.tm_year, t.tm_mon)
+
+
+def test_delete(mongo):
+    storage = make_storage()
+    now = int(time.time())
+    assert storage.write_logs([log(now - 60 * DAY, 0), log(now - DAY, 1), log(now, 2)])
+    storage.rotate_logs()
+    assert sorted(doc['n'] for doc in mongo.shinken.logs.find()) == [1, 2]
+
+
+def test_ttl(mongo):
+    storage = make_storage(logs_retention='ttl')
+    indexes = mongo.shinken.logs.index_information()
+    assert [info.get('expireAfterSeconds') for info in indexes.values() if info['key'] == [('date', 1)]] == [30 * DAY]
+
+    now = int(time.time())
+    # Stored before the ttl retention was set
+    mongo.shinken.logs.insert_one(log(now - 60 * DAY, 0))
+    assert storage.write_logs([log(now - DAY, 1), log(now, 2)])
+    for doc in mongo.shinken.logs.find({'n': {'$gt': 0}}):
+        assert doc['date'] == datetime.datetime.utcfromtimestamp(doc['time'])
+
+    # The old logs without date are deleted, the others are left to the TTL index
+    storage.rotate_logs()
+    assert sorted(doc['n'] for doc in mongo.shinken.logs.find()) == [1, 2]
+
+
+def test_partitioned(mongo):
+    storage = make_storage(logs_retention='partitioned')
+    now = int(time.time())
+    old = now - 90 * DAY
+    # Stored before the partitioned retention was set
+    mongo.shinken.logs.insert_one(log(old, 0))
+
+    assert storage.write_logs([log(old, 1), log(now, 2)])
+    assert mongo.shinken[month_collection(old)].count_documents({}) == 1
+    assert mongo.shinken[month_collection(now)].count_documents({}) == 1
+    for name in (month_collection(old), month_collection(now)):
+        assert len(mongo.shinken[name].index_information()) > 1
+    assert storage.get_logs_partitions() == sorted([month_collection(old), month_collection(now)])
+
+    # The partitions older than the maximum age are dropped, and the emptied logs collection
+    storage.rotate_logs()
+    names = mongo.shinken.list_collection_names()
+    assert month_collection(old) not in names
+    assert month_collection(now) in names
+    assert 'logs' not in names
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Storage sinks tests: the batches sent to the secondary sinks, and the Elasticsearch sink requests
+"""
+
+import json
+import time
+import urllib2
+import datetime
+from StringIO import StringIO
+
+import pytest
+
+from conftest import module_conf
+from module.module import MongoLogs
+from module.writer import MongoLogsWriter
+from module.sinks import Sink, MemorySink, ElasticsearchSink, create_sink
+
+
+class LogsSink(Sink):
+    name = 'logs'
+    operations = ('logs', )
+
+
+def queued(writer):
+    return list(writer.queue.queue)
+
+
+def test_sinks_fan_out():
+    module = MongoLogs(module_conf(sinks='memory, unknown'))
+    assert [sink.name for sink in module.sinks] == ['memory']
+    module.writer = MongoLogsWriter(module.storage)
+    sink_writer = MongoLogsWriter(module.sinks[0])
+    module.sink_writers.append(sink_writer)
+
+    logs = [{'time': 1445000000, 'message': 'a'}, {'time': 1445000001, 'message': 'b'}]
+    assert module.submit('logs', logs)
+    assert queued(module.writer) == [('logs', logs)]
+    # The sinks get copies of the documents
+    (operation, copies), = queued(sink_writer)
+    assert operation == 'logs'
+    assert copies == logs
+    assert all(copy is not doc for copy, doc in zip(copies, logs))
+
+    # The operations that a sink does not implement are not sent to it
+    logs_writer = MongoLogsWriter(LogsSink())
+    module.sink_writers.append(logs_writer)
+    records = [{'hostname': 'host-1', 'service': '', 'day': '2015-10-16'}]
+    assert module.submit('availability', records)
+    assert queued(module.writer)[-1] == ('availability', records)
+    assert queued(sink_writer)[-1] == ('availability', records)
+    assert queued(logs_writer) == []
+
+
+def test_memory_sink():
+    sink = MemorySink(max_logs=3)
+    assert sink.write_logs([{'n': n} for n in xrange(5)])
+    assert sink.logs == [{'n': 2}, {'n': 3}, {'n': 4}]
+    record = {'hostname': 'host-1', 'service': '', 'day': '2015-10-16', 'daily_0': 10}
+    assert sink.write_availability([record])
+    assert sink.write_availability([dict(record, daily_0=20)])
+    assert sink.availability[('host-1', '', '2015-10-16')]['daily_0'] == 20
+    stats = {'period': 'hour', 'time': 1444996800, 'host_name': 'host-1', 'count': 2}
+    assert sink.write_logs_stats([stats, stats])
+    assert sink.logs_stats.values() == [4]
+
+
+class Elasticsearch(object):
+    """
+    Recorded Elasticsearch requests, and their responses
+    """
+
+    def __init__(self, monkeypatch):
+        self.requests = []
+        self.responses = {}
+        self.error = None
+        monkeypatch.setattr(urllib2, 'urlopen', self.urlopen)
+
+    def urlopen(self, request, timeout=None):
+        if self.error is not None:
+            raise self.error
+        self.requests.append((request.get_method(), request.get_full_url(), request.get_data()))
+        return StringIO(json.dumps(self.responses.get(request.get_full_url(), {'errors': False, 'items': []})))
+
+    def bulk_lines(self):
+        method, url, body = self.requests[-1]
+        assert (method, url) == ('POST', 'http://es:9200/_bulk')
+        return [json.loads(line) for line in body.splitlines()]
+
+
+@pytest.fixture
+def es(monkeypatch):
+    return Elasticsearch(monkeypatch)
+
+
+def test_es_logs(es):
+    sink = create_sink('elasticsearch', module_conf(elasticsearch_uri='http://es:9200/', elasticsearch_index_prefix='nagios'))
+    timestamp = int(time.mktime(datetime.date(2015, 10, 16).timetuple())) + 3600
+    assert sink.write_logs([{'_id': 'id-1', 'time': timestamp, 'message': 'a'}, {'time': timestamp, 'message': 'b'}])
+    assert es.bulk_lines() == [
+        {'index': {'_index': 'nagios-logs-2015.10.16', '_id': 'id-1'}}, {'time': timestamp, 'message': 'a'},
+        {'index': {'_index': 'nagios-logs-2015.10.16'}}, {'time': timestamp, 'message': 'b'},
+    ]
+
+
+def test_es_availability_and_stats(es):
+    sink = ElasticsearchSink('http://es:9200', doc_type='doc')
+    assert sink.write_availability([{'_id': 'object id', 'hostname': 'host-1', 'service': 'Load', 'day': '2015-10-16'}])
+    assert es.bulk_lines() == [
+        {'index': {'_index': 'shinken-availability', '_type': 'doc', '_id': 'host-1/Load/2015-10-16'}},
+        {'hostname': 'host-1', 'service': 'Load', 'day': '2015-10-16'}
+    ]
+
+    stats = {'period': 'hour', 'time': 1444996800, 'host_name': 'host-1', 'service_description': '', 'logclass': 1,
+             'type': 'HOST ALERT', 'state': 1, 'count': 3}
+    assert sink.write_logs_stats([stats])
+    action, update = es.bulk_lines()
+    assert action == {'update': {'_index': 'shinken-logs-stats', '_type': 'doc',
+                                 '_id': 'hour/1444996800/host-1//1/HOST ALERT/1'}}
+    assert update['script']['params'] == {'count': 3}
+    assert update['upsert'] == stats
+
+
+def test_es_errors(es):
+    sink = ElasticsearchSink('http://es:9200')
+    # Not available: the batch is retried
+    es.error = urllib2.URLError('connection refused')
+    assert not sink.write_logs([{'time': 1445000000}])
+    # Documents rejected by Elasticsearch are not retried
+    es.error = None
+    es.responses['http://es:9200/_bulk'] = {'errors': True, 'items': [{'index': {'error': 'mapping'}}]}
+    assert sink.write_logs([{'time': 1445000000}])
+    # Documents which can not be serialized are skipped
+    assert sink.write_logs([{'time': 1445000000, 'date': datetime.datetime.now()}])
+    assert len(es.requests) == 1
+
+
+def test_es_rotation(es):
+    sink = ElasticsearchSink('http://es:9200', max_logs_age=30)
+    old = (datetime.date.today() - datetime.timedelta(days=40)).strftime('%Y.%m.%d')
+    recent = (datetime.date.today() - datetime.timedelta(days=2)).strftime('%Y.%m.%d')
+    es.responses['http://es:9200/_cat/indices/shinken-logs-*?format=json&h=index'] = [
+        {'index': 'shinken-logs-' + old}, {'index': 'shinken-logs-' + recent}, {'index': 'shinken-logs-stats'}
+    ]
+    sink.maintain()
+    assert es.requests[1:] == [('DELETE', 'http://es:9200/shinken-logs-' + old, None)]
+    # Once a day
+    sink.maintain()
+    assert len(es.requests) == 2
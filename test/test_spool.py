@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""
+On-disk spool and background writer tests
+"""
+
+import os
+import time
+
+from module.spool import Spool, FSYNC_NEVER
+from module.writer import MongoLogsWriter, OVERFLOW_SPILL
+
+
+class Storage(object):
+    """
+    A storage which writes are recorded, and which fails while it is not available
+    """
+
+    def __init__(self, available=True):
+        self.available = available
+        self.logs = []
+
+    def maintain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write_logs(self, logs):
+        if not self.available:
+            return False
+        self.logs.extend(logs)
+        return True
+
+    def write_availability_load(self, day):
+        self.logs.append({'load': day})
+        return True
+
+
+def batch(first, count=3):
+    return [{'n': n} for n in xrange(first, first + count)]
+
+
+def read_all(spool):
+    read = []
+    while True:
+        record = spool.peek()
+        if record is None:
+            return read
+        read.append(record['n'])
+        spool.ack()
+
+
+def test_spool_order(tmpdir):
+    # Small segments, the records are stored in several segments
+    spool = Spool(str(tmpdir), segment_size=200, fsync=FSYNC_NEVER)
+    for n in xrange(50):
+        assert spool.append({'n': n})
+    assert len(spool.segments) > 1
+
+    read = []
+    while True:
+        record = spool.peek()
+        if record is None:
+            break
+        # Not removed until acknowledged
+        assert spool.peek() == record
+        read.append(record['n'])
+        spool.ack()
+    assert read == range(50)
+    assert spool.empty()
+
+
+def test_spool_restart(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=200, fsync=FSYNC_NEVER)
+    for n in xrange(30):
+        spool.append({'n': n})
+    for _ in xrange(10):
+        spool.peek()
+        spool.ack()
+    # Read but not acknowledged
+    assert spool.peek() == {'n': 10}
+    spool.close()
+
+    spool = Spool(str(tmpdir), segment_size=200, fsync=FSYNC_NEVER)
+    spool.append({'n': 30})
+    assert read_all(spool) == range(10, 31)
+    # The read segments are removed
+    assert len([f for f in os.listdir(str(tmpdir)) if f.endswith('.spool')]) == 1
+
+
+def test_spool_prepend(tmpdir):
+    spool = Spool(str(tmpdir), fsync=FSYNC_NEVER)
+    # Prepended to an empty spool
+    spool.prepend([{'n': 3}, {'n': 4}])
+    for n in xrange(5, 10):
+        spool.append({'n': n})
+    spool.peek()
+    spool.ack()
+    # Inserted before the records not read yet, the segment being written is replaced
+    spool.prepend([{'n': 1}, {'n': 2}])
+    spool.append({'n': 10})
+    spool.close()
+
+    assert read_all(Spool(str(tmpdir), fsync=FSYNC_NEVER)) == [1, 2] + range(4, 11)
+
+
+def test_spool_max_size(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=200, max_size=600, fsync=FSYNC_NEVER)
+    for n in xrange(100):
+        spool.append({'n': n})
+    assert spool.size <= 600
+    assert spool.dropped_records == 0
+    # The oldest segments were dropped, the newest records are kept in order
+    read = read_all(spool)
+    assert read == range(read[0], 100)
+
+
+def test_writer_spill_order(tmpdir):
+    storage = Storage(available=False)
+    writer = MongoLogsWriter(storage, queue_size=2, overflow=OVERFLOW_SPILL,
+                             spool=Spool(str(tmpdir), fsync=FSYNC_NEVER), retry_min_delay=0.01, retry_max_delay=0.01)
+    for first in xrange(0, 30, 3):
+        assert writer.submit('logs', batch(first))
+    # The queue is full, the next jobs are in the spool
+    assert writer.spilled_jobs == 8
+
+    writer.start()
+    time.sleep(0.1)
+    storage.available = True
+    deadline = time.time() + 5
+    while not writer.spool.empty() and time.time() < deadline:
+        time.sleep(0.05)
+    writer.stop(5)
+    assert [log['n'] for log in storage.logs] == range(30)
+    assert writer.spool.empty()
+
+
+def test_writer_restart(tmpdir):
+    # The DB is not available, the writer stops with queued and spooled jobs
+    storage = Storage(available=False)
+    writer = MongoLogsWriter(storage, queue_size=2, overflow=OVERFLOW_SPILL,
+                             spool=Spool(str(tmpdir), fsync=FSYNC_NEVER), retry_min_delay=0.01, retry_max_delay=0.01)
+    for first in xrange(0, 30, 3):
+        writer.submit('logs', batch(first))
+    writer.start()
+    time.sleep(0.1)
+    writer.stop(5)
+    assert not writer.is_alive()
+    assert storage.logs == []
+
+    # The restarted writer replays all the jobs in order
+    storage = Storage()
+    writer = MongoLogsWriter(storage, queue_size=2, overflow=OVERFLOW_SPILL,
+                             spool=Spool(str(tmpdir), fsync=FSYNC_NEVER))
+    writer.submit('logs', batch(30))
+    writer.start()
+    deadline = time.time() + 5
+    while not writer.spool.empty() and time.time() < deadline:
+        time.sleep(0.05)
+    writer.stop(5)
+    assert [log['n'] for log in storage.logs] == range(33)
+
+
+def test_writer_loads_after_the_replay(tmpdir):
+    spool = Spool(str(tmpdir), fsync=FSYNC_NEVER)
+    for first in xrange(0, 9, 3):
+        spool.append({'operation': 'logs', 'payload': batch(first)})
+
+    # After a restart, the availability records are loaded once the spooled jobs are written
+    storage = Storage()
+    writer = MongoLogsWriter(storage, overflow=OVERFLOW_SPILL, spool=spool)
+    writer.submit('availability_load', '2015-10-16')
+    writer.start()
+    deadline = time.time() + 5
+    while len(storage.logs) < 10 and time.time() < deadline:
+        time.sleep(0.05)
+    writer.stop(5)
+    assert storage.logs == batch(0, 9) + [{'load': '2015-10-16'}]
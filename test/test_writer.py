@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Background writer tests: overflow policies and retries
+"""
+
+import time
+
+from module.writer import MongoLogsWriter, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST
+
+
+class Storage(object):
+    """
+    A storage which jobs are recorded, and which fails its first writes
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.jobs = []
+
+    def maintain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, operation, payload):
+        if self.failures:
+            self.failures -= 1
+            return False
+        self.jobs.append((operation, payload))
+        return True
+
+    def write_logs(self, logs):
+        return self.write('logs', logs)
+
+    def write_availability_load(self, day):
+        return self.write('availability_load', day)
+
+
+def test_block_rejects_when_full():
+    writer = MongoLogsWriter(Storage(), queue_size=2, overflow=OVERFLOW_BLOCK)
+    assert writer.submit('logs', [1])
+    assert writer.submit('logs', [2])
+    # The caller keeps the job and submits it again later
+    assert not writer.submit('logs', [3])
+    assert not writer.submit('logs', [3], timeout=0.05)
+    assert writer.rejected_jobs == 2
+    assert list(writer.queue.queue) == [('logs', [1]), ('logs', [2])]
+
+
+def test_drop_oldest():
+    writer = MongoLogsWriter(Storage(), queue_size=3, overflow=OVERFLOW_DROP_OLDEST)
+    for n in xrange(5):
+        assert writer.submit('logs', [n])
+    assert writer.dropped_jobs == 2
+    assert list(writer.queue.queue) == [('logs', [2]), ('logs', [3]), ('logs', [4])]
+
+
+def test_drop_oldest_keeps_the_availability_load():
+    writer = MongoLogsWriter(Storage(), queue_size=3, overflow=OVERFLOW_DROP_OLDEST)
+    assert writer.submit('availability_load', '2015-10-16')
+    for n in xrange(4):
+        assert writer.submit('logs', [n])
+    assert list(writer.queue.queue) == [('availability_load', '2015-10-16'), ('logs', [2]), ('logs', [3])]
+
+    # Only jobs which are not dropped are queued, the new job is dropped
+    writer = MongoLogsWriter(Storage(), queue_size=1, overflow=OVERFLOW_DROP_OLDEST)
+    assert writer.submit('availability_load', '2015-10-16')
+    assert writer.submit('logs', [1])
+    assert writer.dropped_jobs == 1
+    assert list(writer.queue.queue) == [('availability_load', '2015-10-16')]
+
+
+def test_retry_in_order():
+    storage = Storage(failures=3)
+    writer = MongoLogsWriter(storage, retry_min_delay=0.01, retry_max_delay=0.01)
+    for n in xrange(3):
+        writer.submit('logs', [n])
+    writer.start()
+    deadline = time.time() + 5
+    while len(storage.jobs) < 3 and time.time() < deadline:
+        time.sleep(0.05)
+    writer.stop(5)
+    assert storage.jobs == [('logs', [0]), ('logs', [1]), ('logs', [2])]
+    assert writer.failed_jobs == 3
+    assert writer.retries == 0
+
+
+def test_retry_delay():
+    writer = MongoLogsWriter(Storage(), retry_min_delay=1, retry_max_delay=60)
+    for retries, delay in [(1, 1), (2, 2), (4, 8), (10, 60)]:
+        writer.retries = retries
+        assert delay * 0.5 <= writer.retry_delay() <= delay
@@ -0,0 +1,326 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Rebuild the daily availability records from the logs collection.
+
+The state changes of each host/service (HOST/SERVICE ALERT lines) and the states dumped
+at Shinken start (INITIAL/CURRENT HOST/SERVICE STATE lines) are read in time order and
+accounted with the module availability functions. The records of the days before today are
+stored with bulk upserts; by default, the existing records are not modified.
+
+Hosts are split in shards processed in parallel. The rebuilt hosts are appended to a single
+checkpoint file, an interrupted backfill is resumed where it stopped, with any number of workers:
+
+    python tools/backfill_availability.py --start 2015-01-01 --workers 4
+    python tools/backfill_availability.py --uri mongodb://db1 --logs-retention partitioned --overwrite
+"""
+
+import os
+import re
+import sys
+import time
+import heapq
+import datetime
+import optparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+
+from module.availability import Day, new_record, record_check, close_record
+from module.log_line import COMPACT_FIELDS, SERVICE_STATES, HOST_STATES
+
+
+# Log lines types which give the state of an host/service
+ALERT_TYPES = ['HOST ALERT', 'SERVICE ALERT']
+STATE_TYPES = ['INITIAL HOST STATE', 'CURRENT HOST STATE', 'INITIAL SERVICE STATE', 'CURRENT SERVICE STATE']
+
+FIELDS = ['host_name', 'service_description', 'time', 'type', 'state']
+
+# Checkpoint file of the rebuilt hosts, in the checkpoint directory
+CHECKPOINT_FILE = 'hosts.done'
+
+
+def log(message, *args):
+    sys.stderr.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), message % args))
+
+
+class Backfill(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.start = Day(datetime.datetime.strptime(options.start, '%Y-%m-%d').date()) if options.start else None
+        end = datetime.datetime.strptime(options.end, '%Y-%m-%d').date() if options.end else datetime.date.today()
+        # Today's records are maintained by the module
+        self.end = Day(min(end, datetime.date.today()))
+
+        # Logs documents fields names in the DB
+        if options.storage_schema == 'compact':
+            self.fields = dict((field, COMPACT_FIELDS[field][0]) for field in FIELDS)
+        else:
+            self.fields = dict((field, field) for field in FIELDS)
+
+        self.con = None
+        self.db = None
+
+    def connect(self):
+        # One connection per process, connections must not be shared with forked processes
+        self.con = MongoClient(self.options.uri)
+        self.db = self.con[self.options.database]
+
+    def logs_collections(self):
+        """
+        Get the logs collections, in time order
+
+        The logs stored before the partitioned retention was set are in the logs collection.
+        """
+        if self.options.logs_retention != 'partitioned':
+            return [self.options.logs_collection]
+        names = self.db.collection_names()
+        partition = re.compile(r'^%s_(\d{4})_(\d{2})$' % re.escape(self.options.logs_collection))
+        collections = sorted(name for name in names if partition.match(name))
+        if self.options.logs_collection in names:
+            collections.insert(0, self.options.logs_collection)
+        return collections
+
+    def time_query(self):
+        query = {}
+        if self.start:
+            query['$gte'] = self.start.start
+        query['$lt'] = self.end.start
+        return query
+
+    def hosts(self):
+        f = self.fields
+        hosts = set()
+        for collection in self.logs_collections():
+            hosts.update(self.db[collection].distinct(f['host_name'], {
+                f['type']: {'$in': ALERT_TYPES + STATE_TYPES},
+                f['time']: self.time_query()
+            }))
+        return sorted(hosts)
+
+    def events(self, hosts):
+        """
+        Get the state events of the hosts, in host, service and time order:
+        (host_name, service_description, time, state, is a state change)
+        """
+        f = self.fields
+        query = {
+            f['host_name']: {'$in': hosts},
+            f['type']: {'$in': ALERT_TYPES + STATE_TYPES},
+            f['time']: self.time_query()
+        }
+        projection = dict((f[field], True) for field in FIELDS)
+        projection['_id'] = False
+        # Sorted as the default host_name+service_description+time index
+        sort = [(f['host_name'], 1), (f['service_description'], 1), (f['time'], 1)]
+
+        cursors = [self.db[collection].find(query, projection, sort=sort, batch_size=self.options.batch_size)
+                   for collection in self.logs_collections()]
+        if len(cursors) == 1:
+            documents = cursors[0]
+        else:
+            # Partitions are merged per host/service, the partitions are in time order
+            documents = merge_partitions(cursors, f)
+
+        for doc in documents:
+            type = doc.get(f['type'], '')
+            service = doc.get(f['service_description'], '')
+            state = doc.get(f['state'], 0)
+            if type in STATE_TYPES:
+                # State is stored as its name for these lines
+                states = SERVICE_STATES if 'SERVICE' in type else HOST_STATES
+                state = states.get(state, 3)
+            yield doc[f['host_name']], service, int(doc[f['time']]), int(state), type in ALERT_TYPES
+
+    def rebuild(self, events):
+        """
+        Rebuild the daily records of an host/service from its state events, in time order
+        """
+        records = []
+        day = None
+        data = None
+        for host_name, service, t, state, change in events:
+            event_day = Day.from_timestamp(t)
+            if day is not None and event_day != day:
+                # Close the days until the event day, the state lasts during the days without events
+                close_record(data, day)
+                records.append(data)
+                day = day.next()
+                while day != event_day:
+                    data = close_record(new_record(host_name, service, day, data), day)
+                    if 'last_check_state' in data:
+                        records.append(data)
+                    day = day.next()
+                data = new_record(host_name, service, day, data)
+            elif day is None:
+                day = event_day
+                data = new_record(host_name, service, day)
+            record_check(data, day, state, t, t if change else None)
+
+        if data is not None:
+            close_record(data, day)
+            records.append(data)
+            # Days without events until the end
+            day = day.next()
+            while day.start < self.end.start:
+                data = close_record(new_record(data['hostname'], data['service'], day, data), day)
+                records.append(data)
+                day = day.next()
+        return records
+
+    def store(self, records):
+        if not records:
+            return 0
+        requests = []
+        for data in records:
+            query = {'hostname': data['hostname'], 'service': data['service'], 'day': data['day']}
+            if self.options.overwrite:
+                requests.append(ReplaceOne(query, data, upsert=True))
+            else:
+                requests.append(UpdateOne(query, {'$setOnInsert': data}, upsert=True))
+        result = self.db[self.options.hav_collection].bulk_write(requests, ordered=False)
+        return result.upserted_count + result.modified_count
+
+    def checkpoint(self):
+        return os.path.join(self.options.checkpoint_dir, CHECKPOINT_FILE)
+
+    def done_hosts(self):
+        """
+        Get the hosts rebuilt by the previous runs
+        """
+        if not os.path.exists(self.checkpoint()):
+            return set()
+        with open(self.checkpoint()) as f:
+            return set(line.rstrip('\n') for line in f)
+
+    def run_shard(self, shard, hosts, lock):
+        """
+        Rebuild the availability records of a shard of hosts
+
+        The shards append the hosts they have rebuilt to the same checkpoint file, under the lock.
+        """
+        self.connect()
+        log("shard %d: %d hosts to rebuild", shard, len(hosts))
+
+        stored = 0
+        now = time.time()
+        with open(self.checkpoint(), 'a') as f:
+            for i in xrange(0, len(hosts), self.options.hosts_batch):
+                some_hosts = hosts[i:i + self.options.hosts_batch]
+                records = []
+                events = []
+                for event in self.events(some_hosts):
+                    if events and event[:2] != events[-1][:2]:
+                        records.extend(self.rebuild(events))
+                        events = []
+                    events.append(event)
+                records.extend(self.rebuild(events))
+
+                for j in xrange(0, len(records), self.options.batch_size):
+                    stored += self.store(records[j:j + self.options.batch_size])
+                # Hosts are done once their records are stored
+                with lock:
+                    f.write(''.join('%s\n' % host for host in some_hosts))
+                    f.flush()
+                log("shard %d: %d/%d hosts, %d records stored (%.1fs)", shard, i + len(some_hosts), len(hosts), stored, time.time() - now)
+        return stored
+
+    def run(self):
+        self.connect()
+        if not os.path.isdir(self.options.checkpoint_dir):
+            os.makedirs(self.options.checkpoint_dir)
+        hosts = self.hosts()
+        self.con.close()
+        done = self.done_hosts()
+        log("%d hosts in the logs from %s to %s, %d already done", len(hosts), self.start or 'the beginning', self.end,
+            len(done))
+        hosts = [h for h in hosts if h not in done]
+
+        lock = multiprocessing.Lock()
+        workers = max(1, min(self.options.workers, len(hosts)))
+        shards = [hosts[i::workers] for i in xrange(workers)]
+        if workers == 1:
+            self.run_shard(0, shards[0], lock)
+            return
+
+        processes = [multiprocessing.Process(target=self.run_shard, args=(i, shard, lock)) for i, shard in enumerate(shards)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [i for i, process in enumerate(processes) if process.exitcode]
+        if failed:
+            log("shards %s failed, run the backfill again to resume them", failed)
+            sys.exit(1)
+
+
+def merge_partitions(cursors, fields):
+    """
+    Merge the documents of partitions cursors sorted by host_name, service_description, time
+
+    The partitions are in time order: for the same host/service, the documents of a partition
+    are older than the documents of the next partition.
+    """
+    key = lambda doc: (doc[fields['host_name']], doc.get(fields['service_description'], ''))
+    heap = []
+    for i, cursor in enumerate(cursors):
+        for doc in cursor:
+            heapq.heappush(heap, (key(doc), i, doc, cursor))
+            break
+    while heap:
+        k, i, doc, cursor = heapq.heappop(heap)
+        yield doc
+        for doc in cursor:
+            heapq.heappush(heap, (key(doc), i, doc, cursor))
+            break
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--uri', default='mongodb://localhost', help="MongoDB connection string")
+    parser.add_option('--database', default='shinken', help="database name")
+    parser.add_option('--logs-collection', default='logs', help="logs collection name")
+    parser.add_option('--logs-retention', default='delete', help="logs retention of the module: delete, ttl or partitioned")
+    parser.add_option('--storage-schema', default='full', help="logs storage schema of the module: full or compact")
+    parser.add_option('--hav-collection', default='availability', help="availability collection name")
+    parser.add_option('--start', help="first day to rebuild (YYYY-MM-DD), default is the oldest log")
+    parser.add_option('--end', help="day after the last day to rebuild (YYYY-MM-DD), default is today")
+    parser.add_option('--overwrite', action='store_true', default=False, help="replace the existing records")
+    parser.add_option('--workers', type='int', default=multiprocessing.cpu_count(), help="number of parallel shards")
+    parser.add_option('--hosts-batch', type='int', default=100, help="number of hosts read with a single query")
+    parser.add_option('--batch-size', type='int', default=1000, help="cursor batch size and bulk upserts size")
+    parser.add_option('--checkpoint-dir', default='backfill-checkpoint', help="checkpoint file directory")
+    options, args = parser.parse_args()
+
+    Backfill(options).run()
+
+
+if __name__ == '__main__':
+    main()
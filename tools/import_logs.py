@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2015:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#    Frederic Mohier, frederic.mohier@gmail.com
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Import Nagios/Shinken flat log files (nagios.log, shinken.log, archives) in the logs collection.
+
+The files, optionally gzip or bzip2 compressed, are read line by line, filtered and parsed as
+the module does, and inserted by batches with unordered bulk inserts. Lines which are already
+stored (same time and message) are not inserted again, a file may be imported more than once.
+The logs collections indexes of the module are created in each collection the lines are
+inserted in. Bucketed logs collections (logs_bucketing) are not supported.
+Several files are imported in parallel by worker processes:
+
+    python tools/import_logs.py /var/log/nagios/archives/nagios-*.log.gz --workers 4
+    python tools/import_logs.py shinken.log --logs-retention partitioned --storage-schema compact
+"""
+
+import os
+import sys
+import bz2
+import gzip
+import time
+import datetime
+import optparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+from module.log_line import parse_log_line, compact_document, expand_document, LoglineWrongFormat, COMPACT_FIELDS
+from module.filters import LogLinesFilter
+from module.mongo_sink import parse_indexes, LOGS_INDEXES, LOGS_INDEXES_COMPACT, BUCKETING_NONE
+
+
+def log(message, *args):
+    sys.stderr.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), message % args))
+
+
+def open_file(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        return bz2.BZ2File(filename, 'rb')
+    return open(filename, 'rb')
+
+
+class Importer(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.compact = options.storage_schema == 'compact'
+        self.time_field = COMPACT_FIELDS['time'][0] if self.compact else 'time'
+        self.message_field = COMPACT_FIELDS['message'][0] if self.compact else 'message'
+        self.filter = LogLinesFilter(options.include, options.exclude)
+        self.indexes = parse_indexes(options.logs_indexes or (LOGS_INDEXES_COMPACT if self.compact else LOGS_INDEXES))
+        # Collections which indexes were created
+        self.indexed = set()
+        self.db = None
+
+    def connect(self):
+        # One connection per process, connections must not be shared with forked processes
+        self.db = MongoClient(self.options.uri)[self.options.database]
+
+    def get_collection(self, timestamp):
+        if self.options.logs_retention != 'partitioned':
+            return self.options.logs_collection
+        t = time.localtime(timestamp)
+        return '%s_%04d_%02d' % (self.options.logs_collection, t.tm_year, t.tm_mon)
+
+    def create_indexes(self, collection):
+        for keys, unique in self.indexes:
+            try:
+                self.db[collection].create_index(keys, unique=unique, background=True)
+            except Exception, exp:
+                log("could not create the index %s for the collection %s: %s", keys, collection, exp)
+        self.indexed.add(collection)
+
+    def existing(self, collection, some_logs):
+        """
+        Get the (time, message) of the stored logs in the time range of a batch
+        """
+        query = {self.time_field: {'$gte': some_logs[0]['time'], '$lte': some_logs[-1]['time']}}
+        if not self.compact or self.options.storage_message:
+            projection = {'_id': False, self.time_field: True, self.message_field: True}
+            return set((doc.get(self.time_field), (doc.get(self.message_field) or u'').rstrip())
+                       for doc in self.db[collection].find(query, projection))
+        # The message may have to be rebuilt
+        result = set()
+        for doc in self.db[collection].find(query, {'_id': False}):
+            doc = expand_document(doc)
+            result.add((doc['time'], doc['message'].rstrip()))
+        return result
+
+    def insert(self, some_logs):
+        """
+        Insert a batch of logs, sorted by time, which are not yet stored
+
+        Returns the number of inserted logs
+        """
+        partitions = {}
+        for values in some_logs:
+            partitions.setdefault(self.get_collection(values['time']), []).append(values)
+
+        inserted = 0
+        for collection, logs in sorted(partitions.items()):
+            if collection not in self.indexed:
+                self.create_indexes(collection)
+            if self.options.dedup:
+                existing = self.existing(collection, logs)
+                if existing:
+                    logs = [values for values in logs
+                            if (values['time'], values['message'].decode('UTF-8', 'replace').rstrip()) not in existing]
+            if not logs:
+                continue
+            if self.options.logs_retention == 'ttl':
+                for values in logs:
+                    values['date'] = datetime.datetime.utcfromtimestamp(values['time'])
+            if self.compact:
+                logs = [compact_document(values, self.options.storage_message) for values in logs]
+            try:
+                inserted += len(self.db[collection].insert_many(logs, ordered=False).inserted_ids)
+            except BulkWriteError, exp:
+                inserted += exp.details.get('nInserted', 0)
+                log("%d errors when inserting in %s: %s", len(exp.details.get('writeErrors', [])), collection,
+                    exp.details.get('writeErrors', [{}])[0].get('errmsg'))
+        return inserted
+
+    def import_file(self, filename):
+        """
+        Import a log file, returns (filename, lines, inserted logs)
+        """
+        if self.db is None:
+            self.connect()
+
+        now = time.time()
+        check = self.filter.check
+        lines = inserted = 0
+        some_logs = []
+        with open_file(filename) as f:
+            for line in f:
+                lines += 1
+                # As the module, which parses the received lines right-stripped
+                line = line.rstrip()
+                if not line or check(line):
+                    continue
+                try:
+                    values = parse_log_line(line)
+                except LoglineWrongFormat:
+                    continue
+                if values:
+                    some_logs.append(values)
+                if len(some_logs) >= self.options.batch_size:
+                    some_logs.sort(key=lambda values: values['time'])
+                    inserted += self.insert(some_logs)
+                    some_logs = []
+        if some_logs:
+            some_logs.sort(key=lambda values: values['time'])
+            inserted += self.insert(some_logs)
+
+        log("%s: %d lines, %d logs inserted (%.1f lines/s)", filename, lines, inserted, lines / max(time.time() - now, 0.001))
+        return filename, lines, inserted
+
+
+# Importer of the worker processes
+importer = None
+
+
+def init_worker(options):
+    global importer
+    importer = Importer(options)
+
+
+def import_file(filename):
+    try:
+        return importer.import_file(filename)
+    except Exception, exp:
+        log("%s: import failed: %s", filename, exp)
+        return filename, 0, 0
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] file...")
+    parser.add_option('--uri', default='mongodb://localhost', help="MongoDB connection string")
+    parser.add_option('--database', default='shinken', help="database name")
+    parser.add_option('--logs-collection', default='logs', help="logs collection name")
+    parser.add_option('--logs-retention', default='delete', help="logs retention of the module: delete, ttl or partitioned")
+    parser.add_option('--logs-bucketing', default=BUCKETING_NONE, help="logs bucketing of the module, only none is supported")
+    parser.add_option('--logs-indexes', default='', help="logs collection indexes of the module, default is the module default")
+    parser.add_option('--storage-schema', default='full', help="logs storage schema of the module: full or compact")
+    parser.add_option('--storage-message', type='int', default=1, help="store the messages with the compact schema (1 or 0)")
+    parser.add_option('--include', default='', help="log lines types/classes to store, as the module logs_include")
+    parser.add_option('--exclude', default='', help="log lines types/classes not to store, as the module logs_exclude")
+    parser.add_option('--no-dedup', dest='dedup', action='store_false', default=True,
+                      help="do not check if the lines are already stored")
+    parser.add_option('--batch-size', type='int', default=10000, help="number of lines inserted at once")
+    parser.add_option('--workers', type='int', default=1, help="number of files imported in parallel")
+    options, files = parser.parse_args()
+    if not files:
+        parser.error("no file to import")
+    if options.logs_bucketing != BUCKETING_NONE:
+        parser.error("bucketed logs collections are not supported, logs_bucketing must be %s" % BUCKETING_NONE)
+
+    now = time.time()
+    if options.workers > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(min(options.workers, len(files)), init_worker, (options, ))
+        results = pool.map(import_file, files, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        init_worker(options)
+        results = [import_file(filename) for filename in files]
+
+    lines = sum(r[1] for r in results)
+    inserted = sum(r[2] for r in results)
+    log("%d files, %d lines, %d logs inserted in %.1fs", len(files), lines, inserted, time.time() - now)
+
+
+if __name__ == '__main__':
+    main()